@@ -0,0 +1,90 @@
+"""Micro-benchmarks of the API endpoints on synthetic data.
+
+    python -m benchmarks.api_benchmark
+    python -m benchmarks.api_benchmark --mongo-uri mongodb://localhost:27017 --sizes 10 1000 50000
+
+The requests go through the whole app in process (middlewares, JWT, validation, Mongo, JSON),
+without a network hop. Without --mongo-uri the data lives in the in-memory stand-in
+(mongomock-motor), which does not run the trades : those rows report the error.
+Each endpoint is called once to warm the caches, then --repeat times.
+"""
+import argparse
+import asyncio
+import time
+
+from benchmarks.harness import DATABASE, http_client, latency_summary, load_app, login
+from benchmarks.synthetic import ADMIN_USER, BENCHMARK_PASSWORD, SIZES, seed_database
+
+# Per portfolio size
+PORTFOLIO_ENDPOINTS = [
+    ("analytics", "GET", "/portfolio/{name}/analytics", None),
+    ("value", "GET", "/portfolio/{name}/value", None),
+    ("cost", "GET", "/portfolio/{name}/cost", None),
+    ("total_return", "GET", "/portfolio/{name}/total_return", None),
+    ("return_by_asset_class", "GET", "/portfolio/{name}/return_by_asset_class", None),
+    ("return_by_geo_zone", "GET", "/portfolio/{name}/return_by_geo_zone", None),
+    ("return_by_asset", "GET", "/portfolio/{name}/return_by_asset", None),
+    ("assets", "GET", "/portfolio/{name}/assets", None),
+    ("buy", "PUT", "/portfolio/{name}/buy/SYM000000", {"qty": 1, "cost_price": 100}),
+    ("sell", "PUT", "/portfolio/{name}/sell/SYM000000", {"qty": 1, "sell_price": 100}),
+]
+# Bulk listings, once
+LISTING_ENDPOINTS = [
+    ("assets page", "GET", "/assets/", {"limit": 1000}),
+    ("assets stream", "GET", "/assets/", {"stream": "true"}),
+    ("portfolios page", "GET", "/portfolios/", {"limit": 100}),
+    ("users page", "GET", "/users/", {"limit": 100}),
+]
+
+
+async def measure(client, headers, method: str, path: str, params, repeat: int):
+    # Latencies of the successful calls, or the first error
+    samples = []
+    for attempt in range(repeat + 1):
+        start = time.perf_counter()
+        response = await client.request(method, path, params=params, headers=headers)
+        elapsed = time.perf_counter() - start
+        if response.status_code >= 400:
+            return samples, f"{response.status_code} {response.text[:60]}"
+        if attempt:
+            samples.append(elapsed)
+    return samples, None
+
+
+def print_row(label: str, samples, error):
+    if error is not None:
+        print(f"{label:<40} {'failed : ' + error}")
+        return
+    summary = latency_summary(samples)
+    print(f"{label:<40} {summary['min']:>9.2f} {summary['p50']:>9.2f} {summary['p95']:>9.2f} {summary['mean']:>9.2f}")
+
+
+async def run(args):
+    main = load_app(args.mongo_uri, args.database)
+    await seed_database(main.db, args.users, args.assets, args.sizes, user_sizes=(), seed=args.seed)
+    async with http_client(main.app) as client:
+        headers = await login(client, ADMIN_USER, BENCHMARK_PASSWORD)
+        print(f"{'endpoint':<40} {'min ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'mean ms':>9}")
+        for size in args.sizes:
+            for label, method, path, params in PORTFOLIO_ENDPOINTS:
+                samples, error = await measure(client, headers, method, path.format(name=f"bench_{size}"), params, args.repeat)
+                print_row(f"{label} ({size} positions)", samples, error)
+        for label, method, path, params in LISTING_ENDPOINTS:
+            samples, error = await measure(client, headers, method, path, params, args.repeat)
+            print_row(label, samples, error)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mongo-uri", default=None)
+    parser.add_argument("--database", default=DATABASE)
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--assets", type=int, default=max(SIZES))
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
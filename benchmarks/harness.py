@@ -0,0 +1,71 @@
+"""The API under benchmark : in process on a local mongod or an in-memory stand-in, or a running server."""
+import math
+import os
+import statistics
+
+DATABASE = "AssetVisionBenchmark"
+
+
+def use_in_memory_mongo():
+    # mongomock-motor implements the Motor API in memory. It runs the reads and simple writes, the
+    # trades (pipeline updates and bulk writes) fail against it.
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError as e:
+        raise SystemExit("Without --mongo-uri the benchmarks run on mongomock-motor : pip install mongomock-motor") from e
+    import utils.db
+
+    client = AsyncMongoMockClient()
+    utils.db.get_client = lambda: client
+
+
+def load_app(mongo_uri: str = None, database: str = DATABASE):
+    # Imports main with every secret from the environment (utils.secret_tools) : no GCP access needed
+    os.environ["MONGODB_STR"] = mongo_uri or "mongodb://in-memory"
+    os.environ.setdefault("HASH_KEY", "benchmark-signing-key-not-for-production")
+    os.environ["MONGO_DATABASE"] = database
+    if mongo_uri is None:
+        use_in_memory_mongo()
+    else:
+        from pymongo import MongoClient
+        from setup_mongo import migrate
+
+        # Indexes and time-series collections
+        migrate(MongoClient(mongo_uri)[database])
+    import main
+
+    return main
+
+
+def http_client(app=None, url: str = None):
+    try:
+        import httpx
+    except ImportError as e:
+        raise SystemExit("The benchmarks send their requests with httpx : pip install httpx") from e
+    if url is not None:
+        return httpx.AsyncClient(base_url=url, timeout=120)
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app, raise_app_exceptions=False), base_url="http://benchmark", timeout=120)
+
+
+async def login(client, username: str, password: str):
+    response = await client.post("/login", data={"username": username, "password": password})
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+def percentile(sorted_samples, p: float):
+    # Nearest rank
+    if not sorted_samples:
+        return math.nan
+    return sorted_samples[max(math.ceil(p / 100 * len(sorted_samples)) - 1, 0)]
+
+
+def latency_summary(samples):
+    # Seconds in, milliseconds out
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "min": ordered[0] * 1000 if ordered else math.nan,
+        "mean": statistics.fmean(ordered) * 1000 if ordered else math.nan,
+        **{f"p{p}": percentile(ordered, p) * 1000 for p in (50, 95, 99)},
+    }
@@ -0,0 +1,105 @@
+"""HTTP load scenario : concurrent users valuing, listing and trading their portfolios.
+
+    python -m benchmarks.load_test --concurrency 20 --duration 30
+    python -m benchmarks.load_test --mongo-uri mongodb://localhost:27017
+    python -m benchmarks.load_test --url http://localhost:8080 --no-seed
+
+Each virtual user logs in as one of the synthetic users and sends requests drawn from SCENARIO,
+back to back, for --duration seconds. Latency percentiles and throughput are reported per request
+type and overall. Without --url the app runs in process (see benchmarks.api_benchmark), with it
+the server must run on a database seeded by benchmarks.synthetic. --max-p95 makes the run fail
+when the overall p95 latency is higher, to catch regressions before deploying.
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+from collections import defaultdict
+
+from benchmarks.harness import DATABASE, http_client, latency_summary, load_app, login
+from benchmarks.synthetic import BENCHMARK_PASSWORD, seed_database, synthetic_users
+
+# (request type, weight, method, path, params), {name} is a portfolio of the user
+SCENARIO = [
+    ("value", 30, "GET", "/portfolio/{name}/value", None),
+    ("analytics", 10, "GET", "/portfolio/{name}/analytics", None),
+    ("return_by_asset", 15, "GET", "/portfolio/{name}/return_by_asset", None),
+    ("portfolio assets", 10, "GET", "/portfolio/{name}/assets", None),
+    ("assets page", 10, "GET", "/assets/", {"limit": 100}),
+    ("asset", 10, "GET", "/asset/SYM000000", None),
+    ("buy", 8, "PUT", "/portfolio/{name}/buy/SYM000000", {"qty": 1, "cost_price": 100}),
+    ("sell", 7, "PUT", "/portfolio/{name}/sell/SYM000000", {"qty": 1, "sell_price": 100}),
+]
+USER_SIZES = (10, 100)
+
+
+async def virtual_user(client, username: str, deadline: float, rng, latencies, errors):
+    headers = await login(client, username, BENCHMARK_PASSWORD)
+    weights = [weight for _, weight, *_ in SCENARIO]
+    while time.perf_counter() < deadline:
+        label, _, method, path, params = rng.choices(SCENARIO, weights)[0]
+        path = path.format(name=f"bench_{rng.choice(USER_SIZES)}")
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, path, params=params, headers=headers)
+            failed = response.status_code >= 400
+        except Exception:
+            failed = True
+        if failed:
+            errors[label] += 1
+        else:
+            latencies[label].append(time.perf_counter() - start)
+
+
+def print_report(latencies, errors, duration: float):
+    print(f"{'request':<20} {'ok':>7} {'errors':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    rows = [(label, latencies[label]) for label, *_ in SCENARIO] + [("all", [sample for samples in latencies.values() for sample in samples])]
+    for label, samples in rows:
+        summary = latency_summary(samples)
+        failed = sum(errors.values()) if label == "all" else errors[label]
+        print(f"{label:<20} {summary['count']:>7} {failed:>7} {summary['count'] / duration:>8.1f} {summary['p50']:>9.2f} {summary['p95']:>9.2f} {summary['p99']:>9.2f}")
+    return latency_summary(rows[-1][1])
+
+
+async def run(args):
+    app = None
+    if args.url is None:
+        main = load_app(args.mongo_uri, args.database)
+        app = main.app
+        if not args.no_seed:
+            await seed_database(main.db, args.users, args.assets, sizes=(), user_sizes=USER_SIZES, seed=args.seed)
+    users = synthetic_users(args.users)[1:]
+    latencies, errors = defaultdict(list), defaultdict(int)
+    async with http_client(app, args.url) as client:
+        start = time.perf_counter()
+        deadline = start + args.duration
+        await asyncio.gather(*(
+            virtual_user(client, users[index % len(users)], deadline, random.Random(args.seed + index), latencies, errors)
+            for index in range(args.concurrency)
+        ))
+        duration = time.perf_counter() - start
+    overall = print_report(latencies, errors, duration)
+    if args.max_p95 is not None and not overall["p95"] <= args.max_p95:
+        print(f"p95 {overall['p95']:.2f} ms is above --max-p95 {args.max_p95} ms")
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default=None)
+    parser.add_argument("--mongo-uri", default=None)
+    parser.add_argument("--database", default=DATABASE)
+    parser.add_argument("--no-seed", action="store_true")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--assets", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--max-p95", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    sys.exit(asyncio.run(run(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
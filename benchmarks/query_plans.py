@@ -0,0 +1,86 @@
+"""Query plan regression harness : explains every query shape of utils.query_catalogue.
+
+    python -m benchmarks.query_plans --mongo-uri mongodb://localhost:27017
+    python -m benchmarks.query_plans --mongo-uri mongodb://localhost:27017 --database AssetVision --no-migrate --no-seed
+
+The database is first migrated to the catalogue indexes (setup_mongo.py) and seeded with the
+synthetic data, then each shape is explained. Collection scans, blocking in-memory sorts and
+unindexed $lookup fail the run (exit status 1) unless accepted for the shape, and the index that
+would serve the query is printed. --no-migrate checks the indexes of an existing database as they
+are, e.g. a copy of production.
+"""
+import argparse
+import asyncio
+import sys
+
+from benchmarks.harness import DATABASE
+from utils.query_catalogue import QUERY_SHAPES, catalogued_index, command_collection, plan_problems, plan_stages, recommend_index
+
+
+def explain(db, command):
+    return db.command({"explain": command, "verbosity": "queryPlanner"})
+
+def index_names(explain_output):
+    names = []
+    def walk(node):
+        if isinstance(node, dict):
+            if "indexName" in node and node["indexName"] not in names:
+                names.append(node["indexName"])
+            for key, value in node.items():
+                if key not in ("rejectedPlans", "allPlansExecution", "command"):
+                    walk(value)
+        elif isinstance(node, list):
+            for item in node:
+                walk(item)
+    walk(explain_output)
+    return names
+
+def check_shapes(db):
+    # (label, collection, indexes used, problems, recommended keys) of every shape
+    results = []
+    for label, command, accepted in QUERY_SHAPES:
+        output = explain(db, command)
+        stages = plan_stages(output)
+        problems = plan_problems(stages, accepted)
+        if "EOF" in stages:
+            problems.append("collection missing, the plan is not meaningful")
+        results.append((label, command_collection(command), index_names(output), problems, recommend_index(command)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mongo-uri", required=True)
+    parser.add_argument("--database", default=DATABASE)
+    parser.add_argument("--no-migrate", action="store_true")
+    parser.add_argument("--no-seed", action="store_true")
+    args = parser.parse_args()
+
+    from pymongo import MongoClient
+
+    db = MongoClient(args.mongo_uri)[args.database]
+    if not args.no_migrate:
+        from setup_mongo import migrate
+
+        migrate(db)
+    if not args.no_seed:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        from benchmarks.synthetic import seed_database
+
+        asyncio.run(seed_database(AsyncIOMotorClient(args.mongo_uri)[args.database], n_users=5, n_assets=2000, sizes=[10, 100, 1000]))
+
+    failed = 0
+    for label, collection, indexes, problems, keys in check_shapes(db):
+        print(f"{'FAIL' if problems else 'ok':<5} {collection:<21} {label:<60} {', '.join(indexes) or '-'}")
+        if problems:
+            failed += 1
+            print(f"      {'; '.join(problems)}")
+            if keys:
+                note = "" if catalogued_index(collection, keys) else " (add it to utils.query_catalogue.INDEXES)"
+                print(f"      recommended index : db.{collection}.createIndex({{{', '.join(f'{field!r}: {direction}' for field, direction in keys)}}}){note}")
+    print(f"{len(QUERY_SHAPES) - failed} of {len(QUERY_SHAPES)} query shapes served by an index")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""CPU cost per document of the JSON encoding paths of the list and analytics responses.
+
+    python -m benchmarks.serialisation_benchmark
+    python -m benchmarks.serialisation_benchmark --documents 50000 --repeat 3
+
+Assets are encoded to BSON as Mongo would send them, then timed (process CPU time) from the BSON
+bytes to the JSON body : through the Asset model and jsonable_encoder as FastAPI does by default,
+and through the FAST_JSON path (projection, model defaults, utils.fast_json). Decoding alone,
+with dicts and with RawBSONDocument, is timed as the floor. The analytics rows time the body of
+/portfolio/{name}/analytics per position.
+"""
+import argparse
+import json
+import math
+import time
+from datetime import datetime, timezone
+
+import bson
+from bson.raw_bson import RawBSONDocument
+from fastapi.encoders import jsonable_encoder
+
+from benchmarks.synthetic import ADMIN_USER, synthetic_market, synthetic_portfolio
+from models.Asset import Asset
+from utils.fast_json import dumps, orjson
+from utils.listing import model_document, model_field_names
+from utils.valuation import analyze_portfolio
+
+
+def cpu_time(function, repeat: int):
+    best = math.inf
+    for _ in range(repeat):
+        start = time.process_time()
+        function()
+        best = min(best, time.process_time() - start)
+    return best
+
+def starlette_dumps(content):
+    # What JSONResponse does with the output of jsonable_encoder
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode()
+
+def asset_documents(n: int):
+    assets, _ = synthetic_market(n)
+    # Naive UTC, as Motor returns dates
+    now = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+    return [
+        bson.encode({
+            "_id": bson.ObjectId(), "symbol": symbol, "name": f"Asset {symbol}", "industry": "Energy", **data,
+            "created_by": ADMIN_USER, "created_at": now, "last_updated_by": ADMIN_USER, "last_updated_at": now,
+        })
+        for symbol, data in assets.items()
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--documents", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    raw = asset_documents(args.documents)
+    to_document = model_document(Asset)
+    fields = model_field_names(Asset)
+    assets, rates = synthetic_market(args.documents)
+    analytics = analyze_portfolio(synthetic_portfolio("bench", list(assets), args.documents), assets, rates)
+
+    rows = [
+        ("bson decode, dict", lambda: [bson.decode(document) for document in raw]),
+        ("bson decode, RawBSONDocument", lambda: [dict(RawBSONDocument(document)) for document in raw]),
+        ("Asset + jsonable_encoder", lambda: starlette_dumps(jsonable_encoder([Asset(**bson.decode(document)) for document in raw]))),
+        # The projection leaves _id out on the server, the decode here keeps the fields it would return
+        ("FAST_JSON", lambda: dumps([to_document({key: value for key, value in bson.decode(document).items() if key in fields}) for document in raw])),
+        ("analytics, jsonable_encoder", lambda: starlette_dumps(jsonable_encoder(analytics))),
+        ("analytics, FAST_JSON", lambda: dumps(analytics)),
+    ]
+    print(f"encoder : {'orjson' if orjson is not None else 'json (pip install orjson for the fast encoder)'}")
+    print(f"{'path':<32} {'us / document':>14}")
+    timings = {}
+    for label, function in rows:
+        timings[label] = cpu_time(function, args.repeat) / args.documents * 1e6
+        print(f"{label:<32} {timings[label]:>14.2f}")
+    print(f"lists {timings['Asset + jsonable_encoder'] / timings['FAST_JSON']:.1f}x, analytics {timings['analytics, jsonable_encoder'] / timings['analytics, FAST_JSON']:.1f}x less CPU")
+
+
+if __name__ == "__main__":
+    main()
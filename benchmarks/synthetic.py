@@ -0,0 +1,135 @@
+"""Synthetic data for the benchmarks : users, assets across currencies and asset classes, FX rates and portfolios.
+
+    python -m benchmarks.synthetic --mongo-uri mongodb://localhost:27017 --database AssetVisionBenchmark
+
+Seeds a database the way the API writes it, for an API started on it (MONGO_DATABASE) and
+benchmarks.load_test --url. Every user logs in with the password BENCHMARK_PASSWORD, the admin
+user ADMIN_USER owns one portfolio of each size in --sizes. The data only depends on --seed.
+"""
+import argparse
+import asyncio
+import random
+from datetime import datetime
+
+import bcrypt
+import pytz
+
+CURRENCIES = ["USD", "CHF", "EUR", "GBP", "JPY"]
+ASSET_CLASSES = ["Equity", "Bond", "Commodity", "Cash", "Real Estate"]
+GEO_ZONES = ["US", "EU", "CH", "UK", "ASIA"]
+INDUSTRIES = ["Technology", "Healthcare", "Financials", "Energy", "Consumer", "Industrials"]
+SIZES = [10, 100, 1000, 10000, 50000]
+ADMIN_USER = "benchmark"
+BENCHMARK_PASSWORD = "benchmark"
+CH_timezone = pytz.timezone('Europe/Zurich')
+
+
+def synthetic_market(n_assets: int, seed: int = 0):
+    # symbol -> asset fields used by the valuations, pair -> rate for every pair of CURRENCIES
+    rng = random.Random(seed)
+    assets = {
+        f"SYM{i:06d}": {
+            "last_price": round(rng.uniform(1, 500), 2),
+            "currency": rng.choice(CURRENCIES),
+            "asset_class": rng.choice(ASSET_CLASSES),
+            "geo_zone": rng.choice(GEO_ZONES),
+        }
+        for i in range(n_assets)
+    }
+    usd_rates = {currency: rng.uniform(0.5, 1.5) for currency in CURRENCIES}
+    usd_rates["USD"] = 1.0
+    rates = {base + target: usd_rates[base] / usd_rates[target] for base in CURRENCIES for target in CURRENCIES}
+    return assets, rates
+
+
+def synthetic_portfolio(name: str, symbols, n_positions: int, seed: int = 0, owner: str = ADMIN_USER):
+    rng = random.Random(seed)
+    return {
+        "name": name,
+        "owner": owner,
+        "portfolio_currency": "USD",
+        "portfolio_content": [
+            {"symbol": symbol, "qty": rng.randint(1, 1000), "cost_prices": round(rng.uniform(1, 500), 2)}
+            for symbol in rng.sample(symbols, n_positions)
+        ],
+    }
+
+
+def synthetic_users(n_users: int):
+    # The admin user first, then user0000, user0001...
+    return [ADMIN_USER] + [f"user{i:04d}" for i in range(n_users)]
+
+
+def portfolio_plan(users, sizes=SIZES, user_sizes=(10, 100)):
+    # (owner, name, size) of every portfolio : one per size for the admin, one per user size for the others
+    plan = [(ADMIN_USER, f"bench_{size}", size) for size in sizes]
+    for user in users[1:]:
+        plan += [(user, f"bench_{size}", size) for size in user_sizes]
+    return plan
+
+
+async def seed_database(db, n_users: int = 10, n_assets: int = max(SIZES), sizes=SIZES, user_sizes=(10, 100), seed: int = 0):
+    """Empties and fills the collections of db (Motor) with the synthetic data. Returns the portfolio plan."""
+    from utils.trade_ledger import TradeLedger
+
+    # Emptied rather than dropped : the indexes created by setup_mongo.py stay
+    for collection in ("users", "assets", "FX_rates", "portfolios", "portfolio_valuations", "trades", "position_snapshots", "price_history", "FX_rates_history"):
+        await db[collection].delete_many({})
+    now = datetime.now(CH_timezone)
+    assets, rates = synthetic_market(max(n_assets, *sizes, *user_sizes), seed)
+    users = synthetic_users(n_users)
+
+    # One hash for everyone : same password, and seeding does not pay bcrypt per user
+    hashed_password = bcrypt.hashpw(BENCHMARK_PASSWORD.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+    await db.users.insert_many([
+        {"username": user, "hashed_password": hashed_password, "email": f"{user}@example.com",
+         "roles": ["admin", "user"] if user == ADMIN_USER else ["user"], "created_at": now}
+        for user in users
+    ])
+    rng = random.Random(seed)
+    result = await db.assets.insert_many([
+        {"symbol": symbol, "name": f"Asset {symbol}", "industry": rng.choice(INDUSTRIES), **data,
+         "created_by": ADMIN_USER, "created_at": now, "last_updated_by": ADMIN_USER, "last_updated_at": now}
+        for symbol, data in assets.items()
+    ])
+    asset_ids = dict(zip(assets, result.inserted_ids))
+    await db.FX_rates.insert_many([
+        {"symbol": pair, "base_currency": pair[:3], "target_currency": pair[3:], "last_rate": rate,
+         "created_by": ADMIN_USER, "created_at": now, "last_updated_by": ADMIN_USER, "last_updated_at": now}
+        for pair, rate in rates.items()
+    ])
+    # A new market : ETags given out before the seed must not match any more
+    await db.versions.update_one({"_id": "market"}, {"$inc": {"version": 1}}, upsert=True)
+
+    # Portfolios as POST /portfolio writes them, with the starting snapshot of the trade ledger
+    ledger = TradeLedger(db.trades, db.position_snapshots, db.portfolios)
+    symbols = list(assets)
+    plan = portfolio_plan(users, sizes, user_sizes)
+    for index, (owner, name, size) in enumerate(plan):
+        portfolio = synthetic_portfolio(name, symbols, size, seed=seed + index, owner=owner)
+        for position in portfolio["portfolio_content"]:
+            position["asset_id"] = asset_ids[position["symbol"]]
+        await db.portfolios.insert_one({**portfolio, "created_at": now, "last_updated_at": now, "trades_since_snapshot": 0})
+        await ledger.snapshot(owner, name, portfolio["portfolio_content"], now)
+    return plan
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mongo-uri", required=True)
+    parser.add_argument("--database", default="AssetVisionBenchmark")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--assets", type=int, default=max(SIZES))
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    db = AsyncIOMotorClient(args.mongo_uri)[args.database]
+    plan = asyncio.run(seed_database(db, args.users, args.assets, args.sizes, seed=args.seed))
+    print(f"{args.database} : {args.users + 1} users, {max(args.assets, *args.sizes)} assets, {len(plan)} portfolios")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Compare the vectorised valuation engine with the Mongo aggregation pipeline.
+
+    python -m benchmarks.valuation_benchmark
+    python -m benchmarks.valuation_benchmark --mongo-uri mongodb://localhost:27017
+
+Without --mongo-uri only the in-process engine is timed. With it, the synthetic data is written
+to a scratch database, the $facet pipeline is timed on the same portfolios and both results
+are checked to match.
+"""
+import argparse
+import math
+import time
+
+from benchmarks.synthetic import SIZES, synthetic_market, synthetic_portfolio
+from utils.valuation import PORTFOLIO_FACETS, analyze_portfolio, portfolio_analytics_pipeline
+
+
+def timed(function, repeat: int):
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def same_figures(engine_result, mongo_result):
+    engine_total, mongo_total = engine_result["total"], mongo_result["total"][0]
+    return all(
+        math.isclose(engine_total[field], mongo_total[field], rel_tol=1e-9)
+        for field in ("converted_price", "converted_cost_price")
+    ) and len(engine_result["by_asset"]) == len(mongo_result["by_asset"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mongo-uri", default=None)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    assets, rates = synthetic_market(max(SIZES))
+    symbols = list(assets)
+    portfolios = [synthetic_portfolio(f"bench_{size}", symbols, size, seed=size) for size in SIZES]
+
+    db = None
+    if args.mongo_uri:
+        from pymongo import MongoClient
+
+        db = MongoClient(args.mongo_uri).AssetVisionBenchmark
+        db.assets.drop()
+        db.portfolios.drop()
+        db.assets.create_index("symbol", unique=True)
+        db.assets.insert_many([dict(symbol=symbol, **data) for symbol, data in assets.items()])
+        db.portfolios.insert_many([dict(portfolio) for portfolio in portfolios])
+
+    print(f"{'positions':>10} {'engine ms':>10} {'mongo ms':>10} {'speedup':>8} {'match':>6}")
+    for size, portfolio in zip(SIZES, portfolios):
+        engine_time, engine_result = timed(lambda: analyze_portfolio(portfolio, assets, rates), args.repeat)
+        line = f"{size:>10} {engine_time * 1000:>10.2f}"
+        if db is not None:
+            pipeline = portfolio_analytics_pipeline(portfolio["name"], portfolio["owner"], rates, PORTFOLIO_FACETS)
+            mongo_time, mongo_result = timed(lambda: db.portfolios.aggregate(pipeline, allowDiskUse=True).next(), args.repeat)
+            match = same_figures(engine_result, mongo_result)
+            line += f" {mongo_time * 1000:>10.2f} {mongo_time / engine_time:>7.1f}x {str(match):>6}"
+        print(line)
+
+    if db is not None:
+        db.client.drop_database(db.name)
+
+
+if __name__ == "__main__":
+    main()
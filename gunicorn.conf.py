@@ -0,0 +1,33 @@
+"""Gunicorn settings.
+
+With SHARED_PRICES=1 the master creates the shared price table before forking the workers and
+starts the process keeping it in line with MongoDB (utils.shared_prices). Workers find the table
+through SHARED_PRICES_NAME.
+"""
+import os
+
+shared_prices = None
+
+
+def on_starting(server):
+    global shared_prices
+    if os.environ.get("SHARED_PRICES") == "1":
+        from utils.shared_prices import ORDERED_STORES, start_owner
+
+        if not ORDERED_STORES:
+            # The seqlock of the table relies on x86-64 store ordering : each worker keeps its own cache
+            server.log.warning("SHARED_PRICES ignored : the shared price table needs an x86-64 CPU")
+            return
+        shared_prices = start_owner(
+            asset_capacity=int(os.environ.get("SHARED_PRICES_CAPACITY", 100000)),
+            reload_every=float(os.environ.get("PRICE_CACHE_MAX_AGE", 60)),
+        )
+        os.environ["SHARED_PRICES_NAME"] = shared_prices[0].name
+        server.log.info("Shared price table %s, owner pid %s", shared_prices[0].name, shared_prices[1].pid)
+
+def on_exit(server):
+    if shared_prices is not None:
+        table, process = shared_prices
+        process.terminate()
+        process.join(5)
+        table.close()
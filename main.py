@@ -1,41 +1,97 @@
 # FastAPI
-from fastapi import FastAPI, HTTPException,  Depends
+from fastapi import FastAPI, HTTPException,  Depends, Request, Response, Query
 from fastapi.openapi.docs import get_swagger_ui_html
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse, PlainTextResponse, JSONResponse
 
 # Pydantic
 from models.Portfolio import Portfolio
 from models.PortfolioRequest import PortfolioRequest
+from models.PortfolioValuationRequest import PortfolioValuationRequest
 from models.Asset import Asset
 from models.ExchangeRate import ExchangeRate
+from models.ExchangeRateFixing import ExchangeRateFixing
+from models.TradeBatch import TradeBatch
 from models.User import User
 
 
 # MongoDB 
-from pymongo import MongoClient, ReturnDocument, errors
+from utils.db import get_db, in_transaction
+from pymongo import ReturnDocument, UpdateOne, errors
 from pymongo.errors import PyMongoError
 from bson.objectid import ObjectId
 
 # GCP
-from utils.secret_tools import access_secret_version
+from utils.secret_tools import get_secret, load_secrets
+# Caching
+from utils.price_cache import PriceCache
+from utils.shared_prices import SharedPriceTable
+# Bulk uploads
+from utils.ingestion import parse_rows, chunked, latest_rows, write_errors
+from utils.fixings import invalid_pairs, fixing_operations, apply_fixing
+# Listing
+from utils.listing import list_documents, list_models, fields_projection, model_field_names
+from utils.fast_json import FastJSONResponse, dumps
+# Valuation
+from utils.valuation import PORTFOLIO_FACETS, portfolio_analytics_pipeline, analyze_portfolio, value_series, return_ratio
+from utils.valuation_snapshots import ValuationSnapshots
+from utils.live_valuations import ValuationHub, NOT_FOUND, KEEP_ALIVE, KEEP_ALIVE_EVERY
+# Trades
+from utils.trades import net_trades, batch_stages, apply_netted, assets_not_found
+from utils.trade_ledger import TradeLedger, ledger_time, ledger_time_stage
+# History
+from utils.price_history import PriceHistory, parse_step, time_points, history_pairs, derive_rates
+# Monitoring
+from utils.metrics import MetricsRoute, registry, http_requests, http_request_duration, bcrypt_duration
+from utils.profiling import ProfileStore
+
+from utils.etags import PRIVATE_CACHE_CONTROL, make_etag, etag_matches, shared_cache_control, not_modified, with_cache_headers
 # Authentification
 import jwt
 import bcrypt
+from starlette.concurrency import run_in_threadpool
 
 # Others
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import pytz
+import os
 import json
+import asyncio
+import uuid
+import time
 from typing import Union
 
-client = MongoClient(access_secret_version("mongodb_str"))
-secret_key = access_secret_version("hash_key")
-db = client.AssetVision
+# Both secrets in one round trip, then one shared async connection pool for the whole app (utils.db) :
+# every handler awaits its Mongo calls so a slow aggregation no longer blocks the event loop.
+load_secrets("mongodb_str", "hash_key")
+secret_key = get_secret("hash_key")
+db = get_db()
 assets = db.assets
 portfolios = db.portfolios
 users = db.users
 rates = db.FX_rates
+# Prices and FX rates used by the portfolio valuations, kept in memory and invalidated on write.
+# PRICE_CACHE=0 falls back to joining everything inside Mongo.
+USE_PRICE_CACHE = os.environ.get("PRICE_CACHE", "1") != "0"
+# Every price and rate write bumps the market version of db.versions, part of the ETags of the polled reads
+# With SHARED_PRICES=1, gunicorn.conf.py starts one process keeping every price and rate in shared
+# memory : the workers read them from there instead of each following Mongo
+shared_prices = SharedPriceTable.attach(os.environ["SHARED_PRICES_NAME"]) if "SHARED_PRICES_NAME" in os.environ else None
+price_cache = PriceCache(db, assets, rates, max_age=float(os.environ.get("PRICE_CACHE_MAX_AGE", 60)), versions=db.versions, shared=shared_prices)
+# Materialised valuations : trades, prices and rates update the stored figures of the portfolios involved
+valuation_snapshots = ValuationSnapshots(db.portfolio_valuations, price_cache, portfolios=portfolios)
+# Every price and rate update is also appended to a time-series collection, for valuations at past dates
+price_history = PriceHistory(db.price_history)
+rate_history = PriceHistory(db.FX_rates_history)
+# Every trade is appended to the ledger, positions are snapshotted every TRADE_SNAPSHOT_EVERY trades
+trade_ledger = TradeLedger(db.trades, db.position_snapshots, portfolios, snapshot_every=int(os.environ.get("TRADE_SNAPSHOT_EVERY", 100)))
+# Admin requests sent with X-Profile (or ?profile=1) run under a sampling profiler, see /profiles/{profile_id}
+profile_store = ProfileStore()
+# Seconds a CDN may serve /assets/ without asking the API, 0 keeps it out of shared caches
+CDN_MAX_AGE = int(os.environ.get("CDN_MAX_AGE", 0))
+# FAST_JSON=1 : list and analytics responses are encoded straight to JSON bytes (orjson when installed),
+# without building the models nor going through jsonable_encoder
+FAST_JSON = os.environ.get("FAST_JSON", "0") == "1"
 
 
 # FastAPI Configuration
@@ -45,13 +101,71 @@ tags_metadata = [
     {"name": "Assets Methods", "description": "Create and manage assets."},
     {"name": "Rates Methods", "description": "Create and manage exchange rates."},
     {"name": "Portfolio Methods", "description": "Create and manage portfolios."},
+    {"name": "Administration Methods", "description": "Monitor the API."},
 ]
 app = FastAPI(openapi_tags=tags_metadata)
+# Counts the requests in flight per route (utils.metrics) : set before any route is declared
+app.router.route_class = MetricsRoute
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
 
 # Others
 CH_timezone = pytz.timezone('Europe/Zurich')
+# Projections : asset_id never leaves the database
+ASSET_FIELDS = model_field_names(Asset)
+PORTFOLIO_FIELDS = model_field_names(Portfolio)
+PORTFOLIO_CONTENT_FIELDS = {"portfolio_content": ["portfolio_content.symbol", "portfolio_content.qty", "portfolio_content.cost_prices", "portfolio_content.realized_pnl"]}
+
+####################################################################################################
+#                   Background tasks
+####################################################################################################
+background_tasks = []
+
+####################################################################################################
+#                   Metrics
+####################################################################################################
+def route_template(scope):
+    # Label requests by route template, not by raw path, to keep the number of series bounded.
+    # The router stores the matched route in the scope : only known once the request went through it
+    route = scope.get("route")
+    return route.path if route is not None else "unmatched"
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        labels = (request.method, route_template(request.scope))
+        http_request_duration.observe(time.perf_counter() - start, *labels)
+        http_requests.inc(*labels, str(status))
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics(request: Request):
+    # Prometheus scrapers do not log in : METRICS_TOKEN, when set, is expected as a bearer token
+    if (metrics_token := os.environ.get("METRICS_TOKEN")) and request.headers.get("authorization") != f"Bearer {metrics_token}":
+        raise HTTPException(status_code=401, detail="Could not validate credentials")
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+def bcrypt_timed(operation: str, function, *args):
+    # Measured in the worker thread : the wait for a free thread is not counted
+    with bcrypt_duration.time(operation):
+        return function(*args)
+
+@app.on_event("startup")
+async def start_background_tasks():
+    # Follow the writes made by the other workers on assets and FX_rates, done by the owner of the shared table when there is one
+    if shared_prices is None:
+        background_tasks.append(asyncio.create_task(price_cache.watch()))
+    background_tasks.append(asyncio.create_task(live_valuations.run()))
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    for task in background_tasks:
+        task.cancel()
 
 ####################################################################################################
 #                   Main Page
@@ -84,17 +198,18 @@ async def custom_swagger_ui_html():
 ####################################################################################################
 #                   Login
 ####################################################################################################
-def authenticate_user(username: str, password: str):
+async def authenticate_user(username: str, password: str):
     # logic to authenticate the user and return a user object
     # if the username and password are valid, otherwise return None
-    user = users.find_one({"username": username})
+    user = await users.find_one({"username": username})
     if user is None:
         return False
     try : 
          hpwd = user["hashed_password"].encode("utf-8")
     except AttributeError :
         hpwd = user["hashed_password"]
-    return bool(user and bcrypt.checkpw(password.encode("utf-8"), hpwd)) # Check if user is filled and pwd is valid
+    # bcrypt is CPU bound : run it off the event loop
+    return bool(user and await run_in_threadpool(bcrypt_timed, "checkpw", bcrypt.checkpw, password.encode("utf-8"), hpwd)) # Check if user is filled and pwd is valid
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
@@ -107,7 +222,7 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
 
 @app.post("/login", tags=["Authentification Methods"])
 async def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = authenticate_user(form_data.username, form_data.password)
+    user = await authenticate_user(form_data.username, form_data.password)
     if not user:
         raise HTTPException(status_code=401, detail="Incorrect username or password")
     access_token = create_access_token({"sub": form_data.username})
@@ -134,12 +249,99 @@ async def get_user_roles(token: str = Depends(oauth2_scheme)):
         raise HTTPException(
             status_code=401, detail="Could not validate credentials"
         ) from e
-    User_object = User(**users.find_one({"username": payload["sub"]})) # Get the User object currently connected
+    if (user := await users.find_one({"username": payload["sub"]})) is None:
+        # Valid token of a deleted user
+        raise HTTPException(status_code=401, detail="Could not validate credentials")
+    User_object = User(**user) # Get the User object currently connected
     return User_object.roles
 
 def is_admin(current_user = Depends(get_user_roles)):
     if "admin" not in current_user:
         raise HTTPException(status_code=403, detail="Admin permissions required")
+
+@app.get("/cache/stats", tags=["Administration Methods"], dependencies=[Depends(is_admin)])
+async def get_cache_stats():
+    return {**price_cache.stats(), "live_valuations": live_valuations.stats()}
+####################################################################################################
+#                   Profiling
+####################################################################################################
+def profile_requested(request: Request):
+    return "x-profile" in request.headers or "profile" in request.query_params
+
+@app.middleware("http")
+async def profile_request(request: Request, call_next):
+    # Opt-in : requests without the X-Profile header or the profile query flag go straight through
+    if not profile_requested(request):
+        return await call_next(request)
+    try:
+        authorization = request.headers.get("authorization", "")
+        if not authorization.lower().startswith("bearer "):
+            raise HTTPException(status_code=401, detail="Not authenticated")
+        is_admin(await get_user_roles(authorization[7:]))
+    except HTTPException as e:
+        return JSONResponse({"detail": e.detail}, status_code=e.status_code)
+    if (profiler := profile_store.begin(request.url.path)) is None:
+        return JSONResponse({"detail": "Another request is being profiled"}, status_code=409)
+    try:
+        response = await call_next(request)
+    except BaseException:
+        profile_store.end(profiler)
+        raise
+    profiler.route = route_template(request.scope)
+    body = response.body_iterator
+
+    async def profiled_body():
+        # Streamed responses are serialised while they are sent : the profile ends with the body
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            profile_store.end(profiler)
+    response.body_iterator = profiled_body()
+    response.headers["X-Profile-Id"] = profiler.profile_id
+    return response
+
+@app.get("/profiles/{profile_id}", tags=["Administration Methods"], dependencies=[Depends(is_admin)])
+async def get_profile(profile_id: str, format: str = "json"):
+    # format=folded : the flame data alone, for flamegraph.pl or speedscope
+    if (profiler := profile_store.get(profile_id)) is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == "folded":
+        return PlainTextResponse(profiler.folded_stacks())
+    return {"profile_id": profile_id, "route": profiler.route, **profiler.report(), "folded": profiler.folded_stacks()}
+####################################################################################################
+#                   Conditional requests
+#               ETags from the market version and the portfolio document, known while the change stream runs
+####################################################################################################
+def request_key(request: Request):
+    return request.url.path, request.url.query
+
+def market_etag(request: Request):
+    if (version := price_cache.etag_version()) is None:
+        return None
+    return make_etag(*request_key(request), version)
+
+# Fields of the portfolio document the ETag is built from, added to the projection of the handler's own read
+ETAG_FIELDS = {"owner": 1, "last_updated_at": 1, "trades_since_snapshot": 1}
+
+def portfolio_etag(request: Request, portfolio):
+    # None when no ETag can be given : the handler answers as usual, 404 included
+    if (version := price_cache.etag_version()) is None or portfolio is None:
+        return None
+    return make_etag(*request_key(request), version, portfolio.get("owner"), portfolio.get("last_updated_at"), portfolio.get("trades_since_snapshot"))
+
+def snapshot_etag(request: Request, snapshot):
+    # A stored valuation snapshot gets a new write_id on every change : it names the value served
+    if (version := price_cache.etag_version()) is None or snapshot.get("write_id") is None:
+        return None
+    return make_etag(*request_key(request), version, snapshot["write_id"])
+
+async def revalidated_portfolio_etag(request: Request, query):
+    # Read before the handler's own query only when the client sends an ETag back
+    if not request.headers.get("if-none-match") or price_cache.etag_version() is None:
+        return None
+    return portfolio_etag(request, await portfolios.find_one(query, {"_id": 0, **ETAG_FIELDS}))
+
 ####################################################################################################
 #                   User interactions
 ####################################################################################################
@@ -152,10 +354,10 @@ async def create_user(username :str, password:str, email:Union[str, None],token:
             status_code=401, detail="Could not validate credentials"
         ) from e
     creator = payload["sub"]
-    hashed_password = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
+    hashed_password = await run_in_threadpool(bcrypt_timed, "hashpw", bcrypt.hashpw, password.encode("utf-8"), bcrypt.gensalt())
     user = User(username=username,hashed_password=hashed_password, email=email, roles=["user"], created_at = datetime.now(CH_timezone))
     try:
-        users.insert_one(user.dict())
+        await users.insert_one(user.dict())
         return {"message": f"User { username } created by {creator}"}
 
     except errors.DuplicateKeyError as exc:
@@ -172,7 +374,7 @@ async def read_user(username: str, token: str = Depends(oauth2_scheme)):
             status_code=401, detail="Could not validate credentials"
         ) from e
     reader = payload["sub"]
-    return User(**users.find_one({"username": username}))
+    return User(**await users.find_one({"username": username}))
 
 @app.put("/user/{username}", tags=["Users Methods"], dependencies=[Depends(is_admin)])
 async def update_user(username, user_details: str, token: str = Depends(oauth2_scheme)):
@@ -186,11 +388,11 @@ async def update_user(username, user_details: str, token: str = Depends(oauth2_s
     try:
         user_details = json.loads(user_details)
         if "password" in user_details.keys():
-            hashed_password = bcrypt.hashpw(str(user_details["password"]).encode("utf-8"), bcrypt.gensalt())
+            hashed_password = await run_in_threadpool(bcrypt_timed, "hashpw", bcrypt.hashpw, str(user_details["password"]).encode("utf-8"), bcrypt.gensalt())
             user_details.pop("password")
 
             user_details["hashed_password"] = str(hashed_password, 'UTF-8')
-        updated_user = users.find_one_and_update(
+        updated_user = await users.find_one_and_update(
             {"username": username},
             {"$set": user_details},
             return_document=ReturnDocument.AFTER
@@ -208,13 +410,13 @@ async def delete_user(username: str, token: str = Depends(oauth2_scheme)):
             status_code=401, detail="Could not validate credentials"
         ) from e
     interactor = payload["sub"]
-    result = users.delete_one({"username": username})
+    result = await users.delete_one({"username": username})
     if result.deleted_count >= 1:
         return {"message": f"User deleted by {interactor}"}
     raise HTTPException(status_code=500, detail="Something went wrong with the deletion")
 
 @app.get("/users/", tags=["Users Methods"])
-async def get_all_users(token: str = Depends(oauth2_scheme)):
+async def get_all_users(response: Response, after:Union[str, None] = None, limit:Union[int, None] = None, stream: bool = False, token: str = Depends(oauth2_scheme)):
     try:        
         payload = jwt.decode(token, secret_key, algorithms=["HS256"])
     except jwt.PyJWTError as e:
@@ -222,7 +424,8 @@ async def get_all_users(token: str = Depends(oauth2_scheme)):
             status_code=401, detail="Could not validate credentials"
         ) from e
     interactor = payload["sub"]
-    return [User(**user) for user in users.find()]
+    after = None if after is None else [after]
+    return await list_models(users, User, ["username"], after, limit, stream, response, fast=FAST_JSON)
 
 ####################################################################################################
 #                   Unique Asset interactions
@@ -238,7 +441,12 @@ async def create_asset(symbol:str,name:str, currency:Union[str, None] = None, as
     username = payload["sub"]
     asset = Asset(symbol=symbol,name=name, last_price=last_price, currency=currency, asset_class=asset_class,geo_zone=geo_zone, industry=industry,last_updated_by = username, created_by = username, last_updated_at = datetime.now(CH_timezone) , created_at = datetime.now(CH_timezone))
     try:
-        assets.insert_one(asset.dict())
+        await assets.insert_one(asset.dict())
+        price_cache.invalidate_asset(symbol)
+        await price_history.record([(symbol, last_price)], asset.created_at)
+        await valuation_snapshots.invalidate_symbols([symbol])
+        await price_cache.bump_version()
+        live_valuations.publish_prices([symbol])
         return {"message": f"Asset { symbol } created by { username }"}
     except errors.DuplicateKeyError as exc:
         raise HTTPException(
@@ -247,7 +455,7 @@ async def create_asset(symbol:str,name:str, currency:Union[str, None] = None, as
         ) from exc
 
 @app.get("/asset/{asset_symbol}", tags=["Assets Methods"])
-async def read_asset(asset_symbol: str, token: str = Depends(oauth2_scheme)):
+async def read_asset(asset_symbol: str, fields:Union[str, None] = None, token: str = Depends(oauth2_scheme)):
     try:        
         payload = jwt.decode(token, secret_key, algorithms=["HS256"])
     except jwt.PyJWTError as e:
@@ -255,7 +463,12 @@ async def read_asset(asset_symbol: str, token: str = Depends(oauth2_scheme)):
             status_code=401, detail="Could not validate credentials"
         ) from e
     username = payload["sub"]
-    return Asset(**assets.find_one({"symbol": asset_symbol}))
+    if projection := fields_projection(fields, ASSET_FIELDS):
+        # Only the requested fields, returned as stored without building an Asset
+        if (asset := await assets.find_one({"symbol": asset_symbol}, projection)) is None:
+            raise HTTPException(status_code=404, detail="Asset not found")
+        return asset
+    return Asset(**await assets.find_one({"symbol": asset_symbol}))
 
 @app.put("/asset/{asset_symbol}", tags=["Assets Methods"], dependencies=[Depends(is_admin)])
 async def update_asset(asset_symbol, asset_details: str, to_convert_from:Union[str, None] = None, token: str = Depends(oauth2_scheme)):
@@ -271,17 +484,32 @@ async def update_asset(asset_symbol, asset_details: str, to_convert_from:Union[s
         asset_details["last_updated_by"] = str(username)
         asset_details["last_updated_at"] = datetime.now(CH_timezone)
         if to_convert_from and "last_price" in asset_details.keys(): 
-            asset_currency = assets.find_one({"symbol": asset_symbol})["currency"]
-            conv_rate = rates.find_one({"symbol": to_convert_from+asset_currency})["last_rate"]
+            if (asset_stored := (await price_cache.get_assets([asset_symbol])).get(asset_symbol)) is None:
+                raise HTTPException(status_code=404, detail="Asset not found")
+            asset_currency = asset_stored["currency"]
+            conv_rate = (await price_cache.get_rates([to_convert_from+asset_currency])).get(to_convert_from+asset_currency)
+            if conv_rate is None:
+                raise HTTPException(status_code=400, detail=f"No exchange rate from {to_convert_from} to {asset_currency}")
             try:
                 asset_details["last_price"] *= conv_rate
             except TypeError as e:
                 raise HTTPException(status_code=400, detail=str(e)) from e
-        updated_asset = assets.find_one_and_update(
+        updated_asset = await assets.find_one_and_update(
             {"symbol": asset_symbol},
             {"$set": asset_details},
             return_document=ReturnDocument.AFTER
         )
+        if updated_asset is None:
+            raise HTTPException(status_code=404, detail="Asset not found")
+        price_cache.set_asset(updated_asset)
+        if {"currency", "asset_class", "geo_zone"} & asset_details.keys():
+            await valuation_snapshots.invalidate_symbols([asset_symbol])
+        elif "last_price" in asset_details.keys():
+            await valuation_snapshots.apply_prices({asset_symbol: updated_asset["last_price"]})
+        if "last_price" in asset_details.keys():
+            await price_history.record([(asset_symbol, updated_asset["last_price"])], asset_details["last_updated_at"])
+        await price_cache.bump_version()
+        live_valuations.publish_prices([asset_symbol])
         return {"message": "Asset updated", "updated_asset" : Asset(**updated_asset)}
     except PyMongoError as e:
         raise HTTPException(status_code=400, detail=str(e)) from e
@@ -295,13 +523,17 @@ async def delete_asset(asset_symbol: str, token: str = Depends(oauth2_scheme)):
             status_code=401, detail="Could not validate credentials"
         ) from e
     username = payload["sub"]
-    result = assets.delete_one({"symbol": asset_symbol})
+    result = await assets.delete_one({"symbol": asset_symbol})
+    price_cache.invalidate_asset(asset_symbol)
+    await valuation_snapshots.invalidate_symbols([asset_symbol])
+    await price_cache.bump_version()
+    live_valuations.publish_prices([asset_symbol])
     if result.deleted_count >= 1:
         return {"message": "Asset deleted"}
     raise HTTPException(status_code=500, detail="Something went wrong with the deletion")
 
 @app.get("/assets/", tags=["Assets Methods"])
-async def get_all_assets(token: str = Depends(oauth2_scheme)):
+async def get_all_assets(request: Request, response: Response, after:Union[str, None] = None, limit:Union[int, None] = None, stream: bool = False, fields:Union[str, None] = None, token: str = Depends(oauth2_scheme)):
     try:        
         payload = jwt.decode(token, secret_key, algorithms=["HS256"])
     except jwt.PyJWTError as e:
@@ -309,7 +541,87 @@ async def get_all_assets(token: str = Depends(oauth2_scheme)):
             status_code=401, detail="Could not validate credentials"
         ) from e
     username = payload["sub"]
-    return [Asset(**asset) for asset in assets.find()]
+    # The same for every user : a CDN can serve it when CDN_MAX_AGE is set
+    cache_control = shared_cache_control(CDN_MAX_AGE)
+    if etag_matches(request.headers.get("if-none-match"), etag := market_etag(request)):
+        return not_modified(etag, cache_control)
+    after = None if after is None else [after]
+    if projection := fields_projection(fields, ASSET_FIELDS, required=["symbol"]):
+        result = await list_documents(assets, ["symbol"], after, limit, stream, dict, response, projection=projection, fast=FAST_JSON)
+    else:
+        result = await list_models(assets, Asset, ["symbol"], after, limit, stream, response, fast=FAST_JSON)
+    return with_cache_headers(result, response, etag, cache_control)
+
+@app.post("/assets/prices", tags=["Assets Methods"], dependencies=[Depends(is_admin)])
+async def upload_asset_prices(request: Request, chunk_size: int = 1000, token: str = Depends(oauth2_scheme)):
+    # Body : NDJSON ({"symbol", "last_price", "currency"} per line) or CSV with a header line when the
+    # content type is text/csv. currency is optional and gives the currency of last_price when it is
+    # not the asset currency.
+    try:        
+        payload = jwt.decode(token, secret_key, algorithms=["HS256"])
+    except jwt.PyJWTError as e:
+        raise HTTPException(
+            status_code=401, detail="Could not validate credentials"
+        ) from e
+    username = payload["sub"]
+    updated_at = datetime.now(CH_timezone)
+    updated, row_errors = 0, []
+    async for chunk in chunked(parse_rows(request.stream(), request.headers.get("content-type")), max(chunk_size, 1)):
+        rows = []
+        for line, row, error in chunk:
+            if error is None:
+                try:
+                    rows.append((line, str(row["symbol"]), float(row["last_price"]), row.get("currency") or None))
+                    continue
+                except (KeyError, TypeError, ValueError) as e:
+                    error = f"Invalid row : {e!r}"
+            row_errors.append({"line": line, "error": error})
+        # A symbol uploaded twice in a chunk takes its last price, as it would across chunks
+        rows = latest_rows(rows, lambda row: row[1])
+        # One cache lookup per chunk for the asset currencies, FX rates come from the in-memory matrix
+        asset_data = await price_cache.get_assets({symbol for _, symbol, _, _ in rows})
+        rate_data = await price_cache.get_rates({
+            currency + asset_data[symbol]["currency"]
+            for _, symbol, _, currency in rows
+            if currency and symbol in asset_data and asset_data[symbol]["currency"] and currency != asset_data[symbol]["currency"]
+        })
+        operations, operation_lines, new_prices = [], [], []
+        for line, symbol, last_price, currency in rows:
+            if symbol not in asset_data:
+                row_errors.append({"line": line, "symbol": symbol, "error": "Asset not found"})
+                continue
+            asset_currency = asset_data[symbol]["currency"]
+            if currency and asset_currency and currency != asset_currency:
+                if (conv_rate := rate_data.get(currency + asset_currency)) is None:
+                    row_errors.append({"line": line, "symbol": symbol, "error": f"No exchange rate from {currency} to {asset_currency}"})
+                    continue
+                last_price *= conv_rate
+            operations.append(UpdateOne(
+                {"symbol": symbol},
+                {"$set": {"last_price": last_price, "last_updated_by": username, "last_updated_at": updated_at}}
+            ))
+            operation_lines.append(line)
+            new_prices.append((symbol, last_price))
+        if not operations:
+            continue
+        failed = set()
+        try:
+            await assets.bulk_write(operations, ordered=False)
+        except errors.BulkWriteError as exc:
+            chunk_errors = write_errors(exc, operation_lines)
+            failed = {error["line"] for error in chunk_errors}
+            row_errors.extend(chunk_errors)
+        chunk_prices = {}
+        for line, (symbol, last_price) in zip(operation_lines, new_prices):
+            if line not in failed:
+                updated += 1
+                price_cache.set_asset({"symbol": symbol, **asset_data[symbol], "last_price": last_price})
+                chunk_prices[symbol] = last_price
+        await valuation_snapshots.apply_prices(chunk_prices)
+        await price_history.record(chunk_prices.items(), updated_at)
+        await price_cache.bump_version()
+        live_valuations.publish_prices(chunk_prices)
+    return {"message": f"{updated} prices updated by {username}", "updated": updated, "errors": sorted(row_errors, key=lambda error: error["line"])}
 
 ####################################################################################################
 #                   Unique Rates interactions
@@ -323,12 +635,18 @@ async def create_rate(symbol:str, last_rate:Union[float, None] = None, token: st
             status_code=401, detail="Could not validate credentials"
         ) from e
     username = payload["sub"]
+    # Only the quoted pair is stored : the inverse and every cross rate are derived by the FX matrix
     exchangerate = ExchangeRate(symbol=symbol,base_currency=symbol[:3], target_currency=symbol[-3:], last_rate=last_rate,last_updated_by = username, created_by = username, last_updated_at = datetime.now(CH_timezone) , created_at = datetime.now(CH_timezone))
-    inverse_exchangerate = ExchangeRate(symbol=symbol[-3:]+symbol[:3],base_currency=symbol[-3:], target_currency=symbol[:3], last_rate=1/last_rate,last_updated_by = username, created_by = username, last_updated_at = datetime.now(CH_timezone) , created_at = datetime.now(CH_timezone))
     try:
-        rates.insert_one(exchangerate.dict())
-        rates.insert_one(inverse_exchangerate.dict())
-        return {"message": f"ExchangeRate  { symbol } and it's inverse pair created by { username }"}
+        await rates.insert_one(exchangerate.dict())
+        price_cache.set_rate(exchangerate.dict())
+        await rate_history.record([(symbol, last_rate)], exchangerate.created_at)
+        # A new pair can value positions left out so far, and move triangulated rates
+        await valuation_snapshots.invalidate_incomplete()
+        await valuation_snapshots.apply_rates([symbol])
+        await price_cache.bump_version()
+        live_valuations.publish_rates()
+        return {"message": f"ExchangeRate  { symbol } created by { username }"}
 
     except errors.DuplicateKeyError as exc:
         raise HTTPException(
@@ -344,7 +662,12 @@ async def read_rate(rate_symbol: str, token: str = Depends(oauth2_scheme)):
             status_code=401, detail="Could not validate credentials"
         ) from e
     username = payload["sub"]
-    return ExchangeRate(**rates.find_one({"symbol": rate_symbol}))
+    if (rate := await rates.find_one({"symbol": rate_symbol})) is not None:
+        return ExchangeRate(**rate)
+    # Not stored : inverse or cross rate
+    if (last_rate := (await price_cache.get_rates([rate_symbol])).get(rate_symbol)) is None:
+        raise HTTPException(status_code=404, detail="Rate not found")
+    return ExchangeRate(symbol=rate_symbol, base_currency=rate_symbol[:3], target_currency=rate_symbol[-3:], last_rate=last_rate)
 
 @app.put("/rate/{rate_symbol}", tags=["Rates Methods"], dependencies=[Depends(is_admin)])
 async def update_rate(rate_symbol, rate_details: str, token: str = Depends(oauth2_scheme)):
@@ -359,19 +682,28 @@ async def update_rate(rate_symbol, rate_details: str, token: str = Depends(oauth
         rate_details = json.loads(rate_details)
         rate_details["last_updated_by"] = str(username)
         rate_details["last_updated_at"] = datetime.now(CH_timezone)
-        if "last_rate" in rate_details.keys():
-            inv_rate_details = {"last_rate":1/float(rate_details["last_rate"])}
-            updated_inv_rate = rates.find_one_and_update(
-            {"symbol": rate_symbol[-3:]+rate_symbol[:3]},
-            {"$set": inv_rate_details},
-            return_document=ReturnDocument.AFTER
-            )
-        updated_rate = rates.find_one_and_update(
+        updated_rate = await rates.find_one_and_update(
             {"symbol": rate_symbol},
             {"$set": rate_details},
             return_document=ReturnDocument.AFTER
         )
-        return {"message": "Rates updated", "updated_rate" : ExchangeRate(**updated_rate), "inverse_rate_updated": ExchangeRate(**updated_inv_rate)}
+        if updated_rate is None:
+            raise HTTPException(status_code=404, detail="Rate not found")
+        price_cache.set_rate(updated_rate)
+        inverse_symbol = rate_symbol[-3:]+rate_symbol[:3]
+        if "last_rate" in rate_details.keys():
+            # Only the quoted pair has a history : the inverse is derived from it
+            await rate_history.record([(rate_symbol, updated_rate["last_rate"])], rate_details["last_updated_at"])
+            # Inverse pairs stored by older versions of the API are kept in sync
+            inv_rate_details = {"last_rate":1/float(rate_details["last_rate"]), "last_updated_by": rate_details["last_updated_by"], "last_updated_at": rate_details["last_updated_at"]}
+            result = await rates.update_one({"symbol": inverse_symbol}, {"$set": inv_rate_details})
+            if result.matched_count:
+                price_cache.set_rate({"symbol": inverse_symbol, **inv_rate_details})
+        await valuation_snapshots.apply_rates([rate_symbol, inverse_symbol])
+        await price_cache.bump_version()
+        live_valuations.publish_rates()
+        inverse_rate = ExchangeRate(symbol=inverse_symbol, base_currency=inverse_symbol[:3], target_currency=inverse_symbol[-3:], last_rate=price_cache.fx.rate(inverse_symbol[:3], inverse_symbol[-3:]))
+        return {"message": "Rates updated", "updated_rate" : ExchangeRate(**updated_rate), "inverse_rate_updated": inverse_rate}
     except PyMongoError as e:
         raise HTTPException(status_code=400, detail=str(e)) from e
     
@@ -384,13 +716,32 @@ async def delete_rate(rate_symbol: str, token: str = Depends(oauth2_scheme)):
             status_code=401, detail="Could not validate credentials"
         ) from e
     username = payload["sub"]
-    result = rates.delete_one({"symbol": rate_symbol})
+    # Also drop an inverse pair stored by older versions, it would keep deriving the rate
+    inverse_symbol = rate_symbol[-3:]+rate_symbol[:3]
+    result = await rates.delete_many({"symbol": {"$in": [rate_symbol, inverse_symbol]}})
+    price_cache.invalidate_rate(rate_symbol)
+    price_cache.invalidate_rate(inverse_symbol)
+    await valuation_snapshots.apply_rates([rate_symbol, inverse_symbol])
+    await price_cache.bump_version()
+    live_valuations.publish_rates()
     if result.deleted_count >= 1:
         return {"message": "Rate deleted"}
     raise HTTPException(status_code=500, detail="Something went wrong with the deletion")
 
 @app.get("/rates/", tags=["Rates Methods"])
-async def get_all_rates(token: str = Depends(oauth2_scheme)):
+async def get_all_rates(response: Response, after:Union[str, None] = None, limit:Union[int, None] = None, stream: bool = False, token: str = Depends(oauth2_scheme)):
+    try:        
+        payload = jwt.decode(token, secret_key, algorithms=["HS256"])
+    except jwt.PyJWTError as e:
+        raise HTTPException(
+            status_code=401, detail="Could not validate credentials"
+        ) from e
+    username = payload["sub"]
+    after = None if after is None else [after]
+    return await list_models(rates, ExchangeRate, ["symbol"], after, limit, stream, response, fast=FAST_JSON)
+
+@app.put("/rates/", tags=["Rates Methods"], dependencies=[Depends(is_admin)])
+async def upsert_rates(fixing: ExchangeRateFixing, token: str = Depends(oauth2_scheme)):
     try:        
         payload = jwt.decode(token, secret_key, algorithms=["HS256"])
     except jwt.PyJWTError as e:
@@ -398,7 +749,35 @@ async def get_all_rates(token: str = Depends(oauth2_scheme)):
             status_code=401, detail="Could not validate credentials"
         ) from e
     username = payload["sub"]
-    return [ExchangeRate(**rate) for rate in rates.find()]
+    if not fixing.rates:
+        raise HTTPException(status_code=400, detail="No rates")
+    if invalid := invalid_pairs(fixing.rates):
+        raise HTTPException(status_code=400, detail=f"Invalid rates : {invalid}")
+    # The whole fixing shares one timestamp and goes to Mongo in a single bulk_write
+    updated_at = datetime.now(CH_timezone)
+    try:
+        result = await rates.bulk_write(fixing_operations(fixing.rates, username, updated_at), ordered=False)
+    except errors.BulkWriteError as e:
+        # Part of the fixing may have been written : let the next valuation reload the rates,
+        # and value again the portfolios holding one of its currencies
+        price_cache.clear()
+        await valuation_snapshots.invalidate_currencies({currency for pair in fixing.rates for currency in (pair[:3], pair[-3:])})
+        await price_cache.bump_version()
+        live_valuations.publish_rates()
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    apply_fixing(price_cache, fixing.rates)
+    await rate_history.record(fixing.rates.items(), updated_at)
+    if result.upserted_count:
+        await valuation_snapshots.invalidate_incomplete()
+    await valuation_snapshots.apply_rates(fixing.rates)
+    await price_cache.bump_version()
+    live_valuations.publish_rates()
+    return {
+        "message": f"{len(fixing.rates)} rates updated by {username}",
+        "created": result.upserted_count,
+        "updated": len(fixing.rates) - result.upserted_count,
+        "last_updated_at": updated_at,
+    }
 
 
 ####################################################################################################
@@ -422,16 +801,20 @@ async def create_portfolio(name:str, portfolio: PortfolioRequest,  token: str =
     while len(portfolio.assets_symbols)> len(portfolio.cost_prices): 
         portfolio.cost_prices.append(0)  
 
-    #Creation of the portfolio content
+    #Creation of the portfolio content : every symbol resolved at once
+    asset_ids, unknown = await price_cache.resolve_symbols(portfolio.assets_symbols)
+    if unknown:
+        raise assets_not_found(unknown)
     portfolio_content= []
     for (index, symb) in enumerate(portfolio.assets_symbols) : 
-        symb_id = assets.find_one({"symbol": symb})["_id"]
-        portfolio_content.append({"asset_id":ObjectId(symb_id),"symbol":symb,"qty":portfolio.shares[index], "cost_prices":portfolio.cost_prices[index]})
+        portfolio_content.append({"asset_id":ObjectId(asset_ids[symb]),"symbol":symb,"qty":portfolio.shares[index], "cost_prices":portfolio.cost_prices[index]})
 
     portfolio = Portfolio(name=name, portfolio_content = portfolio_content, owner = username,portfolio_currency = portfolio.portfolio_currency,  created_at = datetime.now(CH_timezone))
 
     try:
-        portfolios.insert_one(portfolio.dict())
+        await portfolios.insert_one({**portfolio.dict(), "trades_since_snapshot": 0})
+        # Starting point of the trade ledger
+        await trade_ledger.snapshot(username, name, portfolio_content, portfolio.created_at)
         return {"message": f"Portfolio { name } created by { username }"}
 
     except errors.DuplicateKeyError as exc:
@@ -440,8 +823,99 @@ async def create_portfolio(name:str, portfolio: PortfolioRequest,  token: str =
             detail="The portfolio already exist in the collection.",
         ) from exc
 
+####################################################################################################
+#                   Portfolio analytics
+#               Read from the valuation snapshots, built in process against the price cache, or computed in Mongo
+####################################################################################################
+async def compute_portfolio_analytics(portfolio_name: str, owner: str, facets=PORTFOLIO_FACETS, portfolio=None):
+    if not USE_PRICE_CACHE:
+        # Prices joined in Mongo, FX rates from the matrix : only the quoted pairs are stored
+        if portfolio is None:
+            portfolio = await portfolios.find_one({"name": portfolio_name, "owner": owner}, {"_id": 0, "portfolio_currency": 1})
+        if portfolio is None:
+            raise HTTPException(status_code=404, detail="Portfolio not found")
+        rates = await price_cache.rates_into(portfolio.get("portfolio_currency") or "")
+        result = await portfolios.aggregate(portfolio_analytics_pipeline(portfolio_name, owner, rates, facets)).next()
+        if "total" in result:
+            if not result["total"]:
+                raise HTTPException(status_code=404, detail="Portfolio not found")
+            result["total"] = result["total"][0]
+        return result
+    return valuation_snapshots.analytics(await portfolio_snapshot(portfolio_name, owner), facets)
+
+async def portfolio_snapshot(portfolio_name: str, owner: str):
+    if (snapshot := await valuation_snapshots.get(owner, portfolio_name)) is None:
+        portfolio = await portfolios.find_one(
+            {"name": portfolio_name, "owner": owner},
+            {"_id": 0, "name": 1, "owner": 1, "portfolio_currency": 1, "portfolio_content": 1, "last_updated_at": 1}
+        )
+        if portfolio is None:
+            raise HTTPException(status_code=404, detail="Portfolio not found")
+        snapshot = await valuation_snapshots.rebuild(portfolio)
+    return snapshot
+
+async def live_valuation(owner: str, portfolio_name: str, facets):
+    # Message of the live streams, with the symbols and currency pairs it depends on
+    try:
+        snapshot = await portfolio_snapshot(portfolio_name, owner)
+    except HTTPException:
+        return None
+    return analytics_response(valuation_snapshots.analytics(snapshot, facets)), snapshot["symbols"], snapshot["currency_pairs"]
+
+# Portfolios followed on /portfolio/{name}/stream : each one valued once per tick, whatever the number of subscribers.
+# Writes of this worker are published by the handlers, those of the other workers come from the price cache change stream.
+live_valuations = ValuationHub(live_valuation, market_version=price_cache.etag_version, changes_followed=shared_prices is None)
+price_cache.listeners.append(live_valuations.market_changed)
+
+async def compute_value_series(portfolio_name: str, owner: str, points, portfolio=None):
+    # Positions held at each point, rebuilt from the trade ledger, valued with the prices and FX rates of the history.
+    # Portfolios without ledger history are valued with their current positions.
+    if portfolio is None:
+        portfolio = await portfolios.find_one(
+            {"name": portfolio_name, "owner": owner},
+            {"_id": 0, "name": 1, "owner": 1, "portfolio_currency": 1, "portfolio_content": 1}
+        )
+    if portfolio is None:
+        raise HTTPException(status_code=404, detail="Portfolio not found")
+    holdings = await trade_ledger.positions_series(owner, portfolio_name, points)
+    held = holdings or [portfolio.get("portfolio_content", [])]
+    asset_data = await price_cache.get_assets({position["symbol"] for positions in held for position in positions})
+    currency = portfolio.get("portfolio_currency")
+    pairs = {asset["currency"] + currency for asset in asset_data.values() if asset["currency"] and currency}
+    base = price_cache.fx.base
+    prices, quotes = await asyncio.gather(
+        price_history.at(asset_data, points),
+        rate_history.at(history_pairs(pairs, base), points),
+    )
+    return portfolio, value_series(portfolio, asset_data, prices, derive_rates(pairs, quotes, len(points), base), len(points), holdings)
+
+def analytics_response(analytics):
+    # Totals at the top level, followed by the breakdowns that were computed
+    response = dict(analytics.get("total", {}))
+    response.update({facet: figures for facet, figures in analytics.items() if facet != "total"})
+    return response
+
+def json_response(content):
+    # With FAST_JSON, returned as a response : FastAPI does not encode it again
+    return FastJSONResponse(content) if FAST_JSON else content
+
+def ndjson_line(content):
+    return dumps(content) + b"\n" if FAST_JSON else json.dumps(content) + "\n"
+
+@app.get("/portfolio/{portfolio_name}/analytics", tags=["Portfolio Methods"])
+async def get_portfolio_analytics(portfolio_name:str, owner:Union[str, None] = None, token: str = Depends(oauth2_scheme)):
+    try:        
+        payload = jwt.decode(token, secret_key, algorithms=["HS256"])
+    except jwt.PyJWTError as e:
+        raise HTTPException(
+            status_code=401, detail="Could not validate credentials"
+        ) from e
+    username = payload["sub"]
+    owner = owner or username
+    return json_response(analytics_response(await compute_portfolio_analytics(portfolio_name, owner)))
+
 @app.get("/portfolio/{portfolio_name}/value", tags=["Portfolio Methods"])
-async def get_portfolio_value(portfolio_name:str, owner:Union[str, None] = None, token: str = Depends(oauth2_scheme)):
+async def get_portfolio_value(request: Request, response: Response, portfolio_name:str, owner:Union[str, None] = None, as_of:Union[datetime, None] = None, token: str = Depends(oauth2_scheme)):
     try:        
         payload = jwt.decode(token, secret_key, algorithms=["HS256"])
     except jwt.PyJWTError as e:
@@ -450,65 +924,54 @@ async def get_portfolio_value(portfolio_name:str, owner:Union[str, None] = None,
         ) from e
     username = payload["sub"]
     owner = owner or username
-    result = portfolios.aggregate([
-        {
-            '$match': {
-                'name': portfolio_name,
-                'owner' : owner
-            }
-        }, {
-            '$unwind': '$portfolio_content'
-        }, {
-            '$lookup': {
-                'from': 'assets', 
-                'localField': 'portfolio_content.symbol', 
-                'foreignField': 'symbol', 
-                'as': 'asset'
-            }
-        }, {
-            '$unwind': '$asset'
-        }, {
-            '$addFields': {
-                'asset.exch_rate': {
-                    '$concat': [
-                        '$asset.currency', '$portfolio_currency'
-                    ]
-                }
-            }
-        }, {
-            '$lookup': {
-                'from': 'FX_rates', 
-                'localField': 'asset.exch_rate', 
-                'foreignField': 'symbol', 
-                'as': 'asset.asset_rate'
-            }
-        }, {
-            '$unwind': '$asset.asset_rate'
-        }, {
-            '$group': {
-                '_id': 0, 
-                'name': {
-                    '$first': '$name'
-                }, 
-                'owner': {
-                    '$first': '$owner'
-                }, 
-                'converted_price': {
-                    '$sum': {
-                        '$multiply': [
-                            '$asset.last_price', '$asset.asset_rate.last_rate', '$portfolio_content.qty'
-                        ]
-                    }
-                }, 
-                'currency': {
-                    '$first': '$portfolio_currency'
-                }
-            }
-        }, {
-            '$unset': '_id'
-        }
-    ])
-    return result.next()
+    # Unchanged portfolio and market : 304 without valuing anything. The ETag comes from the document
+    # the value is computed from, no other read
+    if as_of is None and USE_PRICE_CACHE:
+        snapshot = await portfolio_snapshot(portfolio_name, owner)
+        if etag_matches(request.headers.get("if-none-match"), etag := snapshot_etag(request, snapshot)):
+            return not_modified(etag, PRIVATE_CACHE_CONTROL)
+        total = valuation_snapshots.analytics(snapshot, ["total"])["total"]
+    else:
+        portfolio = await portfolios.find_one(
+            {"name": portfolio_name, "owner": owner},
+            {"_id": 0, "name": 1, "portfolio_currency": 1, "portfolio_content": 1, **ETAG_FIELDS}
+        )
+        if portfolio is None:
+            raise HTTPException(status_code=404, detail="Portfolio not found")
+        if etag_matches(request.headers.get("if-none-match"), etag := portfolio_etag(request, portfolio)):
+            return not_modified(etag, PRIVATE_CACHE_CONTROL)
+        if as_of is not None:
+            portfolio, (converted_price, _) = await compute_value_series(portfolio_name, owner, time_points(as_of, as_of, timedelta(days=1)), portfolio)
+            result = {"name": portfolio["name"], "owner": portfolio["owner"], "converted_price": float(converted_price[0]), "currency": portfolio["portfolio_currency"], "as_of": as_of}
+            return with_cache_headers(json_response(result), response, etag, PRIVATE_CACHE_CONTROL)
+        total = (await compute_portfolio_analytics(portfolio_name, owner, ["total"], portfolio))["total"]
+    result = {"name": total["name"], "owner": total["owner"], "converted_price": total["converted_price"], "currency": total["currency"]}
+    return with_cache_headers(json_response(result), response, etag, PRIVATE_CACHE_CONTROL)
+
+@app.get("/portfolio/{portfolio_name}/history", tags=["Portfolio Methods"])
+async def get_portfolio_history(portfolio_name:str, start: datetime = Query(alias="from"), end:Union[datetime, None] = Query(default=None, alias="to"), step: str = "1d", owner:Union[str, None] = None, token: str = Depends(oauth2_scheme)):
+    try:        
+        payload = jwt.decode(token, secret_key, algorithms=["HS256"])
+    except jwt.PyJWTError as e:
+        raise HTTPException(
+            status_code=401, detail="Could not validate credentials"
+        ) from e
+    username = payload["sub"]
+    owner = owner or username
+    try:
+        points = time_points(start, end or datetime.now(timezone.utc), parse_step(step))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    portfolio, (converted_price, converted_cost_price) = await compute_value_series(portfolio_name, owner, points)
+    return json_response({
+        "name": portfolio["name"],
+        "owner": portfolio["owner"],
+        "currency": portfolio["portfolio_currency"],
+        "points": [
+            {"ts": point.replace(tzinfo=timezone.utc), "converted_price": price, "converted_cost_price": cost, "return": return_ratio(price, cost)}
+            for point, price, cost in zip(points, converted_price.tolist(), converted_cost_price.tolist())
+        ],
+    })
 
 @app.get("/portfolio/{portfolio_name}/cost", tags=["Portfolio Methods"])
 async def get_portfolio_cost(portfolio_name:str, owner:Union[str, None] = None, token: str = Depends(oauth2_scheme)):
@@ -520,65 +983,8 @@ async def get_portfolio_cost(portfolio_name:str, owner:Union[str, None] = None,
         ) from e
     username = payload["sub"]
     owner = owner or username
-    result = portfolios.aggregate([
-        {
-            '$match': {
-                'name': portfolio_name,
-                'owner': owner
-            }
-        }, {
-            '$unwind': '$portfolio_content'
-        }, {
-            '$lookup': {
-                'from': 'assets', 
-                'localField': 'portfolio_content.symbol', 
-                'foreignField': 'symbol', 
-                'as': 'asset'
-            }
-        }, {
-            '$unwind': '$asset'
-        }, {
-            '$addFields': {
-                'asset.exch_rate': {
-                    '$concat': [
-                        '$asset.currency', '$portfolio_currency'
-                    ]
-                }
-            }
-        }, {
-            '$lookup': {
-                'from': 'FX_rates', 
-                'localField': 'asset.exch_rate', 
-                'foreignField': 'symbol', 
-                'as': 'asset.asset_rate'
-            }
-        }, {
-            '$unwind': '$asset.asset_rate'
-        }, {
-            '$group': {
-                '_id': 0, 
-                'name': {
-                    '$first': '$name'
-                }, 
-                'owner': {
-                    '$first': '$owner'
-                }, 
-                'converted_cost_price': {
-                    '$sum': {
-                        '$multiply': [
-                            '$portfolio_content.cost_prices', '$asset.asset_rate.last_rate', '$portfolio_content.qty'
-                        ]
-                    }
-                }, 
-                'currency': {
-                    '$first': '$portfolio_currency'
-                }
-            }
-        }, {
-            '$unset': '_id'
-        }
-    ])
-    return result.next()
+    total = (await compute_portfolio_analytics(portfolio_name, owner, ["total"]))["total"]
+    return json_response({"name": total["name"], "owner": total["owner"], "converted_cost_price": total["converted_cost_price"], "currency": total["currency"]})
 
 @app.get("/portfolio/{portfolio_name}/total_return", tags=["Portfolio Methods"])
 async def get_portfolio_total_return(portfolio_name:str, owner:Union[str, None] = None, token: str = Depends(oauth2_scheme)):
@@ -590,88 +996,7 @@ async def get_portfolio_total_return(portfolio_name:str, owner:Union[str, None]
         ) from e
     username = payload["sub"]
     owner = owner or username
-    result = portfolios.aggregate([
-        {
-            '$match': {
-                'name': portfolio_name,
-                'owner': owner            }
-        }, {
-            '$unwind': '$portfolio_content'
-        }, {
-            '$lookup': {
-                'from': 'assets', 
-                'localField': 'portfolio_content.symbol', 
-                'foreignField': 'symbol', 
-                'as': 'asset'
-            }
-        }, {
-            '$unwind': '$asset'
-        }, {
-            '$addFields': {
-                'asset.exch_rate': {
-                    '$concat': [
-                        '$asset.currency', '$portfolio_currency'
-                    ]
-                }
-            }
-        }, {
-            '$lookup': {
-                'from': 'FX_rates', 
-                'localField': 'asset.exch_rate', 
-                'foreignField': 'symbol', 
-                'as': 'asset.asset_rate'
-            }
-        }, {
-            '$unwind': '$asset.asset_rate'
-        }, {
-            '$group': {
-                '_id': 0, 
-                'name': {
-                    '$first': '$name'
-                }, 
-                'owner': {
-                    '$first': '$owner'
-                }, 
-                'converted_price': {
-                    '$sum': {
-                        '$multiply': [
-                            '$asset.last_price', '$asset.asset_rate.last_rate', '$portfolio_content.qty'
-                        ]
-                    }
-                }, 
-                'converted_cost_price': {
-                    '$sum': {
-                        '$multiply': [
-                            '$portfolio_content.cost_prices', '$asset.asset_rate.last_rate', '$portfolio_content.qty'
-                        ]
-                    }
-                }, 
-                'currency': {
-                    '$first': '$portfolio_currency'
-                }
-            }
-        }, {
-            '$project': {
-                'name': '$name', 
-                'owner': '$owner', 
-                'converted_price': '$converted_price', 
-                'converted_cost_price': '$converted_cost_price', 
-                'return': {
-                    '$divide': [
-                        {
-                            '$subtract': [
-                                '$converted_price', '$converted_cost_price'
-                            ]
-                        }, '$converted_cost_price'
-                    ]
-                }, 
-                'currency': '$currency'
-            }
-        }, {
-            '$unset': '_id'
-        }
-    ])
-    return result.next()
+    return json_response((await compute_portfolio_analytics(portfolio_name, owner, ["total"]))["total"])
 
 @app.get("/portfolio/{portfolio_name}/return_by_asset_class", tags=["Portfolio Methods"])
 async def get_portfolio_return_by_asset_class(portfolio_name:str, owner:Union[str, None] = None, token: str = Depends(oauth2_scheme)):
@@ -683,90 +1008,7 @@ async def get_portfolio_return_by_asset_class(portfolio_name:str, owner:Union[st
         ) from e
     username = payload["sub"]
     owner = owner or username
-    result = portfolios.aggregate([
-        {
-            '$match': {
-                'name': portfolio_name, 
-                'owner': owner
-            }
-        }, {
-            '$unwind': '$portfolio_content'
-        }, {
-            '$lookup': {
-                'from': 'assets', 
-                'localField': 'portfolio_content.symbol', 
-                'foreignField': 'symbol', 
-                'as': 'asset'
-            }
-        }, {
-            '$unwind': '$asset'
-        }, {
-            '$addFields': {
-                'asset.exch_rate': {
-                    '$concat': [
-                        '$asset.currency', '$portfolio_currency'
-                    ]
-                }
-            }
-        }, {
-            '$lookup': {
-                'from': 'FX_rates', 
-                'localField': 'asset.exch_rate', 
-                'foreignField': 'symbol', 
-                'as': 'asset.asset_rate'
-            }
-        }, {
-            '$unwind': '$asset.asset_rate'
-        }, {
-            '$group': {
-                '_id': '$asset.asset_class', 
-                'name': {
-                    '$first': '$name'
-                }, 
-                'owner': {
-                    '$first': '$owner'
-                }, 
-                'converted_price': {
-                    '$sum': {
-                        '$multiply': [
-                            '$asset.last_price', '$asset.asset_rate.last_rate', '$portfolio_content.qty'
-                        ]
-                    }
-                }, 
-                'converted_cost_price': {
-                    '$sum': {
-                        '$multiply': [
-                            '$portfolio_content.cost_prices', '$asset.asset_rate.last_rate', '$portfolio_content.qty'
-                        ]
-                    }
-                }, 
-                'currency': {
-                    '$first': '$portfolio_currency'
-                }
-            }
-        }, {
-            '$project': {
-                'asset_class': '$_id', 
-                'name': '$name', 
-                'owner': '$owner', 
-                'converted_price': '$converted_price', 
-                'converted_cost_price': '$converted_cost_price', 
-                'return': {
-                    '$divide': [
-                        {
-                            '$subtract': [
-                                '$converted_price', '$converted_cost_price'
-                            ]
-                        }, '$converted_cost_price'
-                    ]
-                }, 
-                'currency': '$currency'
-            }
-        }, {
-            '$unset': '_id'
-        }
-    ])
-    return list(result)
+    return json_response((await compute_portfolio_analytics(portfolio_name, owner, ["by_asset_class"]))["by_asset_class"])
 
 @app.get("/portfolio/{portfolio_name}/return_by_geo_zone", tags=["Portfolio Methods"])
 async def get_portfolio_return_by_geo_zone(portfolio_name:str, owner:Union[str, None] = None, token: str = Depends(oauth2_scheme)):
@@ -778,90 +1020,7 @@ async def get_portfolio_return_by_geo_zone(portfolio_name:str, owner:Union[str,
         ) from e
     username = payload["sub"]
     owner = owner or username
-    result = portfolios.aggregate([
-        {
-            '$match': {
-                    'name': portfolio_name, 
-                    'owner': owner
-                }
-        }, {
-            '$unwind': '$portfolio_content'
-        }, {
-            '$lookup': {
-                'from': 'assets', 
-                'localField': 'portfolio_content.symbol', 
-                'foreignField': 'symbol', 
-                'as': 'asset'
-            }
-        }, {
-            '$unwind': '$asset'
-        }, {
-            '$addFields': {
-                'asset.exch_rate': {
-                    '$concat': [
-                        '$asset.currency', '$portfolio_currency'
-                    ]
-                }
-            }
-        }, {
-            '$lookup': {
-                'from': 'FX_rates', 
-                'localField': 'asset.exch_rate', 
-                'foreignField': 'symbol', 
-                'as': 'asset.asset_rate'
-            }
-        }, {
-            '$unwind': '$asset.asset_rate'
-        }, {
-            '$group': {
-                '_id': '$asset.geo_zone', 
-                'name': {
-                    '$first': '$name'
-                }, 
-                'owner': {
-                    '$first': '$owner'
-                }, 
-                'converted_price': {
-                    '$sum': {
-                        '$multiply': [
-                            '$asset.last_price', '$asset.asset_rate.last_rate', '$portfolio_content.qty'
-                        ]
-                    }
-                }, 
-                'converted_cost_price': {
-                    '$sum': {
-                        '$multiply': [
-                            '$portfolio_content.cost_prices', '$asset.asset_rate.last_rate', '$portfolio_content.qty'
-                        ]
-                    }
-                }, 
-                'currency': {
-                    '$first': '$portfolio_currency'
-                }
-            }
-        }, {
-            '$project': {
-                'asset_class': '$_id', 
-                'name': '$name', 
-                'owner': '$owner', 
-                'converted_price': '$converted_price', 
-                'converted_cost_price': '$converted_cost_price', 
-                'return': {
-                    '$divide': [
-                        {
-                            '$subtract': [
-                                '$converted_price', '$converted_cost_price'
-                            ]
-                        }, '$converted_cost_price'
-                    ]
-                }, 
-                'currency': '$currency'
-            }
-        }, {
-            '$unset': '_id'
-        }
-    ])
-    return list(result)
+    return json_response((await compute_portfolio_analytics(portfolio_name, owner, ["by_geo_zone"]))["by_geo_zone"])
 
 @app.get("/portfolio/{portfolio_name}/return_by_asset", tags=["Portfolio Methods"])
 async def get_portfolio_return_by_asset(portfolio_name:str, owner:Union[str, None] = None, token: str = Depends(oauth2_scheme)):
@@ -873,87 +1032,106 @@ async def get_portfolio_return_by_asset(portfolio_name:str, owner:Union[str, Non
         ) from e
     username = payload["sub"]
     owner = owner or username
-    result = portfolios.aggregate([
-        {
-            '$match': {
-                    'name': portfolio_name, 
-                    'owner': owner
-                }
-        }, {
-            '$unwind': '$portfolio_content'
-        }, {
-            '$lookup': {
-                'from': 'assets', 
-                'localField': 'portfolio_content.symbol', 
-                'foreignField': 'symbol', 
-                'as': 'asset'
-            }
-        }, {
-            '$unwind': '$asset'
-        }, {
-            '$addFields': {
-                'asset.exch_rate': {
-                    '$concat': [
-                        '$asset.currency', '$portfolio_currency'
-                    ]
-                }
-            }
-        }, {
-            '$lookup': {
-                'from': 'FX_rates', 
-                'localField': 'asset.exch_rate', 
-                'foreignField': 'symbol', 
-                'as': 'asset.asset_rate'
-            }
-        }, {
-            '$unwind': '$asset.asset_rate'
-        }, {
-            '$project': {
-                'name': '$name', 
-                'owner': '$owner', 
-                'asset': '$asset.symbol', 
-                'converted_price': {
-                    '$sum': {
-                        '$multiply': [
-                            '$asset.last_price', '$asset.asset_rate.last_rate', '$portfolio_content.qty'
-                        ]
-                    }
-                }, 
-                'converted_cost_price': {
-                    '$sum': {
-                        '$multiply': [
-                            '$portfolio_content.cost_prices', '$asset.asset_rate.last_rate', '$portfolio_content.qty'
-                        ]
-                    }
-                }, 
-                'currency': '$portfolio_currency'
-            }
-        }, {
-            '$project': {
-                'name': '$name', 
-                'owner': '$owner', 
-                'asset': '$asset', 
-                'converted_price': '$converted_price', 
-                'converted_cost_price': '$converted_cost_price', 
-                'return': {
-                    '$divide': [
-                        {
-                            '$subtract': [
-                                '$converted_price', '$converted_cost_price'
-                            ]
-                        }, '$converted_cost_price'
-                    ]
-                }, 
-                'currency': '$currency'
-            }
-        }, {
-            '$unset': '_id'
-        }
-    ])
-    return list(result)
+    return json_response((await compute_portfolio_analytics(portfolio_name, owner, ["by_asset"]))["by_asset"])
+
+@app.get("/portfolio/{portfolio_name}/stream", tags=["Portfolio Methods"])
+async def stream_portfolio_valuation(portfolio_name:str, owner:Union[str, None] = None, facets: str = "total,by_asset_class,by_geo_zone", interval: float = 1, token: str = Depends(oauth2_scheme)):
+    # Server-Sent Events : the valuation on connection, then again whenever a price, a rate or a trade changes it,
+    # at most once every interval seconds
+    try:        
+        payload = jwt.decode(token, secret_key, algorithms=["HS256"])
+    except jwt.PyJWTError as e:
+        raise HTTPException(
+            status_code=401, detail="Could not validate credentials"
+        ) from e
+    username = payload["sub"]
+    owner = owner or username
+    facets = facets.split(",")
+    if unknown_facets := set(facets) - set(PORTFOLIO_FACETS):
+        raise HTTPException(status_code=400, detail=f"Unknown facets : {sorted(unknown_facets)}")
+    if not USE_PRICE_CACHE:
+        raise HTTPException(status_code=400, detail="Live valuations need the price cache")
+    key = (owner, portfolio_name, tuple(facet for facet in PORTFOLIO_FACETS if facet in facets))
+    mailbox = await live_valuations.subscribe(key)
+    if mailbox.message is NOT_FOUND:
+        raise HTTPException(status_code=404, detail="Portfolio not found")
+
+    async def events():
+        try:
+            while True:
+                if (message := await mailbox.get(KEEP_ALIVE_EVERY)) is None:
+                    yield KEEP_ALIVE
+                    continue
+                yield message
+                if message is NOT_FOUND:
+                    return
+                # The values published meanwhile collapse into the latest one
+                await asyncio.sleep(max(interval, 0))
+        finally:
+            live_valuations.unsubscribe(key, mailbox)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.post("/portfolios/value", tags=["Portfolio Methods"])
+async def value_portfolios(request: PortfolioValuationRequest, batch_size: int = 500, token: str = Depends(oauth2_scheme)):
+    try:        
+        payload = jwt.decode(token, secret_key, algorithms=["HS256"])
+    except jwt.PyJWTError as e:
+        raise HTTPException(
+            status_code=401, detail="Could not validate credentials"
+        ) from e
+    username = payload["sub"]
+    if unknown_facets := set(request.facets) - set(PORTFOLIO_FACETS):
+        raise HTTPException(status_code=400, detail=f"Unknown facets : {sorted(unknown_facets)}")
+    batch_size = max(batch_size, 1)
+    # Selection : explicit (owner, name) pairs, every portfolio of an owner, or everything for admins
+    requested = {(reference.owner or username, reference.name) for reference in request.portfolios}
+    if request.all_portfolios:
+        if "admin" not in await get_user_roles(token):
+            raise HTTPException(status_code=403, detail="Admin permissions required")
+        query = {}
+    elif request.owner:
+        query = {"owner": request.owner}
+    elif requested:
+        names_by_owner = {}
+        for owner, name in requested:
+            names_by_owner.setdefault(owner, []).append(name)
+        query = {"$or": [{"owner": owner, "name": {"$in": names}} for owner, names in names_by_owner.items()]}
+    else:
+        raise HTTPException(status_code=400, detail="No portfolio selected")
+
+    async def valuations():
+        # One query for all the portfolios, valued batch by batch and streamed as NDJSON lines
+        found = set()
+        cursor = portfolios.find(
+            query,
+            {"_id": 0, "name": 1, "owner": 1, "portfolio_currency": 1, "portfolio_content": 1},
+            batch_size=batch_size
+        )
+        batch = []
+        async for portfolio in cursor:
+            batch.append(portfolio)
+            if len(batch) >= batch_size:
+                async for line in value_batch(batch, request.facets, found):
+                    yield line
+                batch = []
+        async for line in value_batch(batch, request.facets, found):
+            yield line
+        for owner, name in sorted(requested - found):
+            yield ndjson_line({"name": name, "owner": owner, "error": "Portfolio not found"})
+
+    return StreamingResponse(valuations(), media_type="application/x-ndjson")
+
+async def value_batch(batch, facets, found):
+    if not batch:
+        return
+    asset_data, rate_data = await price_cache.get_market_data(batch)
+    for portfolio in batch:
+        found.add((portfolio["owner"], portfolio["name"]))
+        yield ndjson_line(analytics_response(analyze_portfolio(portfolio, asset_data, rate_data, facets)))
 
 @app.get("/portfolio/{portfolio_name}/assets", tags=["Portfolio Methods"])
-async def get_portfolio_assets(portfolio_name:str, token: str = Depends(oauth2_scheme)):
+async def get_portfolio_assets(request: Request, response: Response, portfolio_name:str, token: str = Depends(oauth2_scheme)):
     try:        
         payload = jwt.decode(token, secret_key, algorithms=["HS256"])
     except jwt.PyJWTError as e:
@@ -961,6 +1139,9 @@ async def get_portfolio_assets(portfolio_name:str, token: str = Depends(oauth2_s
             status_code=401, detail="Could not validate credentials"
         ) from e
     username = payload["sub"]
+    # Unchanged portfolio and market : 304 without running the $lookup
+    if etag_matches(request.headers.get("if-none-match"), etag := await revalidated_portfolio_etag(request, {"name": portfolio_name})):
+        return not_modified(etag, PRIVATE_CACHE_CONTROL)
     result = portfolios.aggregate([
     {
         '$match': {
@@ -1010,32 +1191,93 @@ async def get_portfolio_assets(portfolio_name:str, token: str = Depends(oauth2_s
             '_id': 0, 
             'owner': 1, 
             'name': 1, 
-            'assets': 1
+            'assets': 1,
+            'last_updated_at': 1,
+            'trades_since_snapshot': 1
         }
     }
 ])
-    return result.next()
+    portfolio = await result.next()
+    # First request : the ETag from the document just read
+    etag = etag or portfolio_etag(request, portfolio)
+    portfolio.pop("last_updated_at", None)
+    portfolio.pop("trades_since_snapshot", None)
+    return with_cache_headers(json_response(portfolio), response, etag, PRIVATE_CACHE_CONTROL)
 
 @app.get("/portfolio/{username}", tags=["Portfolio Methods"])
-async def get_user_portfolios(username:Union[str, None] = None, token: str = Depends(oauth2_scheme)):
+async def get_user_portfolios(username:Union[str, None] = None, fields:Union[str, None] = None, token: str = Depends(oauth2_scheme)):
     try:        
-        payload = jwt.decode(token, "secret", algorithms=["HS256"])
+        payload = jwt.decode(token, secret_key, algorithms=["HS256"])
     except jwt.PyJWTError as e:
         raise HTTPException(
             status_code=401, detail="Could not validate credentials"
         ) from e
     if username is None :     
         username = payload["sub"]
-    result_mdb = portfolios.find({
-        'owner': username
-    })
-    users_portfolios = []
-    for res in  result_mdb : 
-        res.pop("_id",None)
-        for d in res["portfolio_content"]:
-            d.pop("asset_id",None)
-        users_portfolios.append(res)
-    return users_portfolios
+    projection = fields_projection(fields or ",".join(PORTFOLIO_FIELDS), PORTFOLIO_FIELDS, PORTFOLIO_CONTENT_FIELDS)
+    return json_response(await portfolios.find({'owner': username}, projection).to_list(length=None))
+
+async def execute_trades(portfolio_name: str, trades, username: str):
+    # trades : dicts with symbol, side, qty and price. The batch is netted per symbol and applied to the
+    # portfolio in one atomic pipeline update, committed with its trade ledger entries.
+    netted = net_trades(trades)
+    # Every symbol bought resolved at once : the asset_id is only used if the symbol is not held yet
+    bought = [symbol for symbol, sides in netted.items() if "buy" in sides]
+    asset_ids, unknown = await price_cache.resolve_symbols(bought)
+    new_positions = {
+        symbol: {"asset_id": asset_id, "symbol": symbol, "qty": netted[symbol]["buy"][0], "cost_prices": netted[symbol]["buy"][1]}
+        for symbol, asset_id in asset_ids.items()
+    }
+    query = {"name": portfolio_name}
+    if unknown:
+        # Unknown assets can still be traded by portfolios already holding them
+        query["portfolio_content.symbol"] = {"$all": unknown}
+    traded_at = datetime.now(CH_timezone)
+    batch_id = uuid.uuid4().hex
+
+    async def apply_batch(session):
+        before = await portfolios.find_one_and_update(
+            query,
+            batch_stages(netted, new_positions) + [{"$set": {
+                "last_updated_at": traded_at,
+                "last_traded_at": ledger_time_stage(traded_at),
+                "trades_since_snapshot": {"$add": [{"$ifNull": ["$trades_since_snapshot", 0]}, len(trades)]},
+            }}],
+            projection={"_id": 0, "owner": 1, "portfolio_content": 1, "trades_since_snapshot": 1, "last_traded_at": 1},
+            return_document=ReturnDocument.BEFORE,
+            session=session
+        )
+        if before is not None:
+            # Portfolios created before the ledger get their first snapshot from the state the batch was applied to
+            await trade_ledger.record(
+                before["owner"], portfolio_name, [{**trade, "by": username} for trade in trades], batch_id,
+                ledger_time(traded_at, before.get("last_traded_at")),
+                positions_before=before.get("portfolio_content", []) if before.get("trades_since_snapshot") is None else None,
+                session=session
+            )
+        return before
+
+    if (before := await in_transaction(apply_batch)) is None:
+        if (portfolio := await portfolios.find_one({"name": portfolio_name}, {"_id": 0, "portfolio_content.symbol": 1})) is None:
+            raise HTTPException(status_code=404, detail="Portfolio not found")
+        held = {position["symbol"] for position in portfolio.get("portfolio_content", [])}
+        raise assets_not_found(set(unknown) - held)
+    # Outcome of the batch from the document it was applied to
+    held = {position["symbol"]: position for position in before.get("portfolio_content", [])}
+    added = [symbol for symbol in new_positions if symbol not in held]
+    realized_pnl, not_held = apply_netted(held, netted, new_positions)
+    owner = before["owner"]
+    if (before.get("trades_since_snapshot") or 0) + len(trades) >= trade_ledger.snapshot_every:
+        trade_ledger.schedule_compaction(owner, portfolio_name)
+    positions = []
+    for symbol in netted:
+        if symbol in not_held:
+            continue
+        position = {key: value for key, value in held[symbol].items() if key != "asset_id"}
+        positions.append(position)
+    await valuation_snapshots.apply_trades(owner, portfolio_name, positions)
+    live_valuations.publish_portfolio(portfolio_name, owner)
+    return {"positions": positions, "realized_pnl": realized_pnl, "not_held": not_held, "added": added}
 
 @app.put("/portfolio/{portfolio_name}/buy/{symbol}", tags=["Portfolio Methods"])
 async def buy_asset_in_portfolio(portfolio_name: str, symbol: str, qty: float, cost_price:Union[float, None] = None, token: str = Depends(oauth2_scheme)):
@@ -1046,35 +1288,12 @@ async def buy_asset_in_portfolio(portfolio_name: str, symbol: str, qty: float, c
             status_code=401, detail="Could not validate credentials"
         ) from e
     username = payload["sub"]
-    # Get portfolio by name
-    portfolio = Portfolio(**portfolios.find_one({"name": portfolio_name}))
-    if portfolio is None:
-        raise HTTPException(status_code=404, detail="Portfolio not found")
-    # If asset in portfolio
-    if asset := next((a for a in portfolio.portfolio_content if a["symbol"] == symbol), None):
-        # Compute new price qnd qty
-        new_qty = asset["qty"] + qty
-        new_cost_price = (asset["cost_prices"] * asset["qty"] + cost_price * qty) / new_qty
-        # Update portfolio
-        portfolios.update_one(
-            {"name": portfolio_name, "portfolio_content.symbol": symbol},
-            {"$set": {"portfolio_content.$.qty": new_qty, "portfolio_content.$.cost_prices": new_cost_price, "last_updated_at": datetime.now(CH_timezone)}}
-        )
-        return {"message": f"Asset {symbol} updated successfully in portfolio {portfolio_name}."}
-    #If asset not in portfolio
-    else:
-        #Find in DB the asset details
-        asset_stored = assets.find_one({"symbol": symbol})
-        if asset_stored is None:
-            raise HTTPException(status_code=404, detail="Asset not found")
-        asset = {
-            "asset_id": ObjectId(asset_stored["_id"]),
-            "symbol": symbol,
-            "qty": qty,
-            "cost_prices": cost_price,
-        }
-        portfolios.update_one({"name": portfolio_name}, {"$push": {"portfolio_content": asset}})
-        return {"message": f"Asset {symbol} added successfully to portfolio {portfolio_name}."}
+    if qty <= 0:
+        raise HTTPException(status_code=400, detail="qty must be positive")
+    result = await execute_trades(portfolio_name, [{"symbol": symbol, "side": "buy", "qty": qty, "price": cost_price}], username)
+    if result["added"]:
+        return {"message": f"Asset {symbol} added successfully to portfolio {portfolio_name}.", "position": result["positions"][0]}
+    return {"message": f"Asset {symbol} updated successfully in portfolio {portfolio_name}.", "position": result["positions"][0]}
 
 @app.put("/portfolio/{portfolio_name}/sell/{symbol}", tags=["Portfolio Methods"])
 async def sell_asset_in_portfolio(portfolio_name: str, symbol: str, qty: float, sell_price:Union[float, None] = None, token: str = Depends(oauth2_scheme)):
@@ -1085,31 +1304,63 @@ async def sell_asset_in_portfolio(portfolio_name: str, symbol: str, qty: float,
             status_code=401, detail="Could not validate credentials"
         ) from e
     username = payload["sub"]
-    # Get portfolio by name
-    portfolio = Portfolio(**portfolios.find_one({"name": portfolio_name}))
-    if portfolio is None:
-        raise HTTPException(status_code=404, detail="Portfolio not found")
-    # Asset not in portfolio
-    if not (asset := next((a for a in portfolio.portfolio_content if a["symbol"] == symbol),None,)):
+    if qty <= 0:
+        raise HTTPException(status_code=400, detail="qty must be positive")
+    if sell_price is None:
+        raise HTTPException(status_code=400, detail="sell_price is required to compute the realized PnL")
+    result = await execute_trades(portfolio_name, [{"symbol": symbol, "side": "sell", "qty": qty, "price": sell_price}], username)
+    if result["not_held"]:
         return {"message": f"Asset {symbol} does not exist in the portfolio {portfolio_name}."}
-    # Asset in portfolio
-    # Compute new price and qty(no neg)
-    
-    if qty > asset["qty"]:
-        sold_qty = asset["qty"]
-        remaining_qty = 0
-    else : 
-        sold_qty = qty
-        remaining_qty = asset["qty"] - qty
-
-    realizedPNL = asset["realized_pnl"] if "realized_pnl" in asset.keys() else 0
-    realizedPNL += (sell_price - asset["cost_prices"])*abs(sold_qty)
-    # Update portfolio
-    portfolios.update_one(
-        {"name": portfolio_name, "portfolio_content.symbol": symbol},
-        {"$set": {"portfolio_content.$.qty": remaining_qty, "portfolio_content.$.realized_pnl": realizedPNL, "last_updated_at": datetime.now(CH_timezone)}}
-    )
-    return {"message": f"Asset {symbol} updated successfully in portfolio {portfolio_name}."}
+    return {"message": f"Asset {symbol} updated successfully in portfolio {portfolio_name}.", "position": result["positions"][0]}
+
+@app.post("/portfolio/{portfolio_name}/trades", tags=["Portfolio Methods"])
+async def submit_trades(portfolio_name: str, batch: TradeBatch, token: str = Depends(oauth2_scheme)):
+    try:        
+        payload = jwt.decode(token, secret_key, algorithms=["HS256"])
+    except jwt.PyJWTError as e:
+        raise HTTPException(
+            status_code=401, detail="Could not validate credentials"
+        ) from e
+    username = payload["sub"]
+    if not batch.trades:
+        raise HTTPException(status_code=400, detail="No trades")
+    if invalid := [i for i, trade in enumerate(batch.trades) if trade.qty <= 0 or (trade.side == "sell" and trade.price is None)]:
+        raise HTTPException(status_code=400, detail=f"Invalid trades (qty must be positive, sells need a price) : {invalid}")
+    result = await execute_trades(portfolio_name, [trade.dict() for trade in batch.trades], username)
+    return {"message": f"{len(batch.trades)} trades applied to portfolio {portfolio_name} by {username}", **result}
+
+@app.get("/portfolio/{portfolio_name}/trades", tags=["Portfolio Methods"])
+async def get_portfolio_trades(portfolio_name: str, start:Union[datetime, None] = Query(default=None, alias="from"), end:Union[datetime, None] = Query(default=None, alias="to"), owner:Union[str, None] = None, token: str = Depends(oauth2_scheme)):
+    try:        
+        payload = jwt.decode(token, secret_key, algorithms=["HS256"])
+    except jwt.PyJWTError as e:
+        raise HTTPException(
+            status_code=401, detail="Could not validate credentials"
+        ) from e
+    username = payload["sub"]
+    owner = owner or username
+    return await trade_ledger.trades_between(owner, portfolio_name, start or datetime.min, end)
+
+@app.get("/portfolio/{portfolio_name}/positions", tags=["Portfolio Methods"])
+async def get_portfolio_positions(portfolio_name: str, as_of:Union[datetime, None] = None, owner:Union[str, None] = None, token: str = Depends(oauth2_scheme)):
+    try:        
+        payload = jwt.decode(token, secret_key, algorithms=["HS256"])
+    except jwt.PyJWTError as e:
+        raise HTTPException(
+            status_code=401, detail="Could not validate credentials"
+        ) from e
+    username = payload["sub"]
+    owner = owner or username
+    if as_of is None:
+        # Current positions, as maintained by the trades
+        portfolio = await portfolios.find_one({"name": portfolio_name, "owner": owner}, {"_id": 0, "portfolio_content.asset_id": 0})
+        if portfolio is None:
+            raise HTTPException(status_code=404, detail="Portfolio not found")
+        return {"name": portfolio_name, "owner": owner, "positions": portfolio.get("portfolio_content", [])}
+    # Latest snapshot before as_of and the trades since
+    if (positions := await trade_ledger.positions_at(owner, portfolio_name, as_of)) is None:
+        raise HTTPException(status_code=404, detail="No trade history for this portfolio at this date")
+    return {"name": portfolio_name, "owner": owner, "as_of": as_of, "positions": positions}
 
 @app.put("/portfolio/{portfolio_name}", tags=["Portfolio Methods"])
 async def update_portfolio_no_assets(portfolio_name:str, portfolio_details: str, token: str = Depends(oauth2_scheme)):
@@ -1125,12 +1376,22 @@ async def update_portfolio_no_assets(portfolio_name:str, portfolio_details: str,
         portfolio_details["last_updated_at"] = datetime.now(CH_timezone)
         portfolio_details.pop("created_at",None)
         portfolio_details.pop("portfolio_content",None)
-        updated_portfolio = portfolios.find_one_and_update(
+        portfolio_details.pop("trades_since_snapshot",None)
+        portfolio_details.pop("last_traded_at",None)
+        updated_portfolio = await portfolios.find_one_and_update(
             {"name": portfolio_name},
             {"$set": portfolio_details},
             return_document=ReturnDocument.AFTER
         )
+        # Currency or name changes : value the portfolio again on its next read
+        await valuation_snapshots.invalidate({"name": {"$in": [portfolio_name, updated_portfolio["name"]]}})
+        if updated_portfolio["name"] != portfolio_name:
+            await trade_ledger.rename(updated_portfolio["owner"], portfolio_name, updated_portfolio["name"])
+        live_valuations.publish_portfolio(portfolio_name)
+        live_valuations.publish_portfolio(updated_portfolio["name"])
         updated_portfolio.pop("_id",None)
+        updated_portfolio.pop("trades_since_snapshot",None)
+        updated_portfolio.pop("last_traded_at",None)
         for d in updated_portfolio["portfolio_content"]:
             d.pop("asset_id",None)
         return {"message": "Portfolio updated", "updated_portfolio" : updated_portfolio}
@@ -1146,13 +1407,16 @@ async def delete_portfolio(portfolio_name: str, token: str = Depends(oauth2_sche
             status_code=401, detail="Could not validate credentials"
         ) from e
     username = payload["sub"]
-    result = portfolios.delete_one({"name": portfolio_name})
+    result = await portfolios.delete_one({"name": portfolio_name})
+    await valuation_snapshots.invalidate({"name": portfolio_name})
+    live_valuations.publish_portfolio(portfolio_name)
     if result.deleted_count >= 1:
         return {"message": "Portfolio deleted"}
     raise HTTPException(status_code=500, detail="Something went wrong with the deletion")
 
 @app.get("/portfolios/", tags=["Portfolio Methods"])
-async def get_all_portfolios(token: str = Depends(oauth2_scheme)):
+async def get_all_portfolios(response: Response, after_owner:Union[str, None] = None, after:Union[str, None] = None, limit:Union[int, None] = None, stream: bool = False, fields:Union[str, None] = None, token: str = Depends(oauth2_scheme)):
+    # Pages are ordered by (owner, name) : pass the owner and name of the last portfolio received
     try:        
         payload = jwt.decode(token, secret_key, algorithms=["HS256"])
     except jwt.PyJWTError as e:
@@ -1160,11 +1424,9 @@ async def get_all_portfolios(token: str = Depends(oauth2_scheme)):
             status_code=401, detail="Could not validate credentials"
         ) from e
     username = payload["sub"]
-    result_mdb = portfolios.find({}, {"_id": 0})
-    all_portfolios = []
-    for res in  result_mdb : 
-        for d in res["portfolio_content"]:
-            d.pop("asset_id",None)
-        all_portfolios.append(res)
-    return all_portfolios
+    if (after is None) != (after_owner is None):
+        raise HTTPException(status_code=400, detail="after and after_owner go together : pages are ordered by (owner, name)")
+    after = None if after is None else [after_owner, after]
+    projection = fields_projection(fields or ",".join(PORTFOLIO_FIELDS), PORTFOLIO_FIELDS, PORTFOLIO_CONTENT_FIELDS, required=["owner", "name"])
+    return await list_documents(portfolios, ["owner", "name"], after, limit, stream, dict, response, projection=projection, fast=FAST_JSON)
 
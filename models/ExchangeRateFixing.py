@@ -0,0 +1,5 @@
+from pydantic import BaseModel
+from typing import Dict
+
+class ExchangeRateFixing(BaseModel):
+    rates: Dict[str, float] = {}
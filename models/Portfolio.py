@@ -2,17 +2,9 @@ from typing import List
 from datetime import datetime
 import pytz
 
-from bson.objectid import ObjectId
-from pydantic import BaseModel
-from utils.secret_tools import access_secret_version
-
-from pymongo import MongoClient
+from pydantic import BaseModel, Field
 CH_timezone = pytz.timezone('Europe/Zurich')
 
-client = MongoClient(access_secret_version("mongodb_str"))
-db = client.AssetVision
-assets_db = db.assets
-
 
 class Portfolio(BaseModel):
     owner : str = None
@@ -20,11 +12,7 @@ class Portfolio(BaseModel):
     portfolio_content: list = []
     created_at: datetime = None
     portfolio_currency: str = "USD"
-    last_updated_at: datetime = datetime.now(CH_timezone)
+    last_updated_at: datetime = Field(default_factory=lambda: datetime.now(CH_timezone))
 
     def __str__(self):
         return f"{self.name} ({self.owner})"
-
-
-
-
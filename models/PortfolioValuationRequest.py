@@ -0,0 +1,12 @@
+from pydantic import BaseModel
+from typing import List
+
+class PortfolioReference(BaseModel):
+    owner: str = None
+    name: str
+
+class PortfolioValuationRequest(BaseModel):
+    portfolios: List[PortfolioReference] = []
+    owner: str = None
+    all_portfolios: bool = False
+    facets: List[str] = ["total"]
@@ -0,0 +1,11 @@
+from pydantic import BaseModel
+from typing import List, Literal
+
+class Trade(BaseModel):
+    symbol: str
+    side: Literal["buy", "sell"]
+    qty: float
+    price: float = None
+
+class TradeBatch(BaseModel):
+    trades: List[Trade] = []
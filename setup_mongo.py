@@ -1,16 +1,97 @@
-from pymongo import MongoClient, ASCENDING, errors
-from datetime import datetime, timedelta
-from bson.objectid import ObjectId
-from utils.secret_tools import access_secret_version
-
-client = MongoClient(access_secret_version("mongodb_str"))
-db = client.AssetVision
-assets = db.assets
-portfolios = db.portfolios
-users = db.users
-rates = db.FX_rates
-
-assets.create_index([("symbol", ASCENDING)],unique=True)
-users.create_index([("username", ASCENDING)],unique=True)
-rates.create_index([("symbol", ASCENDING)],unique=True)
-portfolios.create_index([("owner", ASCENDING),("name", ASCENDING)], unique=True)
+"""Migrates the collections and indexes of the database to utils.query_catalogue.
+
+    python setup_mongo.py                 # create what is missing
+    python setup_mongo.py --dry-run       # only print the changes
+    python setup_mongo.py --drop-extra    # also drop the indexes the catalogue no longer lists
+
+Idempotent : indexes are matched on their keys, the ones already there are left as they are. An
+index with the same keys but other options (unique, partial filter...) is reported as a conflict
+and never replaced, drop it by hand to rebuild it.
+"""
+import argparse
+import sys
+
+from pymongo import MongoClient
+
+from utils.secret_tools import get_secret
+from utils.db import DATABASE_NAME
+from utils.query_catalogue import INDEXES, TIMESERIES
+
+# Index options compared with the catalogue, with their default
+COMPARED_OPTIONS = {"unique": False, "sparse": False, "partialFilterExpression": None, "expireAfterSeconds": None}
+
+
+def normalised_keys(keys):
+    return [(field, int(direction) if isinstance(direction, float) else direction) for field, direction in keys]
+
+def index_options(info):
+    return {option: info.get(option, default) for option, default in COMPARED_OPTIONS.items()}
+
+def plan_migration(db):
+    """Changes bringing db to the catalogue : (action, collection, detail) tuples."""
+    actions = []
+    collections = {info["name"]: info for info in db.list_collections()}
+    for name, options in TIMESERIES.items():
+        if name not in collections:
+            actions.append(("create_timeseries", name, options))
+        elif collections[name].get("type") != "timeseries":
+            actions.append(("conflict", name, "exists and is not a time-series collection"))
+
+    wanted = {}
+    for collection, keys, options in INDEXES:
+        wanted.setdefault(collection, []).append((normalised_keys(keys), options))
+    for collection in sorted(wanted):
+        existing = db[collection].index_information() if collection in collections else {}
+        existing = {name: info for name, info in existing.items() if name != "_id_"}
+        matched = set()
+        for keys, options in wanted[collection]:
+            same_keys = [name for name, info in existing.items() if normalised_keys(info["key"]) == keys]
+            if not same_keys:
+                actions.append(("create_index", collection, (keys, options)))
+                continue
+            matched.update(same_keys)
+            desired = {**COMPARED_OPTIONS, **options}
+            if index_options(existing[same_keys[0]]) != desired:
+                actions.append(("conflict", collection, f"index {same_keys[0]} has other options than {options}"))
+        # The (meta, time) index time-series collections get on creation is not an extra
+        timeseries = TIMESERIES.get(collection)
+        for name, info in existing.items():
+            automatic = timeseries is not None and normalised_keys(info["key"]) == [(timeseries["metaField"], 1), (timeseries["timeField"], 1)]
+            if name not in matched and not automatic:
+                actions.append(("extra_index", collection, name))
+    return actions
+
+def migrate(db, drop_extra: bool = False, dry_run: bool = False):
+    actions = plan_migration(db)
+    for action, collection, detail in actions:
+        if dry_run:
+            continue
+        if action == "create_timeseries":
+            db.create_collection(collection, timeseries=detail)
+        elif action == "create_index":
+            keys, options = detail
+            db[collection].create_index(keys, **options)
+        elif action == "extra_index" and drop_extra:
+            db[collection].drop_index(detail)
+    return actions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--drop-extra", action="store_true")
+    args = parser.parse_args()
+
+    db = MongoClient(get_secret("mongodb_str"))[DATABASE_NAME]
+    actions = migrate(db, drop_extra=args.drop_extra, dry_run=args.dry_run)
+    for action, collection, detail in actions:
+        if action == "extra_index":
+            action = "drop_index" if args.drop_extra else "extra_index (kept, --drop-extra to drop it)"
+        print(f"{'would ' if args.dry_run else ''}{action} {collection} : {detail}")
+    if not actions:
+        print(f"{DATABASE_NAME} is up to date")
+    # Conflicts need a decision : the exit status tells the deployment
+    sys.exit(1 if any(action == "conflict" for action, _, _ in actions) else 0)
+
+
+if __name__ == "__main__":
+    main()
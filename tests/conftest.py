@@ -0,0 +1,198 @@
+#Pytest
+import asyncio
+import copy
+from types import SimpleNamespace
+from bson import ObjectId
+
+
+# Shared fakes : the Motor calls made by the code under test, on a list of documents. Every call
+# yields to the event loop once, like a round trip to MongoDB would.
+OPERATORS = {
+    "$gt": lambda value, bound: value is not None and value > bound,
+    "$gte": lambda value, bound: value is not None and value >= bound,
+    "$lt": lambda value, bound: value is not None and value < bound,
+    "$lte": lambda value, bound: value is not None and value <= bound,
+    "$ne": lambda value, other: value != other,
+    "$exists": lambda value, exists: (value is not None) is exists,
+}
+
+def field_value(document, key):
+    value = document
+    for part in key.split("."):
+        if isinstance(value, list):
+            # Dotted paths into arrays : the values of every element
+            value = [item.get(part) for item in value if isinstance(item, dict)]
+        else:
+            value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+def equals(value, condition):
+    # A pattern searches, an array field matches one of its elements
+    if hasattr(condition, "search"):
+        return any(isinstance(item, str) and condition.search(item) for item in (value if isinstance(value, list) else [value]))
+    return value == condition or (isinstance(value, list) and condition in value)
+
+def matches(document, query):
+    for key, condition in (query or {}).items():
+        if key == "$or":
+            if not any(matches(document, clause) for clause in condition):
+                return False
+            continue
+        if key == "$and":
+            if not all(matches(document, clause) for clause in condition):
+                return False
+            continue
+        value = field_value(document, key)
+        if isinstance(condition, dict) and any(operator.startswith("$") for operator in condition):
+            for operator, operand in condition.items():
+                if operator == "$in":
+                    if not any(equals(value, candidate) for candidate in operand):
+                        return False
+                elif operator == "$all":
+                    if not all(equals(value, candidate) for candidate in operand):
+                        return False
+                elif not OPERATORS[operator](value, operand):
+                    return False
+        elif not equals(value, condition):
+            return False
+    return True
+
+def projected(document, projection):
+    # Top-level fields only : a dotted path keeps its whole first field
+    if not projection:
+        return document
+    fields = {key.split(".")[0]: keep for key, keep in projection.items()}
+    if any(keep for field, keep in fields.items() if field != "_id"):
+        return {key: value for key, value in document.items() if fields.get(key, key == "_id")}
+    return {key: value for key, value in document.items() if fields.get(key, True)}
+
+def sort_keys(key_or_list, direction=None):
+    return [(key_or_list, direction or 1)] if isinstance(key_or_list, str) else list(key_or_list)
+
+
+class Cursor:
+    # Sorted on the whole documents, projected as they are read
+    def __init__(self, documents, projection=None, on_read=None):
+        self.documents = documents
+        self.projection = projection
+        self.on_read = on_read
+
+    def sort(self, key_or_list, direction=None):
+        # Stable sorts, last key first
+        for key, order in reversed(sort_keys(key_or_list, direction)):
+            self.documents.sort(key=lambda document: field_value(document, key), reverse=order < 0)
+        return self
+
+    def limit(self, limit):
+        if limit:
+            self.documents = self.documents[:limit]
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def read(self):
+        # Change applied while the query was running
+        if self.on_read is not None:
+            self.on_read()
+
+    async def to_list(self, length=None):
+        await asyncio.sleep(0)
+        self.read()
+        return [projected(document, self.projection) for document in self.documents]
+
+    async def __aiter__(self):
+        for document in self.documents:
+            yield projected(document, self.projection)
+        self.read()
+
+class FakeCollection:
+    def __init__(self, documents=(), name=None):
+        self.name = name
+        self.documents = [copy.deepcopy(document) for document in documents]
+        # Filters of the reads, in order, and bulk writes sent
+        self.queries = []
+        self.bulk_writes = 0
+        self.on_read = None
+
+    def find(self, query=None, projection=None, sort=None):
+        self.queries.append(query)
+        cursor = Cursor([copy.deepcopy(document) for document in self.documents if matches(document, query)], projection, self.on_read)
+        return cursor.sort(sort) if sort else cursor
+
+    async def find_one(self, query=None, projection=None, sort=None):
+        found = await self.find(query, projection, sort).limit(1).to_list()
+        return found[0] if found else None
+
+    async def distinct(self, key, query=None):
+        await asyncio.sleep(0)
+        self.queries.append(query)
+        values = []
+        for document in self.documents:
+            if matches(document, query):
+                value = field_value(document, key)
+                values += value if isinstance(value, list) else [value]
+        return sorted(set(values))
+
+    async def insert_many(self, documents, ordered=True, session=None):
+        await asyncio.sleep(0)
+        for document in documents:
+            document.setdefault("_id", ObjectId())
+            self.documents.append(copy.deepcopy(document))
+
+    def apply_update(self, document, update):
+        for key, value in update.get("$set", {}).items():
+            document[key] = copy.deepcopy(value)
+        for key, amount in update.get("$inc", {}).items():
+            document[key] = document.get(key, 0) + amount
+
+    def upsert(self, query, update):
+        document = {"_id": ObjectId(), **{key: value for key, value in query.items() if not key.startswith("$") and not isinstance(value, dict)}}
+        document.update(copy.deepcopy(update.get("$setOnInsert", {})))
+        self.apply_update(document, update)
+        self.documents.append(document)
+        return document["_id"]
+
+    def write(self, query, update, upsert=False, many=False):
+        matched = [index for index, document in enumerate(self.documents) if matches(document, query)][:None if many else 1]
+        for index in matched:
+            if any(key.startswith("$") for key in update):
+                self.apply_update(self.documents[index], update)
+            else:
+                self.documents[index] = {"_id": self.documents[index].get("_id"), **copy.deepcopy(update)}
+        upserted_id = self.upsert(query, update) if upsert and not matched else None
+        return SimpleNamespace(matched_count=len(matched), modified_count=len(matched), upserted_id=upserted_id)
+
+    async def update_one(self, query, update, upsert=False, session=None):
+        await asyncio.sleep(0)
+        return self.write(query, update, upsert)
+
+    async def update_many(self, query, update, upsert=False, session=None):
+        await asyncio.sleep(0)
+        return self.write(query, update, upsert, many=True)
+
+    async def replace_one(self, query, replacement, upsert=False, session=None):
+        await asyncio.sleep(0)
+        return self.write(query, replacement, upsert)
+
+    async def delete_one(self, query, session=None):
+        await asyncio.sleep(0)
+        if (found := next((document for document in self.documents if matches(document, query)), None)) is not None:
+            self.documents.remove(found)
+        return SimpleNamespace(deleted_count=int(found is not None))
+
+    async def delete_many(self, query, session=None):
+        await asyncio.sleep(0)
+        kept = [document for document in self.documents if not matches(document, query)]
+        deleted, self.documents = len(self.documents) - len(kept), kept
+        return SimpleNamespace(deleted_count=deleted)
+
+    async def bulk_write(self, operations, ordered=True, session=None):
+        # UpdateOne and ReplaceOne of pymongo
+        await asyncio.sleep(0)
+        self.bulk_writes += 1
+        results = [self.write(operation._filter, operation._doc, getattr(operation, "_upsert", False) or False) for operation in operations]
+        return SimpleNamespace(
+            matched_count=sum(result.matched_count for result in results),
+            upserted_count=sum(result.upserted_id is not None for result in results),
+        )
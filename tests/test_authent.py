@@ -6,9 +6,12 @@ from main import create_access_token, authenticate_user,secret_key
 import jwt
 from datetime import datetime, timedelta
 import pytz
+import asyncio
 
 # Constants
 CH_timezone = pytz.timezone('Europe/Zurich')
+# The Motor client binds to the first loop it runs on : reuse one loop for every async call
+loop = asyncio.new_event_loop()
 
 
 @pytest.mark.parametrize("username", [
@@ -56,7 +59,7 @@ def test_create_access_token(username):
 ])
 
 def test_authenticate_user_valid(username,password,expected_output):
-    assert authenticate_user(username, password) == expected_output
+    assert loop.run_until_complete(authenticate_user(username, password)) == expected_output
 
 
 
@@ -0,0 +1,39 @@
+#Pytest
+import pytest
+# Code to test
+from benchmarks.harness import percentile, latency_summary
+from benchmarks.synthetic import ADMIN_USER, synthetic_market, synthetic_portfolio, synthetic_users, portfolio_plan
+
+
+@pytest.mark.parametrize("p,expected", [
+    (50, 5),
+    (95, 10),
+    (99, 10),
+    (10, 1),
+])
+
+def test_percentile_nearest_rank(p, expected):
+    assert percentile(list(range(1, 11)), p) == expected
+
+def test_latency_summary_in_milliseconds():
+    summary = latency_summary([0.003, 0.001, 0.002])
+    assert summary["count"] == 3
+    assert summary["min"] == pytest.approx(1)
+    assert summary["p50"] == pytest.approx(2)
+    assert summary["mean"] == pytest.approx(2)
+
+def test_synthetic_data_is_deterministic():
+    assets, rates = synthetic_market(100, seed=3)
+    assert (assets, rates) == synthetic_market(100, seed=3)
+    assert rates["USDUSD"] == 1.0
+    assert rates["EURCHF"] == pytest.approx(1 / rates["CHFEUR"])
+    portfolio = synthetic_portfolio("p", list(assets), 10, seed=1)
+    assert portfolio == synthetic_portfolio("p", list(assets), 10, seed=1)
+    assert len({position["symbol"] for position in portfolio["portfolio_content"]}) == 10
+
+def test_portfolio_plan():
+    users = synthetic_users(2)
+    assert users == [ADMIN_USER, "user0000", "user0001"]
+    assert portfolio_plan(users, sizes=[10, 1000], user_sizes=[10]) == [
+        (ADMIN_USER, "bench_10", 10), (ADMIN_USER, "bench_1000", 1000), ("user0000", "bench_10", 10), ("user0001", "bench_10", 10),
+    ]
@@ -0,0 +1,69 @@
+#Pytest
+import pytest
+from types import SimpleNamespace
+from fastapi import Response
+# Code to test
+from utils.etags import PRIVATE_CACHE_CONTROL, make_etag, etag_matches, shared_cache_control, not_modified, with_cache_headers
+from utils.price_cache import PriceCache
+
+# Constants
+ETAG = make_etag("/portfolio/main/value", "", 7, "alice")
+
+
+def test_make_etag():
+    # Test case 1: Quoted and stable
+    assert ETAG.startswith('"') and ETAG.endswith('"')
+    assert make_etag("/portfolio/main/value", "", 7, "alice") == ETAG
+    # Test case 2: Any part moves it
+    assert make_etag("/portfolio/main/value", "", 8, "alice") != ETAG
+    assert make_etag("/portfolio/main/value", "owner=bob", 7, "alice") != ETAG
+
+@pytest.mark.parametrize("if_none_match,expected", [
+    (None, False),
+    ("", False),
+    (ETAG, True),
+    (f"W/{ETAG}", True),
+    (f'"other", {ETAG}', True),
+    ("*", True),
+    ('"other"', False),
+])
+
+def test_etag_matches(if_none_match, expected):
+    assert etag_matches(if_none_match, ETAG) is expected
+
+def test_no_etag_never_matches():
+    assert not etag_matches("*", None)
+
+def test_cache_headers():
+    # Test case 1: Shared caches only when a CDN max age is given
+    assert shared_cache_control(0) == PRIVATE_CACHE_CONTROL
+    assert shared_cache_control(30) == "public, max-age=0, s-maxage=30"
+    # Test case 2: 304 without a body, varying with the bearer token
+    response = not_modified(ETAG, PRIVATE_CACHE_CONTROL)
+    assert response.status_code == 304 and response.body == b""
+    assert response.headers["etag"] == ETAG and response.headers["vary"] == "Authorization"
+    # Test case 3: Headers on the injected response, or on the returned one
+    injected = Response()
+    assert with_cache_headers({"value": 1}, injected, ETAG, PRIVATE_CACHE_CONTROL) == {"value": 1}
+    assert injected.headers["etag"] == ETAG and injected.headers["cache-control"] == PRIVATE_CACHE_CONTROL
+    assert injected.headers["vary"] == "Authorization"
+    returned = with_cache_headers(Response(), Response(), ETAG, shared_cache_control(30))
+    assert returned.headers["etag"] == ETAG and returned.headers["vary"] == "Authorization"
+    # Test case 4: Nothing without an ETag
+    injected = Response()
+    with_cache_headers({}, injected, None, PRIVATE_CACHE_CONTROL)
+    assert "etag" not in injected.headers
+
+def test_market_version():
+    cache = PriceCache(None, SimpleNamespace(name="assets"), SimpleNamespace(name="FX_rates"), versions=SimpleNamespace(name="versions"))
+    # Test case 1: No version without the change stream
+    cache.version = 3
+    assert cache.etag_version() is None
+    cache.watching = True
+    assert cache.etag_version() == 3
+    # Test case 2: The value of the event, not the looked up document that may be ahead
+    cache.apply_change({"ns": {"coll": "versions"}, "updateDescription": {"updatedFields": {"version": 4}}, "fullDocument": {"_id": "market", "version": 6}})
+    assert cache.etag_version() == 4
+    # Test case 3: First bump inserts the document
+    cache.apply_change({"ns": {"coll": "versions"}, "fullDocument": {"_id": "market", "version": 1}})
+    assert cache.etag_version() == 1
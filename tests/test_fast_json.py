@@ -0,0 +1,52 @@
+#Pytest
+import json
+import pytest
+import numpy as np
+from datetime import datetime, timedelta, timezone
+from bson import Decimal128, ObjectId
+from fastapi.encoders import jsonable_encoder
+# Code to test
+import utils.fast_json
+from utils.fast_json import FastJSONResponse, dumps
+from utils.listing import model_document, model_projection
+from models.Asset import Asset
+from models.ExchangeRate import ExchangeRate
+
+# Constants
+DOCUMENT = {
+    "symbol": "AAPL", "name": "Apple", "last_price": 150.5, "currency": "USD",
+    "created_at": datetime(2024, 1, 2, 3, 4, 5, 678000),
+    "last_updated_at": datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone(timedelta(hours=1))),
+}
+
+
+@pytest.fixture(params=["orjson", "json"])
+def encoder(request, monkeypatch):
+    if request.param == "json":
+        monkeypatch.setattr(utils.fast_json, "orjson", None)
+    elif utils.fast_json.orjson is None:
+        pytest.skip("orjson is not installed")
+
+def test_same_body_as_the_models(encoder):
+    # Test case 1: Same JSON as the model through jsonable_encoder
+    expected = jsonable_encoder(Asset(**DOCUMENT))
+    assert json.loads(dumps(model_document(Asset)(DOCUMENT))) == expected
+    # Test case 2: Required fields missing from the document are null
+    assert json.loads(dumps(model_document(ExchangeRate)({"symbol": "EURUSD"})))["base_currency"] is None
+
+def test_bson_and_numpy_types(encoder):
+    object_id = ObjectId()
+    content = {"_id": object_id, "amount": Decimal128("1.5"), "values": np.array([1.0, 2.0]), "total": np.float64(3.0)}
+    assert json.loads(dumps(content)) == {"_id": str(object_id), "amount": 1.5, "values": [1.0, 2.0], "total": 3.0}
+
+def test_non_finite_floats_are_null(encoder):
+    content = {"price": float("nan"), "values": [1.0, float("inf")], "array": np.array([np.nan, 2.0]), "total": np.float64(-np.inf), "amount": Decimal128("NaN")}
+    assert json.loads(dumps(content)) == {"price": None, "values": [1.0, None], "array": [None, 2.0], "total": None, "amount": None}
+
+def test_model_projection():
+    assert model_projection(Asset) == {"_id": 0, **{field: 1 for field in Asset.model_fields}}
+
+def test_response():
+    response = FastJSONResponse([{"symbol": "AAPL"}])
+    assert response.media_type == "application/json"
+    assert json.loads(response.body) == [{"symbol": "AAPL"}]
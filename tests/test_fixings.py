@@ -0,0 +1,64 @@
+#Pytest
+import asyncio
+import json
+import pytest
+from datetime import datetime
+from tests.conftest import FakeCollection
+# Code to test
+from models.ExchangeRateFixing import ExchangeRateFixing
+from utils.fixings import invalid_pairs, fixing_operations, apply_fixing
+from utils.price_cache import PriceCache
+from utils.price_history import PriceHistory
+
+# Constants
+UPDATED_AT = datetime(2024, 1, 1, 17)
+
+
+def operations_by_pair(fixing_rates):
+    return {operation._filter["symbol"]: operation for operation in fixing_operations(fixing_rates, "admin", UPDATED_AT)}
+
+@pytest.mark.parametrize("rates, invalid", [
+    ({"EURUSD": 1.08, "CHFUSD": 1.1}, []),
+    ({"EURUSD": 1.08, "EURUS": 1.1, "EUR/USD": 1.1}, ["EUR/USD", "EURUS"]),
+    ({"eurusd": 1.08, "EUR1SD": 1.08}, ["EUR1SD", "eurusd"]),
+    ({"EURUSD": 0, "CHFUSD": -1.1}, ["CHFUSD", "EURUSD"]),
+    ({"EURUSD": float("nan"), "CHFUSD": float("inf")}, ["CHFUSD", "EURUSD"]),
+])
+
+def test_invalid_pairs(rates, invalid):
+    assert invalid_pairs(rates) == invalid
+
+def test_every_pair_in_one_batch():
+    operations = operations_by_pair({"EURUSD": 1.25, "CHFUSD": 1.1})
+    # Test case 1: Quoted pairs upserted, their inverses only updated when stored
+    assert sorted(operations) == ["CHFUSD", "EURUSD", "USDCHF", "USDEUR"]
+    assert operations["EURUSD"]._upsert and not operations["USDEUR"]._upsert
+    assert operations["USDEUR"]._doc["$set"]["last_rate"] == pytest.approx(0.8)
+    # Test case 2: One timestamp for the whole fixing
+    assert {operation._doc["$set"]["last_updated_at"] for operation in operations.values()} == {UPDATED_AT}
+
+def test_duplicate_pairs_in_one_body():
+    # Test case 1: A pair repeated in the body is quoted once, at its last rate
+    fixing = ExchangeRateFixing(**json.loads('{"rates": {"EURUSD": 1.08, "EURUSD": 1.09}}'))
+    operations = operations_by_pair(fixing.rates)
+    assert sorted(operations) == ["EURUSD", "USDEUR"]
+    assert operations["EURUSD"]._doc["$set"]["last_rate"] == 1.09
+    # Test case 2: A pair quoted with its inverse keeps both quotes as given
+    operations = operations_by_pair({"EURUSD": 1.08, "USDEUR": 0.93})
+    assert sorted(operations) == ["EURUSD", "USDEUR"]
+    assert operations["USDEUR"]._upsert and operations["USDEUR"]._doc["$set"]["last_rate"] == 0.93
+
+def test_cache_and_history_updated_per_pair():
+    cache = PriceCache(None, None, None)
+    cache.fx.load({"EURUSD": 1.08, "USDCHF": 0.9})
+    fixing = {"EURUSD": 1.1, "CHFUSD": 1.2, "GBPUSD": 1.27}
+    apply_fixing(cache, fixing)
+    # Test case 1: Quoted pairs, and the inverses already cached
+    assert cache.fx.quotes == {"EURUSD": 1.1, "CHFUSD": 1.2, "USDCHF": pytest.approx(1 / 1.2), "GBPUSD": 1.27}
+    assert cache.fx.rate("GBP", "EUR") == pytest.approx(1.27 / 1.1)
+    # Test case 2: One history point per quoted pair, at the fixing time
+    history = PriceHistory(FakeCollection())
+    asyncio.run(history.record(fixing.items(), UPDATED_AT))
+    assert [(point["symbol"], point["value"], point["ts"]) for point in history.collection.documents] == [
+        ("EURUSD", 1.1, UPDATED_AT), ("CHFUSD", 1.2, UPDATED_AT), ("GBPUSD", 1.27, UPDATED_AT),
+    ]
@@ -0,0 +1,52 @@
+#Pytest
+import pytest
+# Code to test
+from utils.fx_matrix import FxMatrix
+
+
+@pytest.fixture
+def matrix():
+    matrix = FxMatrix("USD")
+    matrix.load({"EURUSD": 1.08, "CHFUSD": 1.1, "USDJPY": 150.0, "GBPEUR": 1.16, "AUDNZD": 1.09})
+    return matrix
+
+@pytest.mark.parametrize("base,target,expected", [
+    ("USD", "USD", 1.0),
+    ("EUR", "USD", 1.08),  # Direct quote
+    ("USD", "EUR", 1 / 1.08),  # Inverse quote
+    ("EUR", "CHF", 1.08 / 1.1),  # Through USD
+    ("CHF", "JPY", 1.1 * 150.0),
+    ("GBP", "JPY", 1.16 * 1.08 * 150.0),  # Two hops
+    ("NZD", "AUD", 1 / 1.09),  # Component without the base currency
+])
+
+def test_rate(matrix, base, target, expected):
+    assert matrix.rate(base, target) == pytest.approx(expected)
+
+@pytest.mark.parametrize("base,target", [
+    ("EUR", "AUD"),  # Not connected
+    ("XXX", "USD"),  # Unknown
+])
+
+def test_unknown_rate(matrix, base, target):
+    assert matrix.rate(base, target) is None
+
+def test_set_and_remove_quote(matrix):
+    # Test case 1: A new quote is used for every cross rate
+    matrix.set_quote("CHFUSD", 1.2)
+    assert matrix.rate("EUR", "CHF") == pytest.approx(1.08 / 1.2)
+    # Test case 2: A new currency only needs one quote
+    matrix.set_quote("SEKUSD", 0.1)
+    assert matrix.rate("SEK", "JPY") == pytest.approx(15.0)
+    # Test case 3: Removing the only quote disconnects the currency
+    matrix.remove_quote("SEKUSD")
+    assert matrix.rate("SEK", "USD") is None
+
+def test_moved_currencies(matrix):
+    assert matrix.take_moved() == {"USD", "EUR", "CHF", "JPY", "GBP", "AUD", "NZD"}
+    # Test case 1: The quote, and the rates triangulated through it
+    matrix.set_quote("EURUSD", 1.1)
+    assert matrix.take_moved() == {"EUR", "USD", "GBP"}
+    # Test case 2: Nothing moved
+    matrix.load(dict(matrix.quotes))
+    assert matrix.take_moved() == set()
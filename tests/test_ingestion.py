@@ -0,0 +1,67 @@
+#Pytest
+import asyncio
+import pytest
+from pymongo.errors import BulkWriteError
+# Code to test
+from utils.ingestion import read_lines, parse_rows, chunked, latest_rows, write_errors
+
+# Constants
+NDJSON = b'{"symbol": "AAPL", "last_price": 150}\n\n{"symbol": "NESN", "last_price": 100}\n'
+
+
+async def stream(chunks):
+    for chunk in chunks:
+        yield chunk
+
+async def collect(rows):
+    return [row async for row in rows]
+
+def parsed(chunks, content_type="application/x-ndjson"):
+    return asyncio.run(collect(parse_rows(stream(chunks), content_type)))
+
+@pytest.mark.parametrize("chunks", [
+    [NDJSON],
+    # Lines split across chunks, one byte at a time
+    [NDJSON[i:i + 1] for i in range(len(NDJSON))],
+    # Last line without its newline
+    [NDJSON[:20], NDJSON[20:-1]],
+])
+
+def test_read_lines_whatever_the_chunks(chunks):
+    lines = asyncio.run(collect(read_lines(stream(chunks))))
+    assert lines == [b'{"symbol": "AAPL", "last_price": 150}', b"", b'{"symbol": "NESN", "last_price": 100}']
+
+def test_rows_keep_their_line_numbers():
+    # Test case 1: Blank lines are skipped but counted
+    assert parsed([NDJSON]) == [
+        (1, {"symbol": "AAPL", "last_price": 150}, None),
+        (3, {"symbol": "NESN", "last_price": 100}, None),
+    ]
+    # Test case 2: CSV with a byte order mark, the header is not a row
+    rows = parsed([b'\xef\xbb\xbfsymbol, last_price\nAAPL, 150\n"NESN, SA",100'], "text/csv; charset=utf-8")
+    assert rows == [(2, {"symbol": "AAPL", "last_price": "150"}, None), (3, {"symbol": "NESN, SA", "last_price": "100"}, None)]
+
+@pytest.mark.parametrize("line", [b"not json", b'{"symbol": "AAPL"', b'["AAPL", 150]', b"150"])
+def test_malformed_rows_are_reported(line):
+    rows = parsed([b'{"symbol": "AAPL", "last_price": 150}\n' + line + b'\n{"symbol": "NESN", "last_price": 100}'])
+    # The upload goes on after the bad line
+    assert [(number, error is None) for number, _, error in rows] == [(1, True), (2, False), (3, True)]
+    assert rows[1][1] is None and rows[1][2]
+
+def test_partial_last_chunk():
+    chunks = asyncio.run(collect(chunked(stream(range(7)), 3)))
+    assert chunks == [[0, 1, 2], [3, 4, 5], [6]]
+
+def test_duplicate_symbols_take_the_last_row():
+    rows = [(1, "AAPL", 150.0), (2, "NESN", 100.0), (3, "AAPL", 155.0)]
+    assert latest_rows(rows, lambda row: row[1]) == [(2, "NESN", 100.0), (3, "AAPL", 155.0)]
+
+def test_write_errors_point_to_the_upload_lines():
+    exc = BulkWriteError({"writeErrors": [
+        {"index": 1, "code": 121, "errmsg": "Document failed validation"},
+        {"index": 2, "code": 11000},
+    ]})
+    assert write_errors(exc, [3, 5, 8]) == [
+        {"line": 5, "error": "Document failed validation"},
+        {"line": 8, "error": "Write error"},
+    ]
@@ -0,0 +1,71 @@
+#Pytest
+import asyncio
+import pytest
+from fastapi import HTTPException, Response
+from tests.conftest import FakeCollection
+# Code to test
+from utils.listing import list_documents, fields_projection
+
+# Constants
+PORTFOLIOS = [
+    {"owner": owner, "name": name}
+    for owner in ("alice", "bob,jr") for name in ("growth", "income, EUR", "main")
+]
+ALLOWED = {"name", "owner", "portfolio_currency", "portfolio_content"}
+CONTENT = {"portfolio_content": ["portfolio_content.symbol", "portfolio_content.qty", "portfolio_content.cost_prices"]}
+KEYS = ["owner", "name"]
+
+
+def test_next_page_headers_round_trip():
+    collection = FakeCollection(PORTFOLIOS)
+
+    async def page(after):
+        response = Response()
+        items = await list_documents(collection, ["owner", "name"], after, 2, False, dict, response)
+        return items, response.headers
+
+    async def every_page():
+        pages, after = [], None
+        while True:
+            items, headers = await page(after)
+            pages.append(items)
+            if "X-Next-After" not in headers:
+                return pages
+            # Commas in the keys are passed back as they are
+            after = [headers["X-Next-After-Owner"], headers["X-Next-After"]]
+
+    pages = asyncio.run(every_page())
+    assert [item for items in pages for item in items] == PORTFOLIOS
+    assert [len(items) for items in pages] == [2, 2, 2, 0]
+
+@pytest.mark.parametrize("fields, expected", [
+    (None, None),
+    ("", None),
+    # Key fields always included, once
+    ("portfolio_currency", {"owner": 1, "name": 1, "portfolio_currency": 1}),
+    (" name , owner,,name", {"owner": 1, "name": 1}),
+    # Expanded field
+    ("portfolio_content", {"owner": 1, "name": 1, "portfolio_content.symbol": 1, "portfolio_content.qty": 1, "portfolio_content.cost_prices": 1}),
+    # Nested paths
+    ("portfolio_content.qty", {"owner": 1, "name": 1, "portfolio_content.qty": 1}),
+    ("portfolio_content.qty,portfolio_content", {"owner": 1, "name": 1, "portfolio_content.symbol": 1, "portfolio_content.qty": 1, "portfolio_content.cost_prices": 1}),
+    ("owner.first,owner", {"owner": 1, "name": 1}),
+])
+
+def test_fields_projection(fields, expected):
+    projection = fields_projection(fields, ALLOWED, CONTENT, required=KEYS)
+    assert projection == (None if expected is None else {"_id": 0, **expected})
+
+@pytest.mark.parametrize("fields, unknown", [
+    ("name,last_price", ["last_price"]),
+    ("_id,name", ["_id"]),
+    ("created_by.name", ["created_by.name"]),
+    # Outside the expansion : portfolio_content.asset_id stays hidden
+    ("portfolio_content.asset_id,portfolio_content.symbolic", ["portfolio_content.asset_id", "portfolio_content.symbolic"]),
+])
+
+def test_unknown_fields(fields, unknown):
+    with pytest.raises(HTTPException) as exc_info:
+        fields_projection(fields, ALLOWED, CONTENT, required=KEYS)
+    assert exc_info.value.status_code == 400
+    assert exc_info.value.detail == f"Unknown fields : {unknown}"
@@ -0,0 +1,140 @@
+#Pytest
+import asyncio
+import json
+import pytest
+# Code to test
+from utils.live_valuations import NOT_FOUND, ValuationHub
+
+# Constants
+PORTFOLIOS = {
+    ("alice", "main"): {"value": 100.0, "symbols": ["AAPL", "NESN"], "pairs": ["USDUSD", "CHFUSD"]},
+    ("bob", "main"): {"value": 50.0, "symbols": ["AAPL"], "pairs": ["USDUSD"]},
+}
+TOTAL = ("total",)
+
+
+class Market:
+    def __init__(self):
+        self.portfolios = {key: dict(portfolio) for key, portfolio in PORTFOLIOS.items()}
+        self.computed = []
+        self.version = 0
+
+    async def compute(self, owner, name, facets):
+        self.computed.append((owner, name))
+        if (portfolio := self.portfolios.get((owner, name))) is None:
+            return None
+        return {"name": name, "owner": owner, "converted_price": portfolio["value"]}, portfolio["symbols"], portfolio["pairs"]
+
+def received(mailbox):
+    message, mailbox.message = mailbox.message, None
+    mailbox.event.clear()
+    return None if message is None else json.loads(message.split(b"data: ")[1])["converted_price"]
+
+def test_fan_out_once_per_tick():
+    async def scenario():
+        market = Market()
+        hub = ValuationHub(market.compute)
+        # Test case 1: Computed for the first subscriber, served to the next ones
+        mailboxes = [await hub.subscribe(("alice", "main", TOTAL)) for _ in range(1000)]
+        assert market.computed == [("alice", "main")]
+        assert {received(mailbox) for mailbox in mailboxes} == {100.0}
+        # Test case 2: Several changes in one tick, one computation for every subscriber
+        market.portfolios[("alice", "main")]["value"] = 110.0
+        hub.publish_prices(["AAPL"])
+        hub.publish_prices(["NESN", "UNKNOWN"])
+        hub.publish_portfolio("main", "alice")
+        await asyncio.gather(*(hub.refresh(key) for key in hub.take_dirty()))
+        assert market.computed.count(("alice", "main")) == 2
+        assert {received(mailbox) for mailbox in mailboxes} == {110.0}
+        # Test case 3: Unchanged value, nothing pushed
+        hub.publish_prices(["AAPL"])
+        await asyncio.gather(*(hub.refresh(key) for key in hub.take_dirty()))
+        assert {received(mailbox) for mailbox in mailboxes} == {None}
+        # Test case 4: Channel dropped with its last subscriber
+        for mailbox in mailboxes:
+            hub.unsubscribe(("alice", "main", TOTAL), mailbox)
+        assert hub.channels == {} and hub.by_symbol == {} and hub.by_portfolio == {}
+
+    asyncio.run(scenario())
+
+def test_relevant_changes():
+    async def scenario():
+        market = Market()
+        hub = ValuationHub(market.compute)
+        await hub.subscribe(("alice", "main", TOTAL))
+        await hub.subscribe(("bob", "main", TOTAL))
+        # Test case 1: Holders of the symbol only
+        hub.publish_prices(["NESN"])
+        assert hub.take_dirty() == {("alice", "main", TOTAL)}
+        # Test case 2: FX quotes for the portfolios holding another currency
+        hub.publish_rates()
+        assert hub.take_dirty() == {("alice", "main", TOTAL)}
+        # Test case 3: Portfolios updated by name, every owner
+        hub.publish_portfolio("main")
+        assert hub.take_dirty() == {("alice", "main", TOTAL), ("bob", "main", TOTAL)}
+
+    asyncio.run(scenario())
+
+@pytest.mark.parametrize("changes_followed, dirty", [
+    (True, {("alice", "main", TOTAL)}),
+    (False, {("alice", "main", TOTAL), ("bob", "main", TOTAL)}),
+])
+
+def test_changes_of_other_workers(changes_followed, dirty):
+    async def scenario():
+        market = Market()
+        hub = ValuationHub(market.compute, market_version=lambda: market.version, changes_followed=changes_followed)
+        await hub.subscribe(("alice", "main", TOTAL))
+        await hub.subscribe(("bob", "main", TOTAL))
+        hub.take_dirty()
+        # Test case 1: Held until the market version moves
+        hub.market_changed("asset", "NESN")
+        assert hub.take_dirty() == set()
+        market.version += 1
+        assert hub.take_dirty() == dirty
+
+    asyncio.run(scenario())
+
+def test_deleted_portfolio():
+    async def scenario():
+        market = Market()
+        hub = ValuationHub(market.compute)
+        # Test case 1: Unknown portfolio
+        assert (await hub.subscribe(("carol", "main", TOTAL))).message is NOT_FOUND
+        # Test case 2: Subscribers told when it is deleted
+        mailbox = await hub.subscribe(("alice", "main", TOTAL))
+        del market.portfolios[("alice", "main")]
+        hub.publish_portfolio("main")
+        await asyncio.gather(*(hub.refresh(key) for key in hub.take_dirty()))
+        assert mailbox.message is NOT_FOUND
+        assert ("alice", "main", TOTAL) not in hub.channels
+
+    asyncio.run(scenario())
+
+def test_failing_portfolio_keeps_the_hub_running():
+    async def scenario():
+        market = Market()
+
+        async def compute(owner, name, facets):
+            if market.portfolios[(owner, name)]["value"] < 0:
+                raise KeyError("converted_price")
+            return await market.compute(owner, name, facets)
+
+        hub = ValuationHub(compute, tick=0)
+        alice = await hub.subscribe(("alice", "main", TOTAL))
+        bob = await hub.subscribe(("bob", "main", TOTAL))
+        received(alice), received(bob)
+        run = asyncio.create_task(hub.run())
+        # Test case 1: The other channels are still valued, the failed one is retried
+        market.portfolios[("alice", "main")]["value"] = 120.0
+        market.portfolios[("bob", "main")]["value"] = -1.0
+        hub.publish_prices(["AAPL"])
+        await asyncio.wait_for(alice.event.wait(), 1)
+        assert received(alice) == 120.0 and received(bob) is None
+        # Test case 2: Retried, pushed once it can be valued again
+        market.portfolios[("bob", "main")]["value"] = 60.0
+        await asyncio.wait_for(bob.event.wait(), 1)
+        assert received(bob) == 60.0 and not run.done()
+        run.cancel()
+
+    asyncio.run(scenario())
@@ -0,0 +1,50 @@
+#Pytest
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+# Code to test
+from utils.metrics import Counter, Histogram, MetricsRoute, format_labels, http_requests_in_progress
+
+
+@pytest.mark.parametrize("value,expected", [
+    ("plain", '{route="plain"}'),
+    ('say "hi"', '{route="say \\"hi\\""}'),
+    ("back\\slash", '{route="back\\\\slash"}'),
+])
+
+def test_format_labels(value, expected):
+    assert format_labels(("route",), (value,)) == expected
+
+def test_counter_render():
+    counter = Counter("requests_total", "Requests.", ("status",))
+    counter.inc("200")
+    counter.inc("200", amount=2)
+    assert counter.render() == ["# HELP requests_total Requests.", "# TYPE requests_total counter", 'requests_total{status="200"} 3']
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("duration_seconds", "Durations.", buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 5):
+        histogram.observe(value)
+    lines = histogram.render()[2:]
+    assert lines == [
+        'duration_seconds_bucket{le="0.1"} 2',
+        'duration_seconds_bucket{le="1.0"} 3',
+        'duration_seconds_bucket{le="+Inf"} 4',
+        "duration_seconds_sum 5.65",
+        "duration_seconds_count 4",
+    ]
+
+def test_requests_in_flight_by_route_template():
+    app = FastAPI()
+    app.router.route_class = MetricsRoute
+    seen = []
+
+    @app.get("/items/{item}")
+    async def get_item(item: str):
+        seen.append(http_requests_in_progress.values.get(("GET", "/items/{item}")))
+        return {}
+
+    # Counted under the template while handled, not under the path
+    assert TestClient(app).get("/items/42").status_code == 200
+    assert seen == [1]
+    assert http_requests_in_progress.values[("GET", "/items/{item}")] == 0
@@ -0,0 +1,112 @@
+#Pytest
+import asyncio
+import pytest
+from types import SimpleNamespace
+from bson import ObjectId
+from tests.conftest import FakeCollection
+# Code to test
+import utils.price_cache
+from utils.price_cache import PriceCache
+from utils.trades import assets_not_found
+
+# Constants
+AAPL_ID, EURUSD_ID = ObjectId(), ObjectId()
+NESN_ID = ObjectId()
+ASSETS = [
+    {"_id": AAPL_ID, "symbol": "AAPL", "last_price": 150.0, "currency": "USD", "asset_class": "Equity", "geo_zone": "US"},
+    {"_id": NESN_ID, "symbol": "NESN", "last_price": 100.0, "currency": "CHF", "asset_class": "Equity", "geo_zone": "EU"},
+]
+RATES = [{"_id": EURUSD_ID, "symbol": "EURUSD", "last_rate": 1.08}, {"_id": ObjectId(), "symbol": "CHFUSD", "last_rate": 1.1}]
+MAX_AGE = 60
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(utils.price_cache, "time", SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+@pytest.fixture
+def cache(clock):
+    return PriceCache(None, FakeCollection(ASSETS, "assets"), FakeCollection(RATES, "FX_rates"), max_age=MAX_AGE)
+
+def test_load_racing_a_change_is_not_stored(cache):
+    # Test case 1: Asset invalidated while it was read, served once but read again next time
+    cache.assets_collection.on_read = lambda: cache.invalidate_asset("AAPL")
+    assert asyncio.run(cache.get_assets(["AAPL"]))["AAPL"]["last_price"] == 150.0
+    assert "AAPL" not in cache.assets
+    cache.assets_collection.on_read = None
+    asyncio.run(cache.get_assets(["AAPL"]))
+    assert "AAPL" in cache.assets and len(cache.assets_collection.queries) == 2
+    # Test case 2: Quote written while the rates were read, reloaded on next access
+    cache.rates_collection.on_read = lambda: cache.set_rate({"symbol": "EURUSD", "last_rate": 1.09})
+    asyncio.run(cache.get_rates(["EURUSD"]))
+    assert cache.fx_loaded_at is None
+    cache.rates_collection.on_read = None
+    asyncio.run(cache.get_rates(["EURUSD"]))
+    assert cache.fx_loaded_at is not None and len(cache.rates_collection.queries) == 2
+
+def test_entries_expire_after_max_age(cache, clock):
+    for _ in range(2):
+        asyncio.run(cache.get_assets(["AAPL"]))
+        asyncio.run(cache.get_rates(["CHFEUR"]))
+    assert (cache.misses, cache.hits, cache.stale) == (2, 2, 0)
+    assert len(cache.assets_collection.queries) == len(cache.rates_collection.queries) == 1
+    # Test case 1: Still served at max_age
+    clock.now += MAX_AGE
+    asyncio.run(cache.get_assets(["AAPL"]))
+    assert len(cache.assets_collection.queries) == 1
+    # Test case 2: Read again after it
+    clock.now += 1
+    asyncio.run(cache.get_assets(["AAPL"]))
+    assert asyncio.run(cache.get_rates(["CHFEUR"]))["CHFEUR"] == pytest.approx(1.1 / 1.08)
+    assert cache.stale == 2
+    assert len(cache.assets_collection.queries) == len(cache.rates_collection.queries) == 2
+
+def test_delete_events_resolved_through_ids(cache):
+    changes = []
+    cache.listeners.append(lambda kind, key: changes.append((kind, key)))
+    asyncio.run(cache.get_assets(["AAPL"]))
+    asyncio.run(cache.get_rates(["EURUSD"]))
+    # Test case 1: Deleted documents only carry their _id
+    cache.apply_change({"ns": {"coll": "assets"}, "documentKey": {"_id": AAPL_ID}})
+    cache.apply_change({"ns": {"coll": "FX_rates"}, "documentKey": {"_id": EURUSD_ID}})
+    assert "AAPL" not in cache.assets
+    assert asyncio.run(cache.get_rates(["EURUSD"])) == {}
+    assert changes == [("asset", "AAPL"), ("rate", "EURUSD")]
+    # Test case 2: Documents never loaded here are ignored
+    cache.apply_change({"ns": {"coll": "assets"}, "documentKey": {"_id": ObjectId()}})
+    assert len(changes) == 2
+
+@pytest.mark.parametrize("age, write_version, table_version, own", [
+    # Not published yet : the table cannot hold it
+    (0, None, 5, True),
+    (0, 3, 2, True),
+    # Table at the version the write was published with
+    (0, 3, 3, False),
+    (0, 3, None, True),
+    # Served from here for max_age at most
+    (MAX_AGE + 1, None, 0, False),
+])
+
+def test_own_writes_until_the_table_has_them(cache, clock, age, write_version, table_version, own):
+    writes = {"AAPL": [clock.now, write_version]}
+    clock.now += age
+    shared = SimpleNamespace(version=lambda: table_version)
+    assert cache._own_write(writes, "AAPL", shared) is own
+    # Forgotten once the table holds it
+    assert ("AAPL" in writes) is own
+    assert cache._own_write(writes, "NESN", shared) is False
+
+def test_resolve_known_and_unknown_symbols(cache):
+    asyncio.run(cache.get_assets(["AAPL"]))
+    # Test case 1: One query for the misses, every unknown symbol reported together
+    asset_ids, unknown = asyncio.run(cache.resolve_symbols(["ZZZ", "AAPL", "NESN", "XXX", "ZZZ", "NESN"]))
+    assert asset_ids == {"AAPL": AAPL_ID, "NESN": NESN_ID}
+    assert unknown == ["XXX", "ZZZ"]
+    assert sorted(cache.assets_collection.queries[-1]["symbol"]["$in"]) == ["NESN", "XXX", "ZZZ"]
+    assert len(cache.assets_collection.queries) == 2
+    # Test case 2: The portfolio is not created, the 404 lists them all
+    exc = assets_not_found(unknown)
+    assert exc.status_code == 404
+    assert exc.detail == "Assets not found : ['XXX', 'ZZZ']"
@@ -0,0 +1,104 @@
+#Pytest
+import asyncio
+import pytest
+# Code to test
+from datetime import datetime, timedelta, timezone
+import numpy as np
+from tests.conftest import FakeCollection
+from utils.price_history import PriceHistory, parse_step, time_points, as_of_join, derive_rates
+from utils.valuation import value_series
+
+# Constants
+START = datetime(2024, 1, 1)
+ASSET_DATA = {
+    "AAPL": {"last_price": 150.0, "currency": "USD", "asset_class": "Equity", "geo_zone": "US"},
+    "NESN": {"last_price": 100.0, "currency": "CHF", "asset_class": "Equity", "geo_zone": "EU"},
+}
+
+
+@pytest.mark.parametrize("step,expected", [
+    ("1d", timedelta(days=1)),
+    ("12h", timedelta(hours=12)),
+    ("2w", timedelta(weeks=2)),
+    ("30m", timedelta(minutes=30)),
+])
+
+def test_parse_step(step, expected):
+    assert parse_step(step) == expected
+
+@pytest.mark.parametrize("step", ["", "1x", "0d", "d", "-1d"])
+def test_parse_invalid_step(step):
+    with pytest.raises(ValueError):
+        parse_step(step)
+
+def test_time_points_end_on_the_requested_end():
+    points = time_points(START, START + timedelta(days=2, hours=6), timedelta(days=1))
+    assert points == [START, START + timedelta(days=1), START + timedelta(days=2), START + timedelta(days=2, hours=6)]
+
+def test_time_points_are_naive_utc():
+    zurich = timezone(timedelta(hours=1))
+    assert time_points(datetime(2024, 1, 1, 1, tzinfo=zurich), datetime(2024, 1, 1, 1, tzinfo=zurich), timedelta(days=1)) == [START]
+
+def test_time_points_limit():
+    with pytest.raises(ValueError):
+        time_points(START, START + timedelta(days=100000), timedelta(days=1))
+
+def test_as_of_join():
+    times = np.array([START + timedelta(days=1), START + timedelta(days=3)], dtype="datetime64[ms]")
+    points = np.array([START + timedelta(days=day) for day in range(5)], dtype="datetime64[ms]")
+    joined = as_of_join(times, [10.0, 30.0], points)
+    assert np.isnan(joined[0])
+    assert joined[1:].tolist() == [10.0, 10.0, 30.0, 30.0]
+
+def test_as_of_reads_one_point_per_symbol():
+    history = FakeCollection([
+        {"symbol": "AAPL", "ts": START, "value": 10.0},
+        {"symbol": "AAPL", "ts": START + timedelta(days=2), "value": 20.0},
+        {"symbol": "AAPL", "ts": START + timedelta(days=5), "value": 50.0},
+        {"symbol": "NESN", "ts": START + timedelta(days=5), "value": 5.0},
+    ])
+    moment = datetime(2024, 1, 4, tzinfo=timezone.utc)
+    # Test case 1: Last point at or before the moment, nothing for a symbol without history yet
+    assert asyncio.run(PriceHistory(history).as_of(["AAPL", "NESN"], moment)) == {"AAPL": (START + timedelta(days=2), 20.0)}
+    # Test case 2: One seek per symbol on the time field, in naive UTC
+    assert history.queries == [
+        {"symbol": "AAPL", "ts": {"$lte": datetime(2024, 1, 4)}},
+        {"symbol": "NESN", "ts": {"$lte": datetime(2024, 1, 4)}},
+    ]
+
+def test_derive_rates():
+    quotes = {"CHFUSD": np.array([1.1, 1.2]), "USDEUR": np.array([0.9, np.nan])}
+    rates = derive_rates(["CHFUSD", "USDCHF", "CHFEUR", "USDUSD", "GBPUSD"], quotes, 2)
+    assert rates["CHFUSD"].tolist() == [1.1, 1.2]
+    assert rates["USDCHF"] == pytest.approx([1 / 1.1, 1 / 1.2])
+    assert rates["CHFEUR"][0] == pytest.approx(1.1 * 0.9)
+    assert np.isnan(rates["CHFEUR"][1])
+    assert rates["USDUSD"].tolist() == [1.0, 1.0]
+    assert "GBPUSD" not in rates
+
+def test_value_series_leaves_out_positions_before_their_first_price():
+    portfolio = {
+        "portfolio_currency": "USD",
+        "portfolio_content": [
+            {"symbol": "AAPL", "qty": 10, "cost_prices": 100},
+            {"symbol": "NESN", "qty": 5, "cost_prices": 90},
+        ],
+    }
+    prices = {"AAPL": np.array([140.0, 150.0]), "NESN": np.array([np.nan, 100.0])}
+    rates = {"USDUSD": np.ones(2), "CHFUSD": np.array([1.1, 1.1])}
+    price, cost = value_series(portfolio, ASSET_DATA, prices, rates, 2)
+    assert price == pytest.approx([1400, 1500 + 550])
+    assert cost == pytest.approx([1000, 1000 + 495])
+
+def test_value_series_values_the_positions_held_at_each_point():
+    portfolio = {"portfolio_currency": "USD", "portfolio_content": [{"symbol": "NESN", "qty": 5, "cost_prices": 90}]}
+    holdings = [
+        [{"symbol": "AAPL", "qty": 10, "cost_prices": 100}],
+        [{"symbol": "AAPL", "qty": 10, "cost_prices": 100}, {"symbol": "NESN", "qty": 5, "cost_prices": 90}],
+        [{"symbol": "NESN", "qty": 5, "cost_prices": 90}],
+    ]
+    prices = {"AAPL": np.array([140.0, 150.0, 160.0]), "NESN": np.array([100.0, 100.0, 100.0])}
+    rates = {"USDUSD": np.ones(3), "CHFUSD": np.array([1.1, 1.1, 1.1])}
+    price, cost = value_series(portfolio, ASSET_DATA, prices, rates, 3, holdings)
+    assert price == pytest.approx([1400, 1500 + 550, 550])
+    assert cost == pytest.approx([1000, 1000 + 495, 495])
@@ -0,0 +1,72 @@
+#Pytest
+import pytest
+import sys
+# Code to test
+from utils.metrics import command_observers
+from utils.profiling import ProfileStore, SamplingProfiler, frame_category
+
+
+@pytest.mark.parametrize("module,expected", [
+    ("jwt.api_jwt", "jwt"),
+    ("pydantic.main", "pydantic"),
+    ("fastapi.encoders", "serialisation"),
+    ("json", "serialisation"),
+    ("bson.json_util", "serialisation"),
+    ("motor.core", "mongo"),
+    ("selectors", "waiting"),
+    ("jwtools", None),
+    ("main", None),
+])
+
+def test_frame_category(module, expected):
+    assert frame_category(module) == expected
+
+def test_sample_folds_stack_and_categorises_innermost_frame():
+    profiler = SamplingProfiler(0)
+    for _ in range(2):
+        profiler.sample(sys._getframe())
+    (stack, count), = profiler.folded.items()
+    assert count == 2
+    assert stack.split(";")[-1].startswith("test_sample_folds_stack_and_categorises_innermost_frame (tests.test_profiling:")
+    assert profiler.categories == {"application": 2}
+
+def test_report_breakdown_scales_to_duration():
+    profiler = SamplingProfiler(0)
+    profiler.categories.update({"jwt": 1, "mongo": 3})
+    profiler.samples = 4
+    profiler.started_at, profiler.stopped_at = 10.0, 12.0
+    profiler.observe_command("assets", "find", 0.5)
+    profiler.observe_command("assets", "find", 0.25)
+    report = profiler.report()
+    assert report["breakdown"] == {"mongo": 1.5, "jwt": 0.5}
+    assert report["mongo_commands"] == {"assets.find": {"count": 2, "seconds": 0.75}}
+
+def test_store_profiles_one_request_at_a_time():
+    store = ProfileStore(keep=1)
+    switch_interval = sys.getswitchinterval()
+    first = store.begin("/assets")
+    assert store.begin("/rates") is None
+    assert first.observe_command in command_observers
+    store.end(first)
+    assert first.observe_command not in command_observers
+    assert sys.getswitchinterval() == switch_interval
+    second = store.begin("/rates")
+    store.end(second)
+    assert store.get(first.profile_id) is None
+    assert store.get(second.profile_id) is second
+
+def test_unfinished_profile_stops_on_its_own():
+    # Response body never sent : end is not called
+    store = ProfileStore()
+    switch_interval = sys.getswitchinterval()
+    first = store.begin("/assets")
+    first.max_duration = 0.01
+    first.sampler.join(timeout=5)
+    assert not first.running and first.stopped_at is not None
+    assert sys.getswitchinterval() == switch_interval
+    # Test case 1: The next request is profiled, the cut profile is kept
+    second = store.begin("/rates")
+    assert second is not None and store.get(first.profile_id) is first
+    assert first.observe_command not in command_observers
+    store.end(second)
+    assert not second.running and store.active is None
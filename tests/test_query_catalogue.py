@@ -0,0 +1,88 @@
+#Pytest
+import pytest
+# Code to test
+from utils.query_catalogue import (
+    INDEXES, QUERY_SHAPES, TIMESERIES, catalogued_index, command_collection, find, plan_problems, plan_stages, recommend_index,
+)
+from setup_mongo import plan_migration
+
+# Constants
+FIND_EXPLAIN = {
+    "queryPlanner": {
+        "winningPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": "owner_1_name_1"}},
+        "rejectedPlans": [{"stage": "COLLSCAN"}],
+    },
+    "command": {"find": "portfolios", "filter": {}},
+}
+SORT_EXPLAIN = {
+    "stages": [
+        {"$cursor": {"queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}}}},
+        {"$sort": {"sortKey": {"ts": 1}}},
+    ],
+    "command": {"pipeline": [{"$sort": {"ts": 1}}]},
+}
+
+
+@pytest.mark.parametrize("command,expected", [
+    (find("portfolios", {"name": "p"}), [("name", 1)]),
+    (find("trades", {"owner": "o", "name": "p", "ts": {"$gt": 0}}, sort={"ts": 1, "_id": 1}), [("owner", 1), ("name", 1), ("ts", 1), ("_id", 1)]),
+    (find("assets", {"symbol": {"$in": ["A"]}, "last_price": {"$gt": 1}}), [("symbol", 1), ("last_price", 1)]),
+    (find("portfolios", {"$or": [{"owner": {"$gt": "o"}}, {"owner": "o", "name": {"$gt": "p"}}]}, sort={"owner": 1, "name": 1}), [("owner", 1), ("name", 1)]),
+    (find("portfolio_valuations", {"_id": 1}), []),
+])
+
+def test_recommend_index(command, expected):
+    assert recommend_index(command) == expected
+
+def test_every_query_shape_has_an_index():
+    missing = [
+        label for label, command, accepted in QUERY_SHAPES
+        if "COLLSCAN" not in accepted and not catalogued_index(command_collection(command), recommend_index(command))
+    ]
+    assert missing == []
+
+def test_plan_stages_skip_rejected_plans_and_command():
+    assert plan_stages(FIND_EXPLAIN) == ["FETCH", "IXSCAN"]
+    assert plan_problems(plan_stages(FIND_EXPLAIN)) == []
+
+def test_plan_problems():
+    stages = plan_stages(SORT_EXPLAIN)
+    assert plan_problems(stages) == ["blocking in-memory sort", "collection scan"]
+    assert plan_problems(stages, accepted=("SORT",)) == ["collection scan"]
+
+
+class FakeCollection:
+    def __init__(self, indexes):
+        self.indexes = indexes
+
+    def index_information(self):
+        return {"_id_": {"key": [("_id", 1)]}, **self.indexes}
+
+class FakeDatabase:
+    def __init__(self, collections):
+        self.collections = collections
+
+    def list_collections(self):
+        return [{"name": name, "type": "timeseries" if name in TIMESERIES else "collection"} for name in self.collections]
+
+    def __getitem__(self, name):
+        return FakeCollection(self.collections[name])
+
+def test_migration_is_idempotent():
+    indexes = {}
+    for collection, keys, options in INDEXES:
+        indexes.setdefault(collection, {})["_".join(f"{field}_{direction}" for field, direction in keys)] = {"key": keys, **options}
+    assert plan_migration(FakeDatabase(indexes)) == []
+
+def test_migration_plan():
+    db = FakeDatabase({
+        "assets": {"symbol_1": {"key": [("symbol", 1)]}},
+        "trades": {"owner_1_name_1_ts_1": {"key": [("owner", 1), ("name", 1), ("ts", 1)]}},
+        "price_history": {"symbol_1_ts_1": {"key": [("symbol", 1.0), ("ts", 1.0)]}},
+    })
+    actions = plan_migration(db)
+    assert ("conflict", "assets", "index symbol_1 has other options than {'unique': True}") in actions
+    assert ("extra_index", "trades", "owner_1_name_1_ts_1") in actions
+    assert ("create_index", "trades", ([("owner", 1), ("name", 1), ("ts", 1), ("_id", 1)], {})) in actions
+    assert ("create_timeseries", "FX_rates_history", TIMESERIES["FX_rates_history"]) in actions
+    assert not any(action == "extra_index" and collection == "price_history" for action, collection, _ in actions)
@@ -0,0 +1,129 @@
+#Pytest
+import asyncio
+import pytest
+from types import SimpleNamespace
+from bson import ObjectId
+# Code to test
+from utils.price_cache import PriceCache
+from utils.shared_prices import HEADER, SharedPriceFeeder, SharedPriceTable, SharedPriceWriter
+
+# Constants
+AAPL_ID, NESN_ID = ObjectId(), ObjectId()
+ASSETS = [
+    {"_id": AAPL_ID, "symbol": "AAPL", "last_price": 150.0, "currency": "USD", "asset_class": "Equity", "geo_zone": "US"},
+    {"_id": NESN_ID, "symbol": "NESN", "last_price": 100.0, "currency": "CHF", "asset_class": "Equity", "geo_zone": None},
+]
+QUOTES = {"CHFUSD": 1.1, "EURUSD": 1.08}
+
+
+@pytest.fixture
+def table():
+    table = SharedPriceTable.create(asset_capacity=8, rate_capacity=4, label_capacity=4)
+    yield table
+    table.close()
+
+@pytest.fixture
+def writer(table):
+    writer = SharedPriceWriter(table)
+    writer.load(ASSETS, QUOTES)
+    writer.heartbeat()
+    return writer
+
+@pytest.fixture
+def reader(table):
+    reader = SharedPriceTable.attach(table.name)
+    yield reader
+    reader.close()
+
+def collection(name):
+    return SimpleNamespace(name=name)
+
+def test_load_and_read(writer, reader):
+    # Test case 1: Rows found by symbol, categories and ids restored
+    found = reader.get_assets(["NESN", "AAPL", "UNKNOWN", "X" * 40])
+    assert found == {
+        "AAPL": {"last_price": 150.0, "currency": "USD", "asset_class": "Equity", "geo_zone": "US", "asset_id": AAPL_ID},
+        "NESN": {"last_price": 100.0, "currency": "CHF", "asset_class": "Equity", "geo_zone": None, "asset_id": NESN_ID},
+    }
+    assert reader.get_quotes() == QUOTES
+    # Test case 2: Readers cannot write, the header included
+    with pytest.raises(ValueError):
+        reader.assets[0] = reader.assets[1]
+    with pytest.raises(ValueError):
+        reader.header[HEADER["seq"]] += 1
+    assert reader.writer_header is None
+    # Test case 3: Ready while the owner is alive
+    assert reader.ready(max_age=60)
+    writer.table.writer_header[HEADER["heartbeat_ms"]] -= 120000
+    assert not reader.ready(max_age=60)
+
+def test_writes(writer, reader):
+    # Test case 1: Price update in place
+    writer.set_asset({**ASSETS[0], "last_price": 155.0})
+    assert reader.get_assets(["AAPL"])["AAPL"]["last_price"] == 155.0
+    # Test case 2: New asset kept sorted, then removed
+    writer.set_asset({"_id": ObjectId(), "symbol": "ABB", "last_price": 30.0, "currency": "CHF", "asset_class": "Equity", "geo_zone": "US"})
+    assert set(reader.get_assets(["AAPL", "ABB", "NESN"])) == {"AAPL", "ABB", "NESN"}
+    writer.remove_asset("ABB")
+    assert set(reader.get_assets(["AAPL", "ABB", "NESN"])) == {"AAPL", "NESN"}
+    # Test case 3: Labels beyond the label table are left to Mongo
+    writer.set_asset({"_id": ObjectId(), "symbol": "BHP", "last_price": 40.0, "currency": "AUD", "asset_class": "Commodity", "geo_zone": "APAC"})
+    assert reader.get_assets(["BHP"]) == {}
+    # Test case 4: Quotes
+    writer.set_quote("EURUSD", 1.1)
+    writer.remove_quote("CHFUSD")
+    assert reader.get_quotes() == {"EURUSD": 1.1}
+
+def test_seqlock(writer, reader):
+    # Test case 1: No read while a write is in progress
+    writer.table.writer_header[HEADER["seq"]] += 1
+    assert reader.get_assets(["AAPL"]) is None
+    writer.table.writer_header[HEADER["seq"]] += 1
+    assert "AAPL" in reader.get_assets(["AAPL"])
+    # Test case 2: Version known while the change stream is followed
+    assert reader.version() is None
+    writer.set_version(7)
+    assert reader.version() == 7
+    writer.set_version(None)
+    assert reader.version() is None
+
+def test_feeder_changes(writer, reader):
+    feeder = SharedPriceFeeder(writer, None, collection("assets"), collection("FX_rates"), collection("versions"))
+    feeder.ids[NESN_ID] = ("assets", "NESN")
+    feeder.apply_change({"ns": {"coll": "assets"}, "fullDocument": {**ASSETS[0], "last_price": 160.0}})
+    feeder.apply_change({"ns": {"coll": "assets"}, "documentKey": {"_id": NESN_ID}})
+    feeder.apply_change({"ns": {"coll": "FX_rates"}, "fullDocument": {"_id": ObjectId(), "symbol": "GBPUSD", "last_rate": 1.27}})
+    feeder.apply_change({"ns": {"coll": "versions"}, "updateDescription": {"updatedFields": {"version": 3}}, "fullDocument": {"version": 5}})
+    found = reader.get_assets(["AAPL", "NESN"])
+    assert list(found) == ["AAPL"] and found["AAPL"]["last_price"] == 160.0
+    assert reader.get_quotes()["GBPUSD"] == 1.27
+    assert reader.version() == 3
+
+def test_price_cache_reads_the_table(writer, reader):
+    class Versions:
+        name = "versions"
+        version = 0
+
+        async def find_one_and_update(self, *args, **kwargs):
+            self.version += 1
+            return {"_id": "market", "version": self.version}
+
+    cache = PriceCache(None, collection("assets"), collection("FX_rates"), versions=Versions(), shared=reader)
+    writer.set_version(0)
+    # Test case 1: Prices and cross rates from the table
+    assert asyncio.run(cache.get_assets(["AAPL"]))["AAPL"]["last_price"] == 150.0
+    assert asyncio.run(cache.get_rates(["CHFEUR"]))["CHFEUR"] == pytest.approx(1.1 / 1.08)
+    assert cache.etag_version() == 0
+    # Test case 2: Writes of this worker served until the table reaches their version
+    cache.set_asset({**ASSETS[0], "last_price": 170.0})
+    cache.set_rate({"symbol": "EURUSD", "last_rate": 1.2})
+    asyncio.run(cache.bump_version())
+    writer.set_quote("CHFUSD", 1.12)
+    assert asyncio.run(cache.get_assets(["AAPL"]))["AAPL"]["last_price"] == 170.0
+    assert asyncio.run(cache.get_rates(["EURUSD"]))["EURUSD"] == 1.2
+    writer.set_asset({**ASSETS[0], "last_price": 171.0})
+    writer.set_quote("EURUSD", 1.21)
+    writer.set_version(1)
+    assert asyncio.run(cache.get_assets(["AAPL"]))["AAPL"]["last_price"] == 171.0
+    assert asyncio.run(cache.get_rates(["EURUSD"]))["EURUSD"] == 1.21
+    assert not cache.own_assets and not cache.own_rates
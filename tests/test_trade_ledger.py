@@ -0,0 +1,95 @@
+#Pytest
+import asyncio
+import pytest
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from tests.conftest import FakeCollection
+# Code to test
+from utils.trade_ledger import TradeLedger, ledger_time, replay
+
+# Constants
+SNAPSHOT = [{"symbol": "AAPL", "qty": 10, "cost_prices": 100}]
+START = datetime(2024, 1, 1)
+
+
+def fake_ledger(trades, trades_since_snapshot):
+    # trades, position_snapshots and portfolios collections of one portfolio
+    return SimpleNamespace(
+        trades=FakeCollection(dict(trade, _id=index) for index, trade in enumerate(trades)),
+        snapshots=FakeCollection([{"owner": "test", "name": "p1", "ts": START, "positions": SNAPSHOT, "trade_count": 0}]),
+        portfolios=FakeCollection([{"owner": "test", "name": "p1", "trades_since_snapshot": trades_since_snapshot}]),
+    )
+
+
+def test_replay_batches_in_order():
+    positions = replay(SNAPSHOT, [
+        {"batch_id": "1", "symbol": "AAPL", "side": "buy", "qty": 10, "price": 200},
+        {"batch_id": "2", "symbol": "AAPL", "side": "sell", "qty": 5, "price": 300},
+        {"batch_id": "2", "symbol": "NESN", "side": "buy", "qty": 2, "price": 90},
+    ])
+    assert positions == [
+        {"symbol": "AAPL", "qty": 15, "cost_prices": 150, "realized_pnl": 750},
+        {"symbol": "NESN", "qty": 2, "cost_prices": 90},
+    ]
+
+def test_replay_nets_a_batch_like_the_update():
+    # Bought then sold in the same batch : the sale is applied after the netted buy
+    positions = replay([], [
+        {"batch_id": "1", "symbol": "AAPL", "side": "sell", "qty": 5, "price": 120},
+        {"batch_id": "1", "symbol": "AAPL", "side": "buy", "qty": 10, "price": 100},
+    ])
+    assert positions == [{"symbol": "AAPL", "qty": 5, "cost_prices": 100, "realized_pnl": 100}]
+
+def test_replay_leaves_the_snapshot_untouched():
+    replay(SNAPSHOT, [{"batch_id": "1", "symbol": "AAPL", "side": "buy", "qty": 10, "price": 200}])
+    assert SNAPSHOT == [{"symbol": "AAPL", "qty": 10, "cost_prices": 100}]
+
+@pytest.mark.parametrize("traded_at, last_traded_at, expected", [
+    (START + timedelta(microseconds=1500), None, START + timedelta(milliseconds=1)),
+    (START, START - timedelta(seconds=1), START),
+    # Clock behind the previous batch : still after it
+    (START, START, START + timedelta(milliseconds=1)),
+    (START - timedelta(seconds=1), START, START + timedelta(milliseconds=1)),
+])
+
+def test_ledger_time_follows_the_updates(traded_at, last_traded_at, expected):
+    assert ledger_time(traded_at, last_traded_at) == expected
+
+def test_concurrent_compactions_count_once():
+    # 3 batches of 2 trades, settled : snapshot after the batch holding the 3rd trade
+    trades = [
+        {"owner": "test", "name": "p1", "batch_id": str(batch), "ts": START + timedelta(seconds=batch + 1), "symbol": "AAPL", "side": "buy", "qty": 1, "price": 100}
+        for batch in range(3) for _ in range(2)
+    ]
+    fake = fake_ledger(trades, trades_since_snapshot=6)
+    ledger = TradeLedger(fake.trades, fake.snapshots, fake.portfolios, snapshot_every=3)
+
+    async def compact_twice():
+        await asyncio.gather(ledger.compact("test", "p1"), ledger.compact("test", "p1"))
+
+    asyncio.run(compact_twice())
+    # Test case 1: Both compactions read the same latest snapshot before either writes, one stores it
+    assert [snapshot["ts"] for snapshot in fake.snapshots.documents] == [START, START + timedelta(seconds=2)]
+    assert fake.snapshots.documents[-1]["positions"] == [{"symbol": "AAPL", "qty": 14, "cost_prices": 100}]
+    assert fake.portfolios.documents[0]["trades_since_snapshot"] == 2
+    # Test case 2: Fewer settled trades than snapshot_every, left for later
+    asyncio.run(ledger.compact("test", "p1"))
+    assert len(fake.snapshots.documents) == 2
+
+def test_positions_series_matches_positions_at():
+    trades = [
+        {"owner": "test", "name": "p1", "batch_id": str(batch), "ts": START + timedelta(days=batch + 1), "symbol": symbol, "side": "buy", "qty": 1, "price": 100}
+        for batch in range(3) for symbol in ("AAPL", "NESN")
+    ]
+    fake = fake_ledger(trades, trades_since_snapshot=6)
+    fake.snapshots.documents.append({"owner": "test", "name": "p1", "ts": START + timedelta(days=2), "positions": replay(SNAPSHOT, trades[:4]), "trade_count": 4})
+    ledger = TradeLedger(fake.trades, fake.snapshots, fake.portfolios)
+    points = [START + timedelta(hours=12 * step) for step in range(-1, 9)]
+    series = asyncio.run(ledger.positions_series("test", "p1", points))
+    # Test case 1: Same positions as rebuilt point by point, the first snapshot before it
+    expected = [asyncio.run(ledger.positions_at("test", "p1", point)) or SNAPSHOT for point in points]
+    assert series == expected
+    assert [sum(position["qty"] for position in positions) for positions in series] == [10, 10, 10, 12, 12, 14, 14, 16, 16, 16]
+    # Test case 2: No history
+    fake.snapshots.documents = []
+    assert asyncio.run(ledger.positions_series("test", "p1", points)) is None
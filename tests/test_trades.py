@@ -0,0 +1,36 @@
+#Pytest
+import pytest
+# Code to test
+from utils.trades import net_trades, buy_position, sell_position
+
+# Constants
+POSITION = {"symbol": "AAPL", "qty": 10, "cost_prices": 100}
+
+
+def test_net_trades_averages_prices_by_side():
+    netted = net_trades([
+        {"symbol": "AAPL", "side": "buy", "qty": 10, "price": 200},
+        {"symbol": "AAPL", "side": "buy", "qty": 30, "price": 100},
+        {"symbol": "AAPL", "side": "sell", "qty": 5, "price": 300},
+        {"symbol": "NESN", "side": "buy", "qty": 1},
+    ])
+    assert netted["AAPL"] == {"buy": (40, 125), "sell": (5, 300)}
+    assert netted["NESN"] == {"buy": (1, None)}
+
+@pytest.mark.parametrize("qty,cost_price,expected", [
+    (10, 200, {"qty": 20, "cost_prices": 150}),
+    (-10, 200, {"qty": 0, "cost_prices": 100}),
+    (10, None, {"qty": 20, "cost_prices": None}),
+])
+
+def test_buy_position(qty, cost_price, expected):
+    assert buy_position(POSITION, qty, cost_price) == {**POSITION, **expected}
+
+@pytest.mark.parametrize("qty,expected_qty,expected_pnl", [
+    (4, 6, 200),
+    (50, 0, 500),  # Never sells more than held
+])
+
+def test_sell_position(qty, expected_qty, expected_pnl):
+    position, realized = sell_position({**POSITION, "realized_pnl": 10}, qty, 150)
+    assert (position["qty"], realized, position["realized_pnl"]) == (expected_qty, expected_pnl, 10 + expected_pnl)
@@ -0,0 +1,84 @@
+#Pytest
+import asyncio
+import pytest
+from tests.conftest import FakeCollection
+# Code to test
+from utils.price_cache import PriceCache
+from utils.valuation import PORTFOLIO_FACETS, analyze_portfolio, portfolio_analytics_pipeline
+
+# Constants
+ASSET_DATA = {
+    "AAPL": {"last_price": 150.0, "currency": "USD", "asset_class": "Equity", "geo_zone": "US"},
+    "NESN": {"last_price": 100.0, "currency": "CHF", "asset_class": "Equity", "geo_zone": "EU"},
+    "BND": {"last_price": 70.0, "currency": "USD", "asset_class": "Bond", "geo_zone": "US"},
+    "SAP": {"last_price": 120.0, "currency": "EUR", "asset_class": "Equity", "geo_zone": "EU"},
+}
+RATE_DATA = {"USDUSD": 1.0, "CHFUSD": 1.1}
+# Only quoted pairs are stored : CHFUSD is the inverse of USDCHF, EURUSD a cross rate through CHF
+STORED_QUOTES = {"USDCHF": 1 / 1.1, "EURCHF": 0.95}
+STORED_RATES = [{"_id": index, "symbol": symbol, "last_rate": last_rate} for index, (symbol, last_rate) in enumerate(STORED_QUOTES.items())]
+
+
+@pytest.fixture
+def portfolio():
+    return {
+        "name": "p1",
+        "owner": "test",
+        "portfolio_currency": "USD",
+        "portfolio_content": [
+            {"symbol": "AAPL", "qty": 10, "cost_prices": 100},
+            {"symbol": "NESN", "qty": 5, "cost_prices": 90},
+            {"symbol": "BND", "qty": 20, "cost_prices": 75},
+            {"symbol": "SAP", "qty": 3, "cost_prices": 110},  # No EURUSD rate : left out
+            {"symbol": "UNKNOWN", "qty": 1, "cost_prices": 1},  # Unknown asset : left out
+        ],
+    }
+
+def test_total(portfolio):
+    total = analyze_portfolio(portfolio, ASSET_DATA, RATE_DATA, ["total"])["total"]
+    assert total["converted_price"] == pytest.approx(1500 + 550 + 1400)
+    assert total["converted_cost_price"] == pytest.approx(1000 + 495 + 1500)
+    assert total["return"] == pytest.approx((3450 - 2995) / 2995)
+    assert (total["name"], total["owner"], total["currency"]) == ("p1", "test", "USD")
+
+@pytest.mark.parametrize("facet,key,expected", [
+    ("by_asset_class", "asset_class", {"Equity": (2050, 1495), "Bond": (1400, 1500)}),
+    ("by_geo_zone", "geo_zone", {"US": (2900, 2500), "EU": (550, 495)}),
+])
+
+def test_group_by(portfolio, facet, key, expected):
+    groups = analyze_portfolio(portfolio, ASSET_DATA, RATE_DATA, [facet])[facet]
+    assert {group[key] for group in groups} == set(expected)
+    for group in groups:
+        assert (group["converted_price"], group["converted_cost_price"]) == pytest.approx(expected[group[key]])
+
+def test_by_asset_keeps_position_order(portfolio):
+    lines = analyze_portfolio(portfolio, ASSET_DATA, RATE_DATA, ["by_asset"])["by_asset"]
+    assert [line["asset"] for line in lines] == ["AAPL", "NESN", "BND"]
+    assert lines[0]["return"] == pytest.approx(0.5)
+
+def test_missing_cost_is_skipped_like_mongo(portfolio):
+    # $multiply gives null and $sum ignores it
+    portfolio["portfolio_content"][0]["cost_prices"] = None
+    result = analyze_portfolio(portfolio, ASSET_DATA, RATE_DATA)
+    assert result["total"]["converted_cost_price"] == pytest.approx(495 + 1500)
+    assert result["by_asset"][0]["converted_cost_price"] is None
+    assert result["by_asset"][0]["return"] is None
+
+def test_zero_cost_gives_no_return(portfolio):
+    for position in portfolio["portfolio_content"]:
+        position["cost_prices"] = 0
+    assert analyze_portfolio(portfolio, ASSET_DATA, RATE_DATA, ["total"])["total"]["return"] is None
+
+def test_pipeline_values_through_the_fx_matrix(portfolio):
+    # PRICE_CACHE=0 : prices joined in Mongo, inverse and cross rates from the matrix
+    mongomock = pytest.importorskip("mongomock")
+    db = mongomock.MongoClient().db
+    db.assets.insert_many([{"symbol": symbol, **data} for symbol, data in ASSET_DATA.items()])
+    db.portfolios.insert_one(portfolio)
+    rates = asyncio.run(PriceCache(None, None, FakeCollection(STORED_RATES, "FX_rates")).rates_into("USD"))
+    assert rates["CHFUSD"] == pytest.approx(1.1) and rates["EURUSD"] == pytest.approx(0.95 * 1.1)
+    result = next(db.portfolios.aggregate(portfolio_analytics_pipeline("p1", "test", rates, PORTFOLIO_FACETS)))
+    expected = analyze_portfolio(portfolio, ASSET_DATA, {**RATE_DATA, "EURUSD": 0.95 * 1.1}, PORTFOLIO_FACETS)
+    assert result["total"][0]["converted_price"] == pytest.approx(expected["total"]["converted_price"])
+    assert [line["asset"] for line in result["by_asset"]] == ["AAPL", "NESN", "BND", "SAP"]
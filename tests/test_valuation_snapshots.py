@@ -0,0 +1,203 @@
+#Pytest
+import asyncio
+import pytest
+from bson import ObjectId
+from tests.conftest import FakeCollection
+# Code to test
+from utils.valuation import PORTFOLIO_FACETS, analyze_portfolio
+from utils.valuation_snapshots import ValuationSnapshots, pairs_touching
+
+# Constants
+ASSET_DATA = {
+    "AAPL": {"last_price": 150.0, "currency": "USD", "asset_class": "Equity", "geo_zone": "US"},
+    "NESN": {"last_price": 100.0, "currency": "CHF", "asset_class": "Equity", "geo_zone": "EU"},
+    "BND": {"last_price": 70.0, "currency": "USD", "asset_class": "Bond", "geo_zone": "US"},
+}
+RATE_DATA = {"USDUSD": 1.0, "CHFUSD": 1.1}
+UPDATED_AT = "2024-01-01T00:00:00"
+
+
+class FakePriceCache:
+    def __init__(self, version=1, on_load=None):
+        self.version = version  # read on the change stream
+        self.stored_version = version
+        self.on_load = on_load  # write landing while the market data is read
+        self.rates = dict(RATE_DATA)
+        self.moved = set()
+
+    def etag_version(self):
+        return self.version
+
+    async def load_version(self):
+        return self.stored_version
+
+    async def moved_currencies(self, pairs=()):
+        moved, self.moved = self.moved | {currency for pair in pairs for currency in (pair[:3], pair[-3:])}, set()
+        return moved
+
+    async def get_market_data(self, portfolio_list):
+        if self.on_load is not None:
+            await self.on_load()
+        return ASSET_DATA, RATE_DATA
+
+    async def get_assets(self, symbols):
+        return {symbol: ASSET_DATA[symbol] for symbol in symbols if symbol in ASSET_DATA}
+
+    async def get_rates(self, pairs):
+        return {pair: self.rates[pair] for pair in pairs if pair in self.rates}
+
+
+@pytest.fixture
+def portfolio():
+    return {
+        "name": "p1",
+        "owner": "test",
+        "portfolio_currency": "USD",
+        "portfolio_content": [
+            {"symbol": "AAPL", "qty": 10, "cost_prices": 100},
+            {"symbol": "NESN", "qty": 5, "cost_prices": 90},
+            {"symbol": "BND", "qty": 20, "cost_prices": 75},
+        ],
+    }
+
+@pytest.fixture
+def snapshots():
+    return ValuationSnapshots(collection=None, price_cache=None)
+
+def assert_same_analytics(snapshot_analytics, engine_analytics):
+    for field in ("converted_price", "converted_cost_price", "return"):
+        assert snapshot_analytics["total"][field] == pytest.approx(engine_analytics["total"][field])
+    for facet, key in (("by_asset_class", "asset_class"), ("by_geo_zone", "geo_zone")):
+        expected = {group[key]: group["converted_price"] for group in engine_analytics[facet]}
+        assert {group[key]: group["converted_price"] for group in snapshot_analytics[facet]} == pytest.approx(expected)
+    assert [line["asset"] for line in snapshot_analytics["by_asset"]] == [line["asset"] for line in engine_analytics["by_asset"]]
+
+def test_build_matches_engine(snapshots, portfolio):
+    snapshot = snapshots.build(portfolio, ASSET_DATA, RATE_DATA)
+    assert snapshot["symbols"] == ["AAPL", "BND", "NESN"]
+    assert snapshot["currency_pairs"] == ["CHFUSD", "USDUSD"]
+    assert snapshot["complete"]
+    assert_same_analytics(snapshots.analytics(snapshot), analyze_portfolio(portfolio, ASSET_DATA, RATE_DATA, PORTFOLIO_FACETS))
+
+def test_unvalued_positions_mark_the_snapshot_incomplete(snapshots, portfolio):
+    portfolio["portfolio_content"].append({"symbol": "UNKNOWN", "qty": 1, "cost_prices": 1})
+    snapshot = snapshots.build(portfolio, ASSET_DATA, RATE_DATA)
+    assert "UNKNOWN" in snapshot["symbols"]
+    assert not snapshot["complete"]
+
+@pytest.mark.parametrize("symbol,changes", [
+    ("AAPL", {"qty": 15, "cost_prices": 110}),
+    ("NESN", {"last_price": 120.0}),
+    ("NESN", {"fx_rate": 1.2}),
+    ("BND", {"qty": 0}),
+])
+
+def test_delta_matches_rebuild(snapshots, portfolio, symbol, changes):
+    snapshot = snapshots.build(portfolio, ASSET_DATA, RATE_DATA)
+    line = next(line for line in snapshot["positions"] if line["symbol"] == symbol)
+    snapshots.update_line(snapshot, line, **changes)
+    assert snapshot["deltas"] == 1
+    # Same change applied to the inputs and valued from scratch
+    asset_data = {symbol: dict(data) for symbol, data in ASSET_DATA.items()}
+    rate_data = dict(RATE_DATA)
+    position = next(position for position in portfolio["portfolio_content"] if position["symbol"] == symbol)
+    position.update({key: value for key, value in changes.items() if key in ("qty", "cost_prices")})
+    if "last_price" in changes:
+        asset_data[symbol]["last_price"] = changes["last_price"]
+    if "fx_rate" in changes:
+        rate_data[line["pair"]] = changes["fx_rate"]
+    assert_same_analytics(snapshots.analytics(snapshot), analyze_portfolio(portfolio, asset_data, rate_data, PORTFOLIO_FACETS))
+
+@pytest.mark.parametrize("extra, symbol, complete", [
+    # Already incomplete : a valued new position does not complete it
+    ({"symbol": "UNKNOWN", "qty": 1, "cost_prices": 1}, "BND", False),
+    (None, "BND", True),
+    (None, "UNKNOWN", False),
+])
+
+def test_new_position_keeps_the_complete_flag(snapshots, portfolio, extra, symbol, complete):
+    portfolio["portfolio_content"] = [position for position in portfolio["portfolio_content"] if position["symbol"] != "BND"]
+    if extra:
+        portfolio["portfolio_content"].append(extra)
+    stored = {"_id": ObjectId(), **snapshots.build(portfolio, ASSET_DATA, RATE_DATA)}
+    snapshots = ValuationSnapshots(FakeCollection([stored]), FakePriceCache())
+    asyncio.run(snapshots.apply_trades("test", "p1", [{"symbol": symbol, "qty": 20, "cost_prices": 75}]))
+    snapshot = asyncio.run(snapshots.get("test", "p1"))
+    assert symbol in snapshot["symbols"]
+    assert snapshot["complete"] is complete
+
+def test_batch_of_trades_written_once(snapshots, portfolio):
+    portfolio["portfolio_content"] = [position for position in portfolio["portfolio_content"] if position["symbol"] != "BND"]
+    stored = {"_id": ObjectId(), **snapshots.build(portfolio, ASSET_DATA, RATE_DATA)}
+    snapshots = ValuationSnapshots(FakeCollection([stored]), FakePriceCache())
+    traded = [
+        {"symbol": "AAPL", "qty": 15, "cost_prices": 110},
+        {"symbol": "NESN", "qty": 0, "cost_prices": 90},
+        {"symbol": "BND", "qty": 20, "cost_prices": 75},
+    ]
+    asyncio.run(snapshots.apply_trades("test", "p1", traded))
+    assert snapshots.collection.bulk_writes == 1
+    snapshot = asyncio.run(snapshots.get("test", "p1"))
+    assert snapshot["complete"] and snapshot["deltas"] == 3
+    # Same positions valued from scratch, new ones appended as in portfolio_content
+    portfolio["portfolio_content"] = traded
+    assert_same_analytics(snapshots.analytics(snapshot), analyze_portfolio(portfolio, ASSET_DATA, RATE_DATA, PORTFOLIO_FACETS))
+
+@pytest.mark.parametrize("version, change, stored", [
+    (1, None, True),
+    # Not following the change stream : prices may be stale
+    (None, None, False),
+    # A price or rate write, or a trade, landed while building
+    (1, "market", False),
+    # Bumped in Mongo, not on the stream of this worker yet
+    (1, "stored market", False),
+    (1, "portfolio", False),
+])
+
+def test_rebuild_stores_unchanged_valuations(portfolio, version, change, stored):
+    portfolio["last_updated_at"] = UPDATED_AT
+    portfolios = FakeCollection([portfolio])
+
+    async def on_load():
+        if change == "market":
+            price_cache.version += 1
+            price_cache.stored_version += 1
+        elif change == "stored market":
+            price_cache.stored_version += 1
+        elif change == "portfolio":
+            portfolios.documents[0]["last_updated_at"] = "2024-01-02T00:00:00"
+
+    price_cache = FakePriceCache(version, on_load)
+    snapshots = ValuationSnapshots(FakeCollection(), price_cache, portfolios=portfolios)
+    snapshot = asyncio.run(snapshots.rebuild(portfolio))
+    assert snapshot["total"]["converted_price"] == pytest.approx(150 * 10 + 100 * 1.1 * 5 + 70 * 20)
+    assert (asyncio.run(snapshots.get("test", "p1")) is not None) is stored
+
+def test_rebuild_never_overwrites_a_stored_snapshot(snapshots, portfolio):
+    portfolio["last_updated_at"] = UPDATED_AT
+    stored = {"_id": ObjectId(), **snapshots.build(portfolio, ASSET_DATA, RATE_DATA), "write_id": "newer"}
+    snapshots = ValuationSnapshots(FakeCollection([stored]), FakePriceCache(), portfolios=FakeCollection([portfolio]))
+    asyncio.run(snapshots.rebuild(portfolio))
+    assert [document["write_id"] for document in snapshots.collection.documents] == ["newer"]
+
+@pytest.mark.parametrize("pair, touched", [("EURUSD", True), ("CHFEUR", True), ("GBPJPY", False), ("EURGBP", True), ("XEURXX", False)])
+def test_pairs_touching_a_fixing(pair, touched):
+    patterns = pairs_touching({"EUR", "CHF"})["currency_pairs"]["$in"]
+    assert any(pattern.search(pair) for pattern in patterns) is touched
+
+def test_rates_applied_to_the_holders_of_moved_currencies(snapshots, portfolio):
+    usd_only = dict(portfolio, name="p2", portfolio_content=[{"symbol": "AAPL", "qty": 10, "cost_prices": 100}])
+    stored = [{"_id": ObjectId(), **snapshots.build(held, ASSET_DATA, RATE_DATA)} for held in (portfolio, usd_only)]
+    snapshots = ValuationSnapshots(FakeCollection(stored), FakePriceCache())
+    snapshots.price_cache.rates["CHFUSD"] = 1.2
+    # Test case 1: Only the holders of a CHF pair are read and written
+    asyncio.run(snapshots.apply_rates(["CHFUSD"]))
+    chf, usd = snapshots.collection.documents
+    assert chf["fx_rates"]["CHFUSD"] == 1.2 and chf["deltas"] == 1
+    assert chf["total"]["converted_price"] == pytest.approx(150 * 10 + 100 * 1.2 * 5 + 70 * 20)
+    assert usd == stored[1] and snapshots.collection.bulk_writes == 1
+    # Test case 2: Rates triangulated through the quote move with it
+    snapshots.price_cache.rates["CHFUSD"] = 1.3
+    snapshots.price_cache.moved = {"CHF"}
+    asyncio.run(snapshots.apply_rates(["EURUSD"]))
+    assert snapshots.collection.documents[0]["fx_rates"]["CHFUSD"] == 1.3
@@ -0,0 +1,43 @@
+import os
+from functools import lru_cache
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import OperationFailure
+
+from utils.secret_tools import get_secret
+from utils.metrics import CommandMetrics, PoolMetrics
+
+DATABASE_NAME = os.environ.get("MONGO_DATABASE", "AssetVision")
+ILLEGAL_OPERATION = 20  # error code of a transaction sent to a standalone mongod
+# False once the server turned a transaction down
+transactions_supported = True
+
+
+# One pooled client per process, shared by every module. Motor connects on the first query, so
+# building it costs nothing at import.
+@lru_cache(maxsize=None)
+def get_client():
+    return AsyncIOMotorClient(
+        get_secret("mongodb_str"),
+        maxPoolSize=int(os.environ.get("MONGO_MAX_POOL_SIZE", 100)),
+        minPoolSize=int(os.environ.get("MONGO_MIN_POOL_SIZE", 0)),
+        # Command timings and pool waits exported on /metrics
+        event_listeners=[CommandMetrics(), PoolMetrics()],
+    )
+
+def get_db():
+    return get_client()[DATABASE_NAME]
+
+async def in_transaction(callback):
+    # callback(session) in one multi-document transaction, run again on transient errors. A standalone
+    # mongod (development) has no transactions : callback then runs with session None, write after write.
+    global transactions_supported
+    if transactions_supported:
+        async with await get_client().start_session() as session:
+            try:
+                return await session.with_transaction(callback)
+            except OperationFailure as e:
+                if e.code != ILLEGAL_OPERATION:
+                    raise
+                transactions_supported = False
+    return await callback(None)
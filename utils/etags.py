@@ -0,0 +1,46 @@
+import hashlib
+
+from fastapi import Response
+
+# Polled by the browser only : it keeps the response and revalidates it on every request
+PRIVATE_CACHE_CONTROL = "private, no-cache"
+# Every cached response depends on the bearer token : a shared cache keys it on the Authorization header,
+# a request with another token or none at all never gets it
+VARY = "Authorization"
+
+
+# Conditional GET : the ETag names the state the response was built from, a matching If-None-Match
+# is answered with a bodyless 304 before any query runs
+def make_etag(*parts):
+    digest = hashlib.sha1("\x1f".join(str(part) for part in parts).encode()).hexdigest()
+    return f'"{digest[:32]}"'
+
+def etag_matches(if_none_match, etag):
+    # Weak comparison (RFC 9110) : W/"x" matches "x", * matches any current representation
+    if not if_none_match or etag is None:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate in ("*", etag):
+            return True
+    return False
+
+def shared_cache_control(max_age: int):
+    # Opt-in CDN mode : max_age > 0 lets a CDN serve the response for that long, per Authorization header,
+    # browsers always revalidate
+    return f"public, max-age=0, s-maxage={max_age}" if max_age > 0 else PRIVATE_CACHE_CONTROL
+
+def cache_headers(etag, cache_control):
+    return {"ETag": etag, "Cache-Control": cache_control, "Vary": VARY}
+
+def not_modified(etag, cache_control):
+    return Response(status_code=304, headers=cache_headers(etag, cache_control))
+
+def with_cache_headers(result, response, etag, cache_control):
+    # result is either the body (headers go to the injected response) or a Response, e.g. a stream
+    if etag is not None:
+        headers = result.headers if isinstance(result, Response) else response.headers
+        headers.update(cache_headers(etag, cache_control))
+    return result
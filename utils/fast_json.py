@@ -0,0 +1,54 @@
+import json
+import math
+from datetime import date, datetime
+
+from bson import Decimal128, ObjectId
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:  # Optional : the standard library encoder is used instead
+    orjson = None
+
+
+# Documents and analytics encoded straight to JSON bytes, without building models or going through
+# FastAPI's jsonable_encoder. Output matches it : ObjectId as a string, datetime in ISO 8601.
+def bson_default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Decimal128):
+        return float(value.to_decimal())
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if hasattr(value, "tolist"):  # numpy scalars and arrays
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def finite(content):
+    # null instead of NaN and Infinity, as orjson writes them
+    if isinstance(content, float):
+        return content if math.isfinite(content) else None
+    if isinstance(content, dict):
+        return {key: finite(value) for key, value in content.items()}
+    if isinstance(content, (list, tuple)):
+        return [finite(value) for value in content]
+    return content
+
+def finite_default(value):
+    return finite(bson_default(value))
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=bson_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    try:
+        return json.dumps(content, default=finite_default, ensure_ascii=False, separators=(",", ":"), allow_nan=False).encode()
+    except ValueError:
+        # Non-finite floats are rare : the document is only copied when one is found
+        return json.dumps(finite(content), default=finite_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dumps(content)
@@ -0,0 +1,42 @@
+import math
+
+from pymongo import UpdateOne
+
+
+# FX fixings : a whole set of quotes written in one bulk_write with a single timestamp
+def inverse(pair: str) -> str:
+    return pair[-3:] + pair[:3]
+
+def invalid_pairs(fixing_rates):
+    # Pairs of two currency codes (6 capital letters) quoted at a finite, positive rate
+    return sorted(
+        pair for pair, rate in fixing_rates.items()
+        if not (len(pair) == 6 and pair.isalpha() and pair.isupper()) or not (math.isfinite(rate) and rate > 0)
+    )
+
+def fixing_operations(fixing_rates, username: str, updated_at):
+    operations = []
+    for pair, last_rate in fixing_rates.items():
+        operations.append(UpdateOne(
+            {"symbol": pair},
+            {
+                "$set": {"last_rate": last_rate, "last_updated_by": username, "last_updated_at": updated_at},
+                "$setOnInsert": {"base_currency": pair[:3], "target_currency": pair[-3:], "created_by": username, "created_at": updated_at},
+            },
+            upsert=True
+        ))
+        # Inverse pairs stored by older versions of the API are kept in sync, never created.
+        # A pair quoted with its inverse keeps both quotes as given.
+        if inverse(pair) not in fixing_rates:
+            operations.append(UpdateOne(
+                {"symbol": inverse(pair)},
+                {"$set": {"last_rate": 1/last_rate, "last_updated_by": username, "last_updated_at": updated_at}}
+            ))
+    return operations
+
+def apply_fixing(price_cache, fixing_rates):
+    # Applied without yielding to the event loop : no valuation of this worker sees half a fixing
+    for pair, last_rate in fixing_rates.items():
+        price_cache.set_rate({"symbol": pair, "last_rate": last_rate})
+        if inverse(pair) not in fixing_rates and inverse(pair) in price_cache.fx.quotes:
+            price_cache.set_rate({"symbol": inverse(pair), "last_rate": 1/last_rate})
@@ -0,0 +1,107 @@
+from collections import deque
+
+
+class FxMatrix:
+    """Cross rates between every pair of currencies derived from the stored FX quotes.
+
+    Each currency is valued against the root of its connected component (the base currency when
+    it is quoted) by walking the quote graph, so any cross rate is value[a] / value[b] and one
+    stored quote per currency is enough. Direct quotes, or their inverse, are used as is when
+    they exist. Values are rebuilt from the quotes held in memory after a change, without
+    reading the database again.
+
+    moved collects the currencies whose rates may have changed, until take_moved : the ones of
+    the changed quotes and the ones valued differently by a rebuild. A cross rate triangulated
+    through a changed quote moves with it, whatever its own currencies.
+    """
+
+    def __init__(self, base: str = "USD"):
+        self.base = base
+        self.quotes = {}  # "EURUSD" -> 1.08 : 1 EUR = 1.08 USD
+        self.values = {}  # currency -> (component root, value of one unit in the root currency)
+        self.dirty = False
+        self.version = 0
+        self.moved = set()
+
+    def _moved_quotes(self, pairs):
+        self.moved.update(currency for pair in pairs for currency in (pair[:3], pair[-3:]))
+
+    def load(self, quotes):
+        quotes = {pair: rate for pair, rate in quotes.items() if rate}
+        self._moved_quotes(pair for pair in quotes.keys() | self.quotes.keys() if quotes.get(pair) != self.quotes.get(pair))
+        self.quotes = quotes
+        self.dirty = True
+        self.version += 1
+
+    def set_quote(self, pair: str, rate):
+        self._moved_quotes([pair])
+        if rate:
+            self.quotes[pair] = rate
+        else:
+            self.quotes.pop(pair, None)
+        self.dirty = True
+        self.version += 1
+
+    def remove_quote(self, pair: str):
+        if self.quotes.pop(pair, None) is not None:
+            self._moved_quotes([pair])
+            self.dirty = True
+            self.version += 1
+
+    def _rebuild(self):
+        neighbours = {}
+        for pair, rate in self.quotes.items():
+            base, target = pair[:3], pair[-3:]
+            neighbours.setdefault(base, []).append((target, rate))
+            neighbours.setdefault(target, []).append((base, 1 / rate))
+        values = {}
+        roots = [self.base] if self.base in neighbours else []
+        roots += sorted(neighbours)
+        for root in roots:
+            if root in values:
+                continue
+            values[root] = (root, 1.0)
+            queue = deque([root])
+            while queue:
+                currency = queue.popleft()
+                value = values[currency][1]
+                for neighbour, rate in neighbours[currency]:
+                    if neighbour not in values:
+                        # 1 currency = rate neighbour
+                        values[neighbour] = (root, value / rate)
+                        queue.append(neighbour)
+        self.moved.update(currency for currency in values.keys() | self.values.keys() if values.get(currency) != self.values.get(currency))
+        self.values = values
+        self.dirty = False
+
+    def rate(self, base: str, target: str):
+        if base == target:
+            return 1.0
+        if (direct := self.quotes.get(base + target)) is not None:
+            return direct
+        if (inverse := self.quotes.get(target + base)) is not None:
+            return 1 / inverse
+        if self.dirty:
+            self._rebuild()
+        base_value, target_value = self.values.get(base), self.values.get(target)
+        if base_value is None or target_value is None or base_value[0] != target_value[0]:
+            return None
+        return base_value[1] / target_value[1]
+
+    def rates(self, pairs):
+        found = {}
+        for pair in pairs:
+            if (rate := self.rate(pair[:3], pair[-3:])) is not None:
+                found[pair] = rate
+        return found
+
+    def take_moved(self):
+        if self.dirty:
+            self._rebuild()
+        moved, self.moved = self.moved, set()
+        return moved
+
+    def currencies(self):
+        if self.dirty:
+            self._rebuild()
+        return sorted(self.values)
@@ -0,0 +1,65 @@
+import csv
+import json
+
+
+# Streamed uploads : rows are parsed as the body arrives instead of buffering the whole file
+async def read_lines(stream):
+    buffer = b""
+    async for chunk in stream:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line
+    if buffer:
+        yield buffer
+
+async def parse_rows(stream, content_type: str = "application/x-ndjson"):
+    # Yields (line number, row dict or None, error or None). CSV needs a header line.
+    is_csv = "csv" in (content_type or "")
+    header = None
+    line_number = 0
+    async for line in read_lines(stream):
+        line_number += 1
+        line = line.decode("utf-8-sig").strip()
+        if not line:
+            continue
+        try:
+            if is_csv:
+                values = next(csv.reader([line]))
+                if header is None:
+                    header = [value.strip() for value in values]
+                    continue
+                row = dict(zip(header, (value.strip() for value in values)))
+            else:
+                row = json.loads(line)
+                if not isinstance(row, dict):
+                    raise ValueError("Expected a JSON object")
+        except (ValueError, csv.Error) as e:
+            yield line_number, None, str(e)
+            continue
+        yield line_number, row, None
+
+async def chunked(rows, size: int):
+    chunk = []
+    async for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def latest_rows(rows, key):
+    # Last row of each key, in upload order : the operations of an unordered bulk_write may run in any order
+    latest = {}
+    for row in rows:
+        latest.pop(key(row), None)
+        latest[key(row)] = row
+    return list(latest.values())
+
+def write_errors(exc, operation_lines):
+    # Map the errors of an unordered bulk_write back to the upload lines
+    return [
+        {"line": operation_lines[error["index"]], "error": error.get("errmsg", "Write error")}
+        for error in exc.details.get("writeErrors", [])
+    ]
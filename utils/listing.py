@@ -0,0 +1,92 @@
+import json
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+
+from utils.fast_json import FastJSONResponse, dumps
+
+NDJSON_BATCH_SIZE = 500
+
+
+# Keyset pagination : the next page starts strictly after the sort key of the last item returned,
+# so every page is an index range scan whatever its depth
+def keyset_filter(fields, values):
+    clauses = []
+    for i, field in enumerate(fields):
+        clause = {previous: values[j] for j, previous in enumerate(fields[:i])}
+        clause[field] = {"$gt": values[i]}
+        clauses.append(clause)
+    return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
+async def ndjson_lines(cursor, to_item, fast: bool = False):
+    async for document in cursor:
+        if fast:
+            yield dumps(to_item(document)) + b"\n"
+        else:
+            yield json.dumps(jsonable_encoder(to_item(document))) + "\n"
+
+async def list_documents(collection, fields, after, limit, stream: bool, to_item, response, query=None, projection=None, fast: bool = False):
+    # after holds the sort key values of the last item of the previous page, None for the first page
+    query = dict(query or {})
+    if after is not None:
+        query = {"$and": [query, keyset_filter(fields, after)]} if query else keyset_filter(fields, after)
+    cursor = collection.find(query, projection).sort([(field, 1) for field in fields]).batch_size(NDJSON_BATCH_SIZE)
+    if limit:
+        cursor = cursor.limit(limit)
+    if stream:
+        # Documents are encoded as the cursor batches arrive : memory stays flat whatever the size
+        return StreamingResponse(ndjson_lines(cursor, to_item, fast), media_type="application/x-ndjson")
+    documents = await cursor.to_list(length=None)
+    if fast:
+        # Encoded here : the headers go to the returned response
+        response = FastJSONResponse([to_item(document) for document in documents])
+    if limit and len(documents) == limit:
+        # One header per query parameter, values passed back unchanged : X-Next-After-Owner is after_owner,
+        # X-Next-After the last sort field
+        for field in fields[:-1]:
+            response.headers["X-Next-After-" + field.capitalize()] = str(documents[-1].get(field))
+        response.headers["X-Next-After"] = str(documents[-1].get(fields[-1]))
+    return response if fast else [to_item(document) for document in documents]
+
+async def list_models(collection, model, fields, after, limit, stream: bool, response, fast: bool = False):
+    # fast : the model fields are read as they are stored and encoded without building the models
+    if fast:
+        return await list_documents(collection, fields, after, limit, stream, model_document(model), response, projection=model_projection(model), fast=True)
+    return await list_documents(collection, fields, after, limit, stream, lambda document: model(**document), response)
+
+# Server side projections : fields=symbol,last_price becomes {"_id": 0, "symbol": 1, "last_price": 1}
+def model_field_names(model):
+    return set(getattr(model, "model_fields", None) or model.__fields__)
+
+def model_projection(model):
+    return {"_id": 0, **{field: 1 for field in model_field_names(model)}}
+
+def model_document(model):
+    # Documents shaped as the model would return them, unvalidated : missing fields get their default
+    fields = getattr(model, "model_fields", None) or model.__fields__
+    template = {
+        name: None if (field.is_required() if hasattr(field, "is_required") else field.required) else field.default
+        for name, field in fields.items()
+    }
+    return lambda document: {**template, **document}
+
+def fields_projection(fields, allowed, expand=None, required=()):
+    # None when no fields are requested : the caller returns full, validated models
+    if not fields:
+        return None
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    expand = expand or {}
+
+    def known(field):
+        # Nested paths of an expanded field stay within its expansion
+        top = field.split(".")[0]
+        if top not in allowed:
+            return False
+        return top not in expand or field == top or any(field == path or field.startswith(path + ".") for path in expand[top])
+
+    if unknown := sorted(field for field in requested if not known(field)):
+        raise HTTPException(status_code=400, detail=f"Unknown fields : {unknown}")
+    paths = {projected for field in list(requested) + list(required) for projected in expand.get(field, [field])}
+    # A path inside another projected one is a path collision for Mongo
+    return {"_id": 0, **{path: 1 for path in sorted(paths) if not any(path.startswith(other + ".") for other in paths)}}
@@ -0,0 +1,184 @@
+import asyncio
+import logging
+
+from utils.fast_json import dumps
+
+logger = logging.getLogger(__name__)
+
+
+def sse_event(event: str, data):
+    return b"event: " + event.encode() + b"\ndata: " + dumps(data) + b"\n\n"
+
+NOT_FOUND = sse_event("error", {"detail": "Portfolio not found"})
+KEEP_ALIVE = b": keep-alive\n\n"
+KEEP_ALIVE_EVERY = 15  # seconds without a value before a comment line keeps proxies from closing the stream
+
+
+class Mailbox:
+    """Latest message for one subscriber : a slow reader skips the values it had no time to read."""
+
+    def __init__(self):
+        self.message = None
+        self.event = asyncio.Event()
+
+    def put(self, message):
+        self.message = message
+        self.event.set()
+
+    async def get(self, timeout: float):
+        # None when nothing came within timeout
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        self.event.clear()
+        message, self.message = self.message, None
+        return message
+
+
+class Channel:
+    def __init__(self):
+        self.subscribers = set()
+        self.symbols = set()
+        self.fx_sensitive = False  # holds assets in another currency : any quote can move a cross rate
+        self.last = None
+
+
+class ValuationHub:
+    """Live valuations of the portfolios followed by subscribers, keyed by (owner, name, facets).
+
+    Writes mark the channels depending on them dirty : symbols through an index of the held
+    symbols, FX quotes for every portfolio holding another currency, trades for their portfolio.
+    Every tick each dirty channel is computed once and the same encoded message is handed to all
+    its subscribers, only when it changed. compute(owner, name, facets) returns the message data,
+    the symbols and the currency pairs of the portfolio, or None when it does not exist.
+
+    Writes of this worker are published by the handlers once their side effects are stored.
+    Changes made by other workers, seen on the price cache change stream, are held until the
+    market version moves : it is bumped after their valuation snapshots are updated. When
+    changes are not followed one by one (shared price table), a new market version marks every
+    channel dirty.
+    """
+
+    def __init__(self, compute, tick: float = 0.25, market_version=None, changes_followed: bool = True):
+        self.compute = compute
+        self.tick = tick
+        self.market_version = market_version
+        self.changes_followed = changes_followed
+        self.channels = {}
+        self.by_symbol = {}  # symbol -> channel keys
+        self.by_portfolio = {}  # name -> channel keys
+        self.dirty = set()
+        self.fx_dirty = False
+        self.pending_symbols = set()
+        self.pending_fx = False
+        self.seen_version = None
+        self.computations = 0
+
+    # Subscriptions
+    async def subscribe(self, key):
+        mailbox = Mailbox()
+        if (channel := self.channels.get(key)) is None:
+            channel = self.channels[key] = Channel()
+            self.by_portfolio.setdefault(key[1], set()).add(key)
+            channel.subscribers.add(mailbox)
+            await self.refresh(key)
+        else:
+            channel.subscribers.add(mailbox)
+            if channel.last is not None:
+                mailbox.put(channel.last)
+        return mailbox
+
+    def unsubscribe(self, key, mailbox):
+        if (channel := self.channels.get(key)) is None:
+            return
+        channel.subscribers.discard(mailbox)
+        if not channel.subscribers:
+            self.drop(key)
+
+    def drop(self, key):
+        channel = self.channels.pop(key)
+        self.index(key, channel, set())
+        self.by_portfolio[key[1]].discard(key)
+        if not self.by_portfolio[key[1]]:
+            del self.by_portfolio[key[1]]
+
+    def index(self, key, channel, symbols):
+        for symbol in channel.symbols - symbols:
+            self.by_symbol[symbol].discard(key)
+            if not self.by_symbol[symbol]:
+                del self.by_symbol[symbol]
+        for symbol in symbols - channel.symbols:
+            self.by_symbol.setdefault(symbol, set()).add(key)
+        channel.symbols = symbols
+
+    # Changes
+    def publish_prices(self, symbols):
+        for symbol in symbols:
+            self.dirty.update(self.by_symbol.get(symbol, ()))
+
+    def publish_rates(self):
+        self.fx_dirty = True
+
+    def publish_portfolio(self, name: str, owner=None):
+        # Every owner when not given : portfolios are updated and deleted by name
+        self.dirty.update(key for key in self.by_portfolio.get(name, ()) if owner is None or key[0] == owner)
+
+    def market_changed(self, kind: str, key: str):
+        # Change stream listener of the price cache : applied once the market version moves
+        if kind == "asset":
+            self.pending_symbols.add(key)
+        else:
+            self.pending_fx = True
+
+    # Ticks
+    async def refresh(self, key):
+        try:
+            result = await self.compute(*key)
+        except Exception:
+            # Retried on the next tick : a database error or a malformed document never stops the other channels
+            logger.exception("Live valuation of %s failed", key)
+            self.dirty.add(key)
+            return
+        self.computations += 1
+        if (channel := self.channels.get(key)) is None:
+            return
+        if result is None:
+            for mailbox in channel.subscribers:
+                mailbox.put(NOT_FOUND)
+            self.drop(key)
+            return
+        data, symbols, pairs = result
+        self.index(key, channel, set(symbols))
+        channel.fx_sensitive = any(pair[:3] != pair[3:] for pair in pairs)
+        if (message := sse_event("valuation", data)) != channel.last:
+            channel.last = message
+            for mailbox in channel.subscribers:
+                mailbox.put(message)
+
+    def take_dirty(self):
+        if self.market_version is not None and (version := self.market_version()) != self.seen_version:
+            self.seen_version = version
+            if not self.changes_followed:
+                self.dirty.update(self.channels)
+            self.publish_prices(self.pending_symbols)
+            self.fx_dirty |= self.pending_fx
+            self.pending_symbols, self.pending_fx = set(), False
+        if self.fx_dirty:
+            self.dirty.update(key for key, channel in self.channels.items() if channel.fx_sensitive)
+        keys = self.dirty & set(self.channels)
+        self.dirty, self.fx_dirty = set(), False
+        return keys
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            # Each portfolio computed once per tick, whatever the number of changes and subscribers
+            await asyncio.gather(*(self.refresh(key) for key in self.take_dirty()))
+
+    def stats(self):
+        return {
+            "channels": len(self.channels),
+            "subscribers": sum(len(channel.subscribers) for channel in self.channels.values()),
+            "computations": self.computations,
+        }
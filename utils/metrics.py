@@ -0,0 +1,208 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from fastapi.routing import APIRoute
+from pymongo import monitoring
+
+# Seconds, from a fast find_one to a slow aggregation
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class Metric:
+    # Children are keyed by their label values. Pymongo listeners run in Motor's threads : updates are locked.
+    kind = None
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines += self.render_child(label_values, value)
+        return lines
+
+    def render_child(self, label_values, value):
+        return [f"{self.name}{format_labels(self.labels, label_values)} {value}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, *label_values, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *label_values):
+        with self.lock:
+            # Per bucket counts (the last one is +Inf), sum
+            child = self.values.setdefault(label_values, [[0] * (len(self.buckets) + 1), 0.0])
+            child[0][bisect.bisect_left(self.buckets, value)] += 1
+            child[1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def render_child(self, label_values, value):
+        counts, total = value
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(float(bound))
+            lines.append(f"{self.name}_bucket{format_labels(self.labels + ('le',), label_values + (le,))} {cumulative}")
+        lines.append(f"{self.name}_sum{format_labels(self.labels, label_values)} {total}")
+        lines.append(f"{self.name}_count{format_labels(self.labels, label_values)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        # Prometheus text exposition format
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+registry = Registry()
+http_requests = registry.register(Counter("http_requests_total", "HTTP requests by route, method and status.", ("method", "route", "status")))
+http_request_duration = registry.register(Histogram("http_request_duration_seconds", "Time to the response headers, by route.", ("method", "route")))
+http_requests_in_progress = registry.register(Gauge("http_requests_in_progress", "Requests being handled, by route.", ("method", "route")))
+mongodb_command_duration = registry.register(Histogram("mongodb_command_duration_seconds", "MongoDB command round trips, by collection and command.", ("collection", "command")))
+mongodb_command_failures = registry.register(Counter("mongodb_command_failures_total", "Failed MongoDB commands, by collection and command.", ("collection", "command")))
+mongodb_pool_wait = registry.register(Histogram("mongodb_pool_checkout_wait_seconds", "Time waited for a pooled connection."))
+mongodb_pool_checkout_failures = registry.register(Counter("mongodb_pool_checkout_failures_total", "Connection checkouts that failed, by reason.", ("reason",)))
+bcrypt_duration = registry.register(Histogram("bcrypt_duration_seconds", "bcrypt hashing and checks, by operation.", ("operation",), buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 1, 2)))
+# Callables (collection, command, seconds) also told about every completed command, e.g. a running request profile
+command_observers = []
+
+
+class MetricsRoute(APIRoute):
+    # Requests in flight counted once routed : the route template is known without matching the path again
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def counted_handler(request):
+            labels = (request.method, self.path)
+            http_requests_in_progress.inc(*labels)
+            try:
+                return await handler(request)
+            finally:
+                http_requests_in_progress.dec(*labels)
+        return counted_handler
+
+
+class CommandMetrics(monitoring.CommandListener):
+    # The collection is only known from the started event : kept until the command completes
+    def __init__(self):
+        self.collections = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(event):
+        return event.connection_id, event.request_id
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            # Next batch of a cursor : the collection is a separate field
+            target = event.command.get("collection")
+        with self.lock:
+            self.collections[self.key(event)] = target if isinstance(target, str) else ""
+
+    def _collection(self, event):
+        with self.lock:
+            return self.collections.pop(self.key(event), "")
+
+    def completed(self, event, collection):
+        seconds = event.duration_micros / 1e6
+        mongodb_command_duration.observe(seconds, collection, event.command_name)
+        for observer in command_observers:
+            observer(collection, event.command_name, seconds)
+
+    def succeeded(self, event):
+        self.completed(event, self._collection(event))
+
+    def failed(self, event):
+        collection = self._collection(event)
+        self.completed(event, collection)
+        mongodb_command_failures.inc(collection, event.command_name)
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    def connection_checked_out(self, event):
+        # duration : pymongo >= 4.7
+        if (duration := getattr(event, "duration", None)) is not None:
+            mongodb_pool_wait.observe(duration)
+
+    def connection_check_out_failed(self, event):
+        mongodb_pool_checkout_failures.inc(event.reason)
+
+    # The other pool events are not measured
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
@@ -0,0 +1,309 @@
+import asyncio
+import time
+
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+from utils.fx_matrix import FxMatrix
+
+ASSET_FIELDS = ("symbol", "last_price", "currency", "asset_class", "geo_zone")
+
+
+class PriceCache:
+    """In-process copy of the asset prices and FX rates used to value portfolios.
+
+    Assets are loaded on demand with a single $in query per batch of misses. FX quotes are loaded
+    all at once into an FxMatrix which derives every cross rate from them. Entries are refreshed
+    by the write endpoints of this process and by a MongoDB change stream for writes made
+    elsewhere. max_age bounds how long an entry can be served if the change stream is down.
+
+    Writers bump a market version shared by every worker (one counter document in versions) once
+    their prices or rates are stored. The stream delivers each bump after the changes made before
+    it, so while it runs the cache holds every change up to version : ETags built on it never
+    describe prices newer than the ones served.
+
+    With a SharedPriceTable (shared), prices and quotes are read from the table another process
+    keeps in line with Mongo, and this cache only holds the misses and the writes of this worker.
+    Those writes are served from here until the table reaches the market version they were
+    published with, or for max_age seconds.
+    """
+
+    def __init__(self, db, assets, rates, max_age: float = 60, base_currency: str = "USD", versions=None, shared=None):
+        self.db = db
+        self.assets_collection = assets
+        self.rates_collection = rates
+        self.versions_collection = versions
+        self.version = None  # market version of the data cached, None when not following the stream
+        self.shared = shared
+        self.own_assets = {}  # symbol -> [written_at, market version or None until published]
+        self.own_rates = {}  # pair -> [written_at, market version or None, rate or None when removed]
+        self.fx_synced = None  # fx_seq of the shared table self.fx was built from
+        self.max_age = max_age
+        self.assets = {}  # symbol -> (loaded_at, {last_price, currency, asset_class, geo_zone})
+        self.fx = FxMatrix(base_currency)
+        self.fx_loaded_at = None
+        self.ids = {}  # Mongo _id -> (collection name, key), to resolve delete events
+        self.generation = 0  # bumped on every invalidation, so an in-flight load never stores stale data
+        self.watching = False
+        self.listeners = []  # called with ("asset" or "rate", symbol) for every change read on the stream
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.invalidations = 0
+
+    # Lookups
+    def _lookup(self, store, keys):
+        found, missing = {}, []
+        now = time.monotonic()
+        for key in keys:
+            entry = store.get(key)
+            if entry is None:
+                self.misses += 1
+                missing.append(key)
+            elif now - entry[0] > self.max_age:
+                self.stale += 1
+                missing.append(key)
+            else:
+                self.hits += 1
+                found[key] = entry[1]
+        return found, missing
+
+    def _shared(self):
+        # The shared table, when its owner is alive and has loaded it
+        if self.shared is not None and self.shared.ready(self.max_age):
+            return self.shared
+        return None
+
+    def _own_write(self, writes, key, shared):
+        # True while the table may not hold the write of this worker yet
+        if (write := writes.get(key)) is None:
+            return False
+        if time.monotonic() - write[0] <= self.max_age and (write[1] is None or (shared.version() or 0) < write[1]):
+            return True
+        del writes[key]
+        return False
+
+    def _sync_fx(self, shared):
+        # Matrix rebuilt when the table quotes changed, with the writes of this worker on top
+        if (fx_seq := shared.fx_seq()) == self.fx_synced or (quotes := shared.get_quotes()) is None:
+            return
+        for pair in list(self.own_rates):
+            if self._own_write(self.own_rates, pair, shared):
+                quotes[pair] = self.own_rates[pair][2]
+        self.fx.load({pair: rate for pair, rate in quotes.items() if rate is not None})
+        self.fx_synced = fx_seq
+
+    async def get_assets(self, symbols):
+        found = {}
+        if (shared := self._shared()) is not None:
+            symbols = set(symbols)
+            in_table = {symbol for symbol in symbols if not self._own_write(self.own_assets, symbol, shared)}
+            if (found := shared.get_assets(in_table)) is not None:
+                self.hits += len(found)
+                symbols -= set(found)
+            else:
+                found = {}
+        cached, missing = self._lookup(self.assets, symbols)
+        found.update(cached)
+        if missing:
+            generation = self.generation
+            cursor = self.assets_collection.find({"symbol": {"$in": missing}}, {field: 1 for field in ASSET_FIELDS})
+            async for doc in cursor:
+                found[doc["symbol"]] = self._store_asset(doc, generation)
+        return found
+
+    async def resolve_symbols(self, symbols):
+        # symbol -> asset _id for a whole list, one $in query for the misses. Also returns the unknown symbols.
+        symbols = set(symbols)
+        found = await self.get_assets(symbols)
+        return {symbol: asset["asset_id"] for symbol, asset in found.items()}, sorted(symbols - set(found))
+
+    async def get_rates(self, pairs):
+        # Direct, inverse or triangulated rate for each pair, pairs without any path are left out
+        pairs = list(pairs)
+        if (shared := self._shared()) is not None:
+            self.hits += len(pairs)
+            self._sync_fx(shared)
+            return self.fx.rates(pairs)
+        if self.fx_loaded_at is None:
+            self.misses += len(pairs)
+            await self.load_rates()
+        elif time.monotonic() - self.fx_loaded_at > self.max_age:
+            self.stale += len(pairs)
+            await self.load_rates()
+        else:
+            self.hits += len(pairs)
+        return self.fx.rates(pairs)
+
+    async def rates_into(self, currency: str):
+        # Rate of every quoted currency into currency, with the same freshness as get_rates
+        await self.get_rates([currency + currency])
+        return self.fx.rates(other + currency for other in self.fx.currencies() + [currency])
+
+    async def moved_currencies(self, pairs=()):
+        # Currencies whose rates may have changed since the last call, with the ones of the given pairs
+        await self.get_rates(pairs)
+        return self.fx.take_moved() | {currency for pair in pairs for currency in (pair[:3], pair[-3:])}
+
+    async def get_market_data(self, portfolio_list):
+        # Prices and FX rates needed to value all the given portfolios, one lookup for the lot
+        asset_data = await self.get_assets({
+            position["symbol"] for portfolio in portfolio_list for position in portfolio.get("portfolio_content", [])
+        })
+        currencies = {portfolio.get("portfolio_currency") for portfolio in portfolio_list} - {None}
+        rate_data = await self.get_rates({
+            asset["currency"] + currency for asset in asset_data.values() if asset["currency"] for currency in currencies
+        })
+        return asset_data, rate_data
+
+    async def load_rates(self):
+        generation = self.generation
+        quotes = {}
+        async for doc in self.rates_collection.find({}, {"symbol": 1, "last_rate": 1}):
+            quotes[doc["symbol"]] = doc.get("last_rate")
+            self.ids[doc["_id"]] = (self.rates_collection.name, doc["symbol"])
+        self.fx.load(quotes)
+        # A quote written meanwhile may be missing from this read : reload on next access
+        self.fx_loaded_at = time.monotonic() if generation == self.generation else None
+
+    # Updates
+    def _store_asset(self, doc, generation=None):
+        data = {field: doc.get(field) for field in ASSET_FIELDS if field != "symbol"}
+        # The asset _id is referenced by the portfolio positions
+        data["asset_id"] = doc["_id"] if "_id" in doc else doc.get("asset_id")
+        if generation is None or generation == self.generation:
+            self.assets[doc["symbol"]] = (time.monotonic(), data)
+            if "_id" in doc:
+                self.ids[doc["_id"]] = (self.assets_collection.name, doc["symbol"])
+        return data
+
+    def set_asset(self, doc):
+        self.invalidate_asset(doc["symbol"])
+        self._store_asset(doc)
+
+    def set_rate(self, doc):
+        self.generation += 1
+        self.fx.set_quote(doc["symbol"], doc.get("last_rate"))
+        if "_id" in doc:
+            self.ids[doc["_id"]] = (self.rates_collection.name, doc["symbol"])
+        if self.shared is not None:
+            self.own_rates[doc["symbol"]] = [time.monotonic(), None, doc.get("last_rate")]
+
+    def invalidate_asset(self, symbol):
+        self.generation += 1
+        self.invalidations += 1
+        self.assets.pop(symbol, None)
+        if self.shared is not None:
+            self.own_assets[symbol] = [time.monotonic(), None]
+
+    def invalidate_rate(self, pair):
+        self.generation += 1
+        self.invalidations += 1
+        self.fx.remove_quote(pair)
+        if self.shared is not None:
+            self.own_rates[pair] = [time.monotonic(), None, None]
+
+    def clear(self):
+        self.generation += 1
+        self.invalidations += 1
+        self.assets.clear()
+        self.fx_loaded_at = None
+        self.ids.clear()
+        self.own_assets.clear()
+        self.own_rates.clear()
+        self.fx_synced = None
+
+    # Market version
+    async def bump_version(self):
+        if self.versions_collection is None:
+            return
+        document = await self.versions_collection.find_one_and_update(
+            {"_id": "market"}, {"$inc": {"version": 1}}, upsert=True, return_document=ReturnDocument.AFTER
+        )
+        # The writes of this worker made so far are in the table once it reaches this version
+        for write in (*self.own_assets.values(), *self.own_rates.values()):
+            if write[1] is None:
+                write[1] = document["version"]
+
+    async def load_version(self):
+        if self.versions_collection is None:
+            return None
+        document = await self.versions_collection.find_one({"_id": "market"})
+        return document["version"] if document else 0
+
+    def etag_version(self):
+        # None when changes made by other workers may be missing from the cache
+        if self.shared is not None:
+            return shared.version() if (shared := self._shared()) is not None else None
+        return self.version if self.watching else None
+
+    # Change stream
+    def apply_change(self, change):
+        collection = change["ns"]["coll"]
+        document = change.get("fullDocument")
+        if self.versions_collection is not None and collection == self.versions_collection.name:
+            # The value of this event : the looked up document may already hold a later bump
+            fields = change.get("updateDescription", {}).get("updatedFields") or document or {}
+            if "version" in fields:
+                self.version = fields["version"]
+            return
+        if document and "symbol" in document:
+            # Inserts and updates carry the document : apply it directly
+            key = document["symbol"]
+            if collection == self.assets_collection.name:
+                self.set_asset(document)
+            elif collection == self.rates_collection.name:
+                self.set_rate(document)
+        elif (key := self.ids.get(change.get("documentKey", {}).get("_id"), (None, None))[1]) is None:
+            return
+        elif collection == self.assets_collection.name:
+            self.invalidate_asset(key)
+        elif collection == self.rates_collection.name:
+            self.invalidate_rate(key)
+        if (kind := {self.assets_collection.name: "asset", self.rates_collection.name: "rate"}.get(collection)) is None:
+            return
+        for listener in self.listeners:
+            listener(kind, key)
+
+    async def watch(self, retry_delay: float = 5):
+        collections = [self.assets_collection.name, self.rates_collection.name]
+        if self.versions_collection is not None:
+            collections.append(self.versions_collection.name)
+        pipeline = [{"$match": {"ns.coll": {"$in": collections}}}]
+        while True:
+            try:
+                async with self.db.watch(pipeline, full_document="updateLookup") as stream:
+                    # Entries loaded before the stream opened may have missed changes : start again from
+                    # the database, at the version stored now
+                    self.clear()
+                    self.version = await self.load_version()
+                    self.watching = True
+                    async for change in stream:
+                        self.apply_change(change)
+            except PyMongoError:
+                # Changes may have been missed while the stream was down, without a stream
+                # (standalone mongod) entries simply expire after max_age
+                if self.watching:
+                    self.watching = False
+                    self.version = None
+                    self.clear()
+                await asyncio.sleep(retry_delay)
+
+    def stats(self):
+        now = time.monotonic()
+        ages = [now - entry[0] for entry in self.assets.values()]
+        if self.fx_loaded_at is not None:
+            ages.append(now - self.fx_loaded_at)
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "invalidations": self.invalidations,
+            "assets_cached": len(self.assets),
+            "rates_cached": len(self.fx.quotes),
+            "currencies": len(self.fx.currencies()),
+            "oldest_entry_age": max(ages, default=0),
+            "change_stream_active": self.watching,
+            "market_version": self.version,
+            "shared_table": self.shared.stats() if self.shared is not None else None,
+        }
@@ -0,0 +1,140 @@
+import asyncio
+import re
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+STEP_UNITS = {"m": "minutes", "h": "hours", "d": "days", "w": "weeks"}
+MAX_POINTS = 10000
+
+
+def parse_step(step: str) -> timedelta:
+    # "1d", "12h", "1w", "30m"
+    if not (match := re.fullmatch(r"\s*(\d+)\s*([mhdw])\s*", step or "")) or int(match.group(1)) == 0:
+        raise ValueError(f"Invalid step : {step!r}, expected e.g. 30m, 12h, 1d or 1w")
+    return timedelta(**{STEP_UNITS[match.group(2)]: int(match.group(1))})
+
+def to_utc(moment: datetime) -> datetime:
+    # Mongo returns naive UTC datetimes : every comparison is made in naive UTC
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+def time_points(start: datetime, end: datetime, step: timedelta):
+    start, end = to_utc(start), to_utc(end)
+    if end < start:
+        raise ValueError("The end of the history is before its start")
+    count = int((end - start) / step) + 1
+    if count > MAX_POINTS:
+        raise ValueError(f"{count} points requested, at most {MAX_POINTS} : use a larger step")
+    points = [start + i * step for i in range(count)]
+    # The history always ends on the requested end, even off the step grid
+    return points if points[-1] == end else points + [end]
+
+def as_of_join(times, values, points):
+    # Last value at or before each point, NaN before the first one. times must be sorted.
+    index = np.searchsorted(times, points, side="right") - 1
+    joined = np.asarray(values, dtype=float)[np.maximum(index, 0)] if len(values) else np.full(len(points), np.nan)
+    return np.where(index >= 0, joined, np.nan)
+
+def history_pairs(pairs, base: str = "USD"):
+    # Stored pairs whose history can give the requested ones : direct, inverse, or both legs through base
+    needed = set()
+    for pair in pairs:
+        source, target = pair[:3], pair[-3:]
+        needed.update({pair, target + source})
+        for currency in (source, target):
+            needed.update({currency + base, base + currency})
+    return sorted(needed)
+
+def derive_rates(pairs, quotes, count: int, base: str = "USD"):
+    # quotes : stored pair -> rates at each point. Missing points stay NaN.
+    def quote(source, target):
+        if source == target:
+            return np.ones(count)
+        if (direct := quotes.get(source + target)) is not None and not np.isnan(direct).all():
+            return direct
+        if (inverse := quotes.get(target + source)) is not None and not np.isnan(inverse).all():
+            return 1 / inverse
+        return None
+
+    rates = {}
+    for pair in pairs:
+        source, target = pair[:3], pair[-3:]
+        if (rate := quote(source, target)) is None:
+            source_leg, target_leg = quote(source, base), quote(target, base)
+            if source_leg is None or target_leg is None:
+                continue
+            rate = source_leg / target_leg
+        rates[pair] = rate
+    return rates
+
+
+class PriceHistory:
+    """Append-only history of a price, one (symbol, ts, value) document per update.
+
+    The collection is a MongoDB time-series collection (see setup_mongo.py) with symbol as its
+    meta field, so the points of a symbol are stored together in compressed buckets. Values at
+    past dates are read with as-of joins : the last point at or before each requested time.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def record(self, points, ts: datetime = None):
+        # points : iterable of (symbol, value)
+        ts = ts or datetime.now(timezone.utc)
+        documents = [{"symbol": symbol, "ts": ts, "value": float(value)} for symbol, value in points if value is not None]
+        if documents:
+            await self.collection.insert_many(documents, ordered=False)
+
+    async def as_of(self, symbols, moment: datetime):
+        # Last point of each symbol at or before moment : one index seek per symbol on (symbol, ts desc),
+        # the earlier history is never read nor sorted
+        moment = to_utc(moment)
+
+        async def last_point(symbol):
+            return await self.collection.find_one(
+                {"symbol": symbol, "ts": {"$lte": moment}}, {"_id": 0, "ts": 1, "value": 1}, sort=[("ts", -1)]
+            )
+
+        symbols = list(symbols)
+        points = await asyncio.gather(*(last_point(symbol) for symbol in symbols))
+        return {symbol: (point["ts"], point["value"]) for symbol, point in zip(symbols, points) if point is not None}
+
+    async def between(self, symbols, start: datetime, end: datetime, step: timedelta):
+        # Points in (start, end], reduced in Mongo to the last one of each step : the transfer is bounded
+        # by symbols x points whatever the number of intraday updates
+        start, end = to_utc(start), to_utc(end)
+        cursor = self.collection.aggregate([
+            {"$match": {"symbol": {"$in": list(symbols)}, "ts": {"$gt": start, "$lte": end}}},
+            {"$sort": {"ts": 1}},
+            {"$group": {
+                "_id": {
+                    "symbol": "$symbol",
+                    "step": {"$ceil": {"$divide": [{"$subtract": ["$ts", start]}, step / timedelta(milliseconds=1)]}},
+                },
+                "ts": {"$last": "$ts"},
+                "value": {"$last": "$value"},
+            }},
+        ])
+        return await cursor.to_list(length=None)
+
+    async def at(self, symbols, points):
+        # symbol -> array of the values at each point (sorted datetimes), NaN where there is no history yet
+        symbols = sorted(set(symbols))
+        if not symbols or not points:
+            return {}
+        series = {symbol: [] for symbol in symbols}
+        for symbol, (ts, value) in (await self.as_of(symbols, points[0])).items():
+            series[symbol].append((ts, value))
+        if len(points) > 1:
+            for doc in await self.between(symbols, points[0], points[-1], points[1] - points[0]):
+                series[doc["_id"]["symbol"]].append((doc["ts"], doc["value"]))
+        grid = np.array(points, dtype="datetime64[ms]")
+        joined = {}
+        for symbol, values in series.items():
+            values.sort(key=lambda point: point[0])
+            times = np.array([ts for ts, _ in values], dtype="datetime64[ms]")
+            joined[symbol] = as_of_join(times, [value for _, value in values], grid)
+        return joined
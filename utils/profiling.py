@@ -0,0 +1,144 @@
+import collections
+import sys
+import threading
+import time
+import uuid
+
+from utils.metrics import command_observers
+
+# Where a sample is spent : the innermost frame from one of these packages decides
+CATEGORIES = (
+    ("jwt", ("jwt",)),
+    ("pydantic", ("pydantic", "pydantic_core")),
+    ("serialisation", ("json", "fastapi.encoders", "starlette.responses", "bson.json_util")),
+    ("mongo", ("motor", "pymongo", "bson")),
+    ("waiting", ("selectors",)),
+)
+MAX_STACK_DEPTH = 128
+MAX_DURATION = 60  # seconds : a profile whose response body is never sent stops on its own
+
+
+def frame_category(module: str):
+    for category, prefixes in CATEGORIES:
+        if any(module == prefix or module.startswith(prefix + ".") for prefix in prefixes):
+            return category
+    return None
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({frame.f_globals.get('__name__', '?')}:{frame.f_lineno})"
+
+
+class SamplingProfiler:
+    """Samples the stack of one thread (the event loop) from a background thread.
+
+    Stacks are folded ("outer;inner count" lines, the input of flamegraph.pl or speedscope) and each
+    sample is attributed to a category by its innermost recognised frame. Samples spent in select
+    are the event loop waiting, mostly for Mongo replies. Command round trips reported by the
+    pymongo listener while the profile runs are added : on a busy worker they include the other
+    requests' commands. The sampler stops after max_duration even if stop is never called.
+    """
+
+    def __init__(self, thread_id: int, interval: float = 0.001, max_duration: float = MAX_DURATION):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_duration = max_duration
+        self.folded = collections.Counter()
+        self.categories = collections.Counter()
+        self.commands = collections.defaultdict(lambda: [0, 0.0])
+        self.samples = 0
+        self.running = False
+        self.started_at = self.stopped_at = None
+        self.sampler = None
+        self.switch_interval = None
+
+    def start(self):
+        # The sampler only runs when it gets the GIL : switch threads as often as it samples while profiling
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(self.interval, self.switch_interval))
+        self.running = True
+        self.started_at = time.perf_counter()
+        self.sampler = threading.Thread(target=self.run, name="request-profiler", daemon=True)
+        self.sampler.start()
+
+    def stop(self):
+        self.running = False
+        if self.sampler is not None:
+            self.sampler.join()
+
+    def run(self):
+        try:
+            while self.running and time.perf_counter() - self.started_at < self.max_duration:
+                if (frame := sys._current_frames().get(self.thread_id)) is not None:
+                    self.sample(frame)
+                time.sleep(self.interval)
+        finally:
+            self.running = False
+            self.stopped_at = time.perf_counter()
+            sys.setswitchinterval(self.switch_interval)
+
+    def sample(self, frame):
+        stack, category = [], None
+        while frame is not None and len(stack) < MAX_STACK_DEPTH:
+            stack.append(frame_label(frame))
+            if category is None:
+                category = frame_category(frame.f_globals.get("__name__", ""))
+            frame = frame.f_back
+        self.folded[";".join(reversed(stack))] += 1
+        self.categories[category or "application"] += 1
+        self.samples += 1
+
+    def observe_command(self, collection: str, command: str, seconds: float):
+        # Called from the pymongo listener threads
+        entry = self.commands[f"{collection}.{command}" if collection else command]
+        entry[0] += 1
+        entry[1] += seconds
+
+    def report(self):
+        duration = (self.stopped_at or time.perf_counter()) - self.started_at
+        samples = max(self.samples, 1)
+        return {
+            "duration": duration,
+            "samples": self.samples,
+            "interval": self.interval,
+            # Share of the samples, scaled to the request duration
+            "breakdown": {category: duration * count / samples for category, count in self.categories.most_common()},
+            "mongo_commands": {name: {"count": count, "seconds": seconds} for name, (count, seconds) in sorted(self.commands.items())},
+        }
+
+    def folded_stacks(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.folded.most_common())
+
+
+class ProfileStore:
+    # Latest profiles kept in memory, one profiled request at a time
+    def __init__(self, keep: int = 20):
+        self.profiles = collections.OrderedDict()
+        self.keep = keep
+        self.active = None
+
+    def begin(self, route: str):
+        if self.active is not None:
+            if self.active.running:
+                return None
+            # Stopped after max_duration : its response body was never sent
+            self.end(self.active)
+        profiler = SamplingProfiler(threading.get_ident())
+        profiler.profile_id, profiler.route = uuid.uuid4().hex, route
+        self.active = profiler
+        command_observers.append(profiler.observe_command)
+        profiler.start()
+        return profiler
+
+    def end(self, profiler):
+        profiler.stop()
+        if profiler.observe_command in command_observers:
+            command_observers.remove(profiler.observe_command)
+        if self.active is profiler:
+            self.active = None
+        self.profiles[profiler.profile_id] = profiler
+        while len(self.profiles) > self.keep:
+            self.profiles.popitem(last=False)
+
+    def get(self, profile_id: str):
+        return self.profiles.get(profile_id)
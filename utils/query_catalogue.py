@@ -0,0 +1,253 @@
+"""Every index of the database and every query shape sent by the API.
+
+INDEXES is the index state setup_mongo.py migrates the database to. QUERY_SHAPES holds each
+find, update, delete and aggregate of main.py and of the utils it calls, as the command sent
+to the server with sample values from the synthetic data of benchmarks.synthetic. The query plan
+harness (benchmarks.query_plans) explains each of them and fails on collection scans and blocking
+sorts. A new query goes in QUERY_SHAPES, with its index in INDEXES when none serves it.
+"""
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING, DESCENDING
+
+from utils.valuation import PORTFOLIO_FACETS, portfolio_analytics_pipeline
+from utils.valuation_snapshots import pairs_touching
+
+# Collection -> options of the time-series collections
+TIMESERIES = {
+    "price_history": {"timeField": "ts", "metaField": "symbol", "granularity": "hours"},
+    "FX_rates_history": {"timeField": "ts", "metaField": "symbol", "granularity": "hours"},
+}
+
+# (collection, keys, options)
+INDEXES = [
+    ("assets", [("symbol", ASCENDING)], {"unique": True}),
+    ("users", [("username", ASCENDING)], {"unique": True}),
+    ("FX_rates", [("symbol", ASCENDING)], {"unique": True}),
+    ("portfolios", [("owner", ASCENDING), ("name", ASCENDING)], {"unique": True}),
+    # Trades, updates, deletions and the assets of a portfolio find it by name alone
+    ("portfolios", [("name", ASCENDING)], {}),
+    # Valuation snapshots : one per portfolio, found by the symbols and FX pairs they hold
+    ("portfolio_valuations", [("owner", ASCENDING), ("name", ASCENDING)], {"unique": True}),
+    ("portfolio_valuations", [("name", ASCENDING)], {}),
+    ("portfolio_valuations", [("symbols", ASCENDING)], {}),
+    ("portfolio_valuations", [("currency_pairs", ASCENDING)], {}),
+    # Only the incomplete snapshots, the ones dropped when a new FX pair comes in
+    ("portfolio_valuations", [("complete", ASCENDING)], {"partialFilterExpression": {"complete": False}}),
+    # Price and FX rate histories : (symbol, ts, value) points
+    ("price_history", [("symbol", ASCENDING), ("ts", DESCENDING)], {}),
+    ("FX_rates_history", [("symbol", ASCENDING), ("ts", DESCENDING)], {}),
+    # Trade ledger : trades replayed in (ts, _id) order, latest snapshot before a time
+    ("trades", [("owner", ASCENDING), ("name", ASCENDING), ("ts", ASCENDING), ("_id", ASCENDING)], {}),
+    ("position_snapshots", [("owner", ASCENDING), ("name", ASCENDING), ("ts", DESCENDING)], {"unique": True}),
+]
+
+# Sample values
+OWNER, NAME, SYMBOL, PAIR = "benchmark", "bench_10", "SYM000000", "EURUSD"
+NOW = datetime(2024, 1, 1, tzinfo=timezone.utc)
+OBJECT_ID = "000000000000000000000000"
+
+
+def find(collection: str, filter, sort=None, limit: int = None, projection=None):
+    command = {"find": collection, "filter": filter}
+    if sort:
+        command["sort"] = sort
+    if limit:
+        command["limit"] = limit
+    if projection:
+        command["projection"] = projection
+    return command
+
+def find_and_modify(collection: str, query, update):
+    return {"findAndModify": collection, "query": query, "update": update}
+
+def update(collection: str, query, update, multi: bool = False, upsert: bool = False):
+    return {"update": collection, "updates": [{"q": query, "u": update, "multi": multi, "upsert": upsert}]}
+
+def delete(collection: str, query, limit: int = 0):
+    return {"delete": collection, "deletes": [{"q": query, "limit": limit}]}
+
+def aggregate(collection: str, pipeline):
+    return {"aggregate": collection, "pipeline": pipeline, "cursor": {}}
+
+def distinct(collection: str, key: str, query=None):
+    return {"distinct": collection, "key": key, "query": query or {}}
+
+
+SET = {"$set": {"last_updated_at": NOW}}
+# (where the query is sent from, command, plan stages accepted for it)
+QUERY_SHAPES = [
+    # Users
+    ("login, GET /user/{username}", find("users", {"username": OWNER}, limit=1), ()),
+    ("PUT /user/{username}", find_and_modify("users", {"username": OWNER}, SET), ()),
+    ("DELETE /user/{username}", delete("users", {"username": OWNER}, limit=1), ()),
+    ("GET /users", find("users", {}, sort={"username": 1}, limit=100), ()),
+    ("GET /users page", find("users", {"username": {"$gt": OWNER}}, sort={"username": 1}, limit=100), ()),
+    # Assets
+    ("GET /asset/{asset_symbol}", find("assets", {"symbol": SYMBOL}, limit=1), ()),
+    ("PUT /asset/{asset_symbol}", find_and_modify("assets", {"symbol": SYMBOL}, SET), ()),
+    ("DELETE /asset/{asset_symbol}", delete("assets", {"symbol": SYMBOL}, limit=1), ()),
+    ("POST /assets/prices", update("assets", {"symbol": SYMBOL}, SET), ()),
+    ("GET /assets page", find("assets", {"symbol": {"$gt": SYMBOL}}, sort={"symbol": 1}, limit=100), ()),
+    ("price cache assets", find("assets", {"symbol": {"$in": [SYMBOL, "SYM000001"]}}), ()),
+    # FX rates
+    ("GET /rate/{rate_symbol}", find("FX_rates", {"symbol": PAIR}, limit=1), ()),
+    ("PUT /rate/{rate_symbol}", find_and_modify("FX_rates", {"symbol": PAIR}, SET), ()),
+    ("PUT /rate inverse, PUT /rates", update("FX_rates", {"symbol": PAIR}, SET, upsert=True), ()),
+    ("DELETE /rate/{rate_symbol}", delete("FX_rates", {"symbol": {"$in": [PAIR, "USDEUR"]}}), ()),
+    ("GET /rates page", find("FX_rates", {"symbol": {"$gt": PAIR}}, sort={"symbol": 1}, limit=100), ()),
+    # Every rate is loaded at once
+    ("price cache rates", find("FX_rates", {}, projection={"symbol": 1, "last_rate": 1}), ("COLLSCAN",)),
+    # Market version, bumped by every price and rate write
+    ("market version bump", find_and_modify("versions", {"_id": "market"}, {"$inc": {"version": 1}}), ()),
+    ("market version", find("versions", {"_id": "market"}, limit=1), ()),
+    # Portfolios
+    ("GET /portfolio/{portfolio_name}/analytics with PRICE_CACHE=0", aggregate("portfolios", portfolio_analytics_pipeline(NAME, OWNER, {PAIR: 1.1}, PORTFOLIO_FACETS)), ()),
+    ("portfolio valuation, snapshot rebuild, ETags, GET /portfolio/{portfolio_name}/positions", find("portfolios", {"name": NAME, "owner": OWNER}, limit=1), ()),
+    ("buy, sell, POST /portfolio/{portfolio_name}/trades", find_and_modify("portfolios", {"name": NAME}, [SET]), ()),
+    ("trades on unknown assets", find_and_modify("portfolios", {"name": NAME, "portfolio_content.symbol": {"$all": [SYMBOL]}}, [SET]), ()),
+    ("trades, portfolio not found, ETag of /portfolio/{portfolio_name}/assets", find("portfolios", {"name": NAME}, limit=1), ()),
+    ("GET /portfolio/{portfolio_name}/assets", aggregate("portfolios", [
+        {"$match": {"name": NAME}},
+        {"$lookup": {"from": "assets", "localField": "portfolio_content.symbol", "foreignField": "symbol", "as": "assets"}},
+    ]), ()),
+    ("GET /portfolio/{username}", find("portfolios", {"owner": OWNER}), ()),
+    ("PUT /portfolio/{portfolio_name}", find_and_modify("portfolios", {"name": NAME}, SET), ()),
+    ("DELETE /portfolio/{portfolio_name}", delete("portfolios", {"name": NAME}, limit=1), ()),
+    ("GET /portfolios page", find("portfolios", {"$or": [{"owner": {"$gt": OWNER}}, {"owner": OWNER, "name": {"$gt": NAME}}]}, sort={"owner": 1, "name": 1}, limit=100), ()),
+    # Every portfolio, for admins
+    ("POST /portfolios/value all", find("portfolios", {}), ("COLLSCAN",)),
+    ("POST /portfolios/value owner", find("portfolios", {"owner": OWNER}), ()),
+    ("POST /portfolios/value pairs", find("portfolios", {"$or": [{"owner": OWNER, "name": {"$in": [NAME, "bench_100"]}}]}), ()),
+    ("trade ledger compaction", update("portfolios", {"owner": OWNER, "name": NAME}, {"$inc": {"trades_since_snapshot": -1}}), ()),
+    # Valuation snapshots
+    ("valuation snapshot", find("portfolio_valuations", {"owner": OWNER, "name": NAME}, limit=1), ()),
+    ("snapshot rebuild", update("portfolio_valuations", {"owner": OWNER, "name": NAME}, {"$setOnInsert": {"positions": []}}, upsert=True), ()),
+    ("snapshot rebuild, market or portfolio moved", delete("portfolio_valuations", {"owner": OWNER, "name": NAME, "write_id": OBJECT_ID}, limit=1), ()),
+    ("snapshot save", update("portfolio_valuations", {"_id": OBJECT_ID, "write_id": OBJECT_ID}, SET), ()),
+    ("snapshot save conflicts", delete("portfolio_valuations", {"_id": {"$in": [OBJECT_ID]}, "write_id": {"$ne": OBJECT_ID}}), ()),
+    ("price updates", find("portfolio_valuations", {"symbols": {"$in": [SYMBOL]}}), ()),
+    ("FX updates, pairs in use", distinct("portfolio_valuations", "currency_pairs", pairs_touching(["EUR", "USD"])), ()),
+    ("FX updates", find("portfolio_valuations", {"$or": [{"currency_pairs": PAIR, f"fx_rates.{PAIR}": {"$ne": 1.1}}]}), ()),
+    ("FX pair removed", delete("portfolio_valuations", {"currency_pairs": {"$in": [PAIR]}}), ()),
+    ("FX fixing failed", delete("portfolio_valuations", pairs_touching(["EUR", "USD"])), ()),
+    ("asset changes", delete("portfolio_valuations", {"symbols": {"$in": [SYMBOL]}}), ()),
+    ("new FX pair", delete("portfolio_valuations", {"complete": False}), ()),
+    ("portfolio updates and deletions", delete("portfolio_valuations", {"name": {"$in": [NAME, "bench_100"]}}), ()),
+    # Trade ledger
+    ("GET /portfolio/{portfolio_name}/trades, replay", find("trades", {"owner": OWNER, "name": NAME, "ts": {"$gt": NOW - timedelta(days=1), "$lte": NOW}}, sort={"ts": 1, "_id": 1}), ()),
+    ("portfolio rename, trades", update("trades", {"owner": OWNER, "name": NAME}, {"$set": {"name": "renamed"}}, multi=True), ()),
+    ("latest position snapshot", find("position_snapshots", {"owner": OWNER, "name": NAME, "ts": {"$lte": NOW}}, sort={"ts": -1}, limit=1), ()),
+    ("first position snapshot", find("position_snapshots", {"owner": OWNER, "name": NAME}, sort={"ts": 1}, limit=1), ()),
+    ("position snapshot", update("position_snapshots", {"owner": OWNER, "name": NAME, "ts": NOW}, {"$setOnInsert": {"positions": []}}, upsert=True), ()),
+    ("portfolio rename, snapshots", update("position_snapshots", {"owner": OWNER, "name": NAME}, {"$set": {"name": "renamed"}}, multi=True), ()),
+]
+# Histories : time-series points are unpacked from their buckets before being sorted, the
+# (symbol, ts) index bounds the buckets read
+for history in TIMESERIES:
+    QUERY_SHAPES += [
+        (f"value as of, {history}", find(history, {"symbol": SYMBOL, "ts": {"$lte": NOW}}, sort={"ts": -1}, limit=1, projection={"_id": 0, "ts": 1, "value": 1}), ("SORT",)),
+        (f"value history, {history}", aggregate(history, [
+            {"$match": {"symbol": {"$in": [SYMBOL, PAIR]}, "ts": {"$gt": NOW - timedelta(days=30), "$lte": NOW}}},
+            {"$sort": {"ts": 1}},
+        ]), ("SORT",)),
+    ]
+
+
+# Plans
+def command_collection(command):
+    return next(iter(command.values()))
+
+def command_filter_and_sort(command):
+    # The filter and the sort the server has to serve for the command
+    if "find" in command:
+        return command["filter"], command.get("sort") or {}
+    if "findAndModify" in command:
+        return command["query"], command.get("sort") or {}
+    if "distinct" in command:
+        return command["query"], {}
+    if "updates" in command:
+        return command["updates"][0]["q"], {}
+    if "deletes" in command:
+        return command["deletes"][0]["q"], {}
+    filter, sort = {}, {}
+    for stage in command["pipeline"]:
+        if "$match" in stage and not filter and not sort:
+            filter = stage["$match"]
+        elif "$sort" in stage and not sort:
+            sort = stage["$sort"]
+        else:
+            break
+    return filter, sort
+
+EQUALITY_OPERATORS = {"$eq", "$in", "$all"}
+
+def recommend_index(command):
+    """Keys of the index serving the command, by the equality, sort, range rule. [] when there is nothing to index."""
+    filter, sort = command_filter_and_sort(command)
+    if "distinct" in command:
+        return [(command["key"], ASCENDING)]
+    equality, ranges = [], []
+    for field, condition in filter.items():
+        if field.startswith("$"):
+            # $or, $and : served clause by clause
+            continue
+        if isinstance(condition, dict) and any(key.startswith("$") for key in condition):
+            (equality if set(condition) <= EQUALITY_OPERATORS else ranges).append(field)
+        else:
+            equality.append(field)
+    keys = [(field, ASCENDING) for field in equality]
+    keys += [(field, direction) for field, direction in sort.items() if field not in equality]
+    keys += [(field, ASCENDING) for field in ranges if field not in sort]
+    if not keys and "$or" in filter:
+        # The clauses of a keyset page share their leading fields
+        keys = recommend_index({"find": None, "filter": filter["$or"][-1], "sort": sort})
+    return [] if keys == [("_id", ASCENDING)] else keys
+
+def index_serves(index_keys, keys):
+    # Same leading fields : the equalities come in any order, the plan harness checks the rest
+    length = min(len(index_keys), len(keys))
+    return {field for field, _ in index_keys[:length]} == {field for field, _ in keys[:length]}
+
+def catalogued_index(collection: str, keys):
+    # True when an index of INDEXES, or _id, can serve the recommended keys
+    if not keys or keys[0][0] == "_id":
+        return True
+    return any(index_collection == collection and index_serves(index_keys, keys) for index_collection, index_keys, _ in INDEXES)
+
+def plan_stages(explain):
+    """Stage names of the winning plans of an explain output, nested stages and pipeline stages included."""
+    stages = []
+    def walk(node):
+        if isinstance(node, list):
+            for item in node:
+                walk(item)
+        elif isinstance(node, dict):
+            if isinstance(node.get("stage"), str):
+                stages.append(node["stage"])
+                if node["stage"] == "EQ_LOOKUP" and node.get("strategy") == "NestedLoopJoin":
+                    stages.append("NESTED_LOOP_JOIN")
+            for key, value in node.items():
+                # Plans not run, and the command echoed back
+                if key in ("rejectedPlans", "allPlansExecution", "command", "originalCommand"):
+                    continue
+                if key in ("$sort", "$lookup") and isinstance(value, dict):
+                    stages.append(key)
+                walk(value)
+    walk(explain)
+    return stages
+
+# Stage -> problem. $sort stays in a pipeline explain when no index provides the order.
+BLOCKING_STAGES = {
+    "COLLSCAN": "collection scan",
+    "SORT": "blocking in-memory sort",
+    "$sort": "blocking in-memory sort",
+    "NESTED_LOOP_JOIN": "$lookup without an index on the foreign field",
+}
+
+def plan_problems(stages, accepted=()):
+    # accepted : stages expected for the query shape, SORT also accepts $sort
+    return sorted({
+        problem for stage, problem in BLOCKING_STAGES.items()
+        if stage in stages and stage.lstrip("$").upper() not in accepted
+    })
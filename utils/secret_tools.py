@@ -1,16 +1,50 @@
-from google.cloud import secretmanager
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
-def access_secret_version(secret_id, version_id="latest"):
-    # Create the Secret Manager client.
-    client = secretmanager.SecretManagerServiceClient()
+PROJECT_ID = os.environ.get("GCP_PROJECT_ID", "97612062608")
+_client_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def _create_client():
+    # Imported on first use : runs with every secret overridden never load the Google client
+    from google.cloud import secretmanager
+    return secretmanager.SecretManagerServiceClient()
 
+def secret_manager_client():
+    # One client for every secret, also when they are fetched from several threads
+    with _client_lock:
+        return _create_client()
+
+def access_secret_version(secret_id, version_id="latest"):
     # Build the resource name of the secret version.
-    name = f"projects/97612062608/secrets/{secret_id}/versions/{version_id}"
+    name = f"projects/{PROJECT_ID}/secrets/{secret_id}/versions/{version_id}"
     # Access the secret version.
-    response = client.access_secret_version(name=name)
+    response = secret_manager_client().access_secret_version(name=name)
 
     # Return the decoded payload.
     return response.payload.data.decode('UTF-8')
 
+def secret_override(secret_id):
+    # MONGODB_STR=... or MONGODB_STR_FILE=/run/secrets/mongodb_str, for local and offline runs
+    variable = secret_id.upper()
+    if (value := os.environ.get(variable)) is not None:
+        return value
+    if (path := os.environ.get(f"{variable}_FILE")) is not None:
+        with open(path, encoding="utf-8") as file:
+            return file.read().strip()
+    return None
 
+@lru_cache(maxsize=None)
+def get_secret(secret_id):
+    # Loaded once per process
+    if (value := secret_override(secret_id)) is not None:
+        return value
+    return access_secret_version(secret_id)
 
+def load_secrets(*secret_ids):
+    # Fetches the secrets in parallel, cold starts wait for one Secret Manager round trip instead of one each
+    with ThreadPoolExecutor(max_workers=max(len(secret_ids), 1)) as executor:
+        return list(executor.map(get_secret, secret_ids))
@@ -0,0 +1,403 @@
+import asyncio
+import multiprocessing
+import platform
+import time
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+from bson import ObjectId
+from pymongo.errors import PyMongoError
+
+from utils.price_cache import ASSET_FIELDS
+
+# Header : int64 slots at the start of the segment
+HEADER_FIELDS = (
+    "seq", "n_assets", "n_rates", "n_labels", "fx_seq", "version", "state", "heartbeat_ms",
+    "asset_capacity", "rate_capacity", "label_capacity",
+)
+HEADER = {field: slot for slot, field in enumerate(HEADER_FIELDS)}
+HEADER_SLOTS = 16
+LOADED, WATCHING = 1, 2  # state bits
+SYMBOL_WIDTH = 24
+# Rows sorted by symbol, categories stored as indexes in the label table (-1 for None)
+ASSET_DTYPE = np.dtype([
+    ("symbol", f"S{SYMBOL_WIDTH}"), ("asset_id", "u1", (12,)), ("last_price", "f8"),
+    ("currency", "i2"), ("asset_class", "i2"), ("geo_zone", "i2"),
+])
+LABEL_FIELDS = ("currency", "asset_class", "geo_zone")
+RATE_DTYPE = np.dtype([("symbol", "S12"), ("last_rate", "f8")])
+LABEL_DTYPE = np.dtype("S32")
+READ_ATTEMPTS = 1000
+# The seqlock needs stores seen in program order by other cores (x86-64 total store order) : numpy
+# issues plain stores and Python has no memory fence. On other architectures (ARM) the table is not used.
+ORDERED_STORES = platform.machine().lower() in ("x86_64", "amd64")
+
+
+def table_size(asset_capacity: int, rate_capacity: int, label_capacity: int):
+    return HEADER_SLOTS * 8 + asset_capacity * ASSET_DTYPE.itemsize + rate_capacity * RATE_DTYPE.itemsize + label_capacity * LABEL_DTYPE.itemsize
+
+def now_ms():
+    return int(time.time() * 1000)
+
+def header_view(shm):
+    return np.ndarray((HEADER_SLOTS,), np.int64, buffer=shm.buf)
+
+
+class SharedPriceTable:
+    """Asset prices and FX quotes in a shared memory segment, written by one process, read by every worker.
+
+    The segment holds a header, the assets sorted by symbol (looked up with a binary search on the
+    mapped array, nothing is copied but the rows found), the FX quotes and the labels of the asset
+    categories. Readers use a seqlock : the writer makes seq odd while it writes and even again
+    after, a read is retried when seq was odd or moved meanwhile. Stores go through numpy in
+    program order, without fences : the seqlock relies on x86-64 not reordering stores with stores
+    nor loads with loads (see ORDERED_STORES). The header is read-only but for the writer.
+
+    version is the market version (see PriceCache) of the data held, set while the owner follows
+    the change stream. The owner stamps heartbeat_ms every second : readers stop using a table
+    whose owner stopped.
+    """
+
+    def __init__(self, shm, owner: bool = False, writable: bool = False):
+        self.shm = shm
+        self.owner = owner
+        # Read-only for everyone : the writer stores through writer_header, None for readers
+        self.header = header_view(shm)
+        self.writer_header = header_view(shm) if writable else None
+        offset = HEADER_SLOTS * 8
+        self.assets = np.ndarray((int(self.header[HEADER["asset_capacity"]]),), ASSET_DTYPE, buffer=shm.buf, offset=offset)
+        offset += self.assets.nbytes
+        self.rates = np.ndarray((int(self.header[HEADER["rate_capacity"]]),), RATE_DTYPE, buffer=shm.buf, offset=offset)
+        offset += self.rates.nbytes
+        self.labels = np.ndarray((int(self.header[HEADER["label_capacity"]]),), LABEL_DTYPE, buffer=shm.buf, offset=offset)
+        self.header.flags.writeable = False
+        if not writable:
+            for array in (self.assets, self.rates, self.labels):
+                array.flags.writeable = False
+
+    @classmethod
+    def create(cls, asset_capacity: int = 100000, rate_capacity: int = 4096, label_capacity: int = 1024):
+        shm = shared_memory.SharedMemory(create=True, size=table_size(asset_capacity, rate_capacity, label_capacity))
+        header = header_view(shm)
+        header[:] = 0
+        header[HEADER["asset_capacity"]] = asset_capacity
+        header[HEADER["rate_capacity"]] = rate_capacity
+        header[HEADER["label_capacity"]] = label_capacity
+        del header
+        return cls(shm, owner=True, writable=True)
+
+    @classmethod
+    def attach(cls, name: str, writable: bool = False):
+        # Only the creator removes the segment : the resource tracker would remove it when an
+        # attached process exits
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:  # Python < 3.13
+            shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return cls(shm, writable=writable)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        # The numpy views hold the buffer : released before the segment is closed
+        self.header = self.writer_header = self.assets = self.rates = self.labels = None
+        self.shm.close()
+        if self.owner:
+            # Forked processes share the tracker of the creator : attaching may have unregistered it
+            resource_tracker.register(self.shm._name, "shared_memory")
+            self.shm.unlink()
+
+    # Reads
+    def read(self, function):
+        # function runs on a consistent table, None when the writer kept it busy for every attempt
+        for _ in range(READ_ATTEMPTS):
+            start = int(self.header[HEADER["seq"]])
+            if start % 2 == 0:
+                try:
+                    result = function()
+                except (IndexError, ValueError):
+                    # Sizes and rows of different writes, only possible if seq moved
+                    if int(self.header[HEADER["seq"]]) == start:
+                        raise
+                    continue
+                if int(self.header[HEADER["seq"]]) == start:
+                    return result
+            time.sleep(0)
+        return None
+
+    def ready(self, max_age: float):
+        # Loaded, and the owner was alive less than max_age seconds ago
+        return bool(self.header[HEADER["state"]] & LOADED) and now_ms() - int(self.header[HEADER["heartbeat_ms"]]) <= max_age * 1000
+
+    def version(self):
+        # None when the owner does not follow the change stream : changes may be missing
+        state, version = self.read(lambda: (int(self.header[HEADER["state"]]), int(self.header[HEADER["version"]]))) or (0, 0)
+        return version if state & WATCHING else None
+
+    def fx_seq(self):
+        return int(self.header[HEADER["fx_seq"]])
+
+    def get_assets(self, symbols):
+        # symbol -> {last_price, currency, asset_class, geo_zone, asset_id} of the symbols held
+        keys = np.array([key for key in (symbol.encode() for symbol in symbols) if len(key) <= SYMBOL_WIDTH], dtype=ASSET_DTYPE["symbol"])
+
+        def lookup():
+            table = self.assets[:int(self.header[HEADER["n_assets"]])]
+            if not len(table) or not len(keys):
+                return table[:0].copy(), self.labels[:0].copy()
+            positions = np.minimum(np.searchsorted(table["symbol"], keys), len(table) - 1)
+            rows = table[positions]
+            return rows[rows["symbol"] == keys], self.labels[:int(self.header[HEADER["n_labels"]])].copy()
+
+        if (result := self.read(lookup)) is None:
+            return None
+        rows, labels = result
+        # Decoded column by column : numpy scalars are slow one by one
+        labels = [label.decode() for label in labels.tolist()] + [None]  # -1 is None
+        columns = [[labels[index] for index in rows[field].tolist()] for field in LABEL_FIELDS]
+        prices = [None if price != price else price for price in rows["last_price"].tolist()]  # NaN is None
+        asset_ids = rows["asset_id"].tobytes()
+        return {
+            symbol.decode(): {
+                "last_price": prices[i],
+                **{field: column[i] for field, column in zip(LABEL_FIELDS, columns)},
+                "asset_id": ObjectId(asset_ids[12 * i:12 * i + 12]),
+            }
+            for i, symbol in enumerate(rows["symbol"].tolist())
+        }
+
+    def get_quotes(self):
+        def quotes():
+            return self.rates[:int(self.header[HEADER["n_rates"]])].copy()
+
+        if (rows := self.read(quotes)) is None:
+            return None
+        return {row["symbol"].decode(): float(row["last_rate"]) for row in rows}
+
+    def stats(self):
+        return {
+            "assets": int(self.header[HEADER["n_assets"]]),
+            "rates": int(self.header[HEADER["n_rates"]]),
+            "version": self.version(),
+            "heartbeat_age": (now_ms() - int(self.header[HEADER["heartbeat_ms"]])) / 1000,
+        }
+
+
+class SharedPriceWriter:
+    """The single writer of a SharedPriceTable. Rows are kept in Python and published under the seqlock."""
+
+    def __init__(self, table: SharedPriceTable):
+        self.table = table
+        self.rows = {}  # symbol -> (asset_id bytes, last_price, currency, asset_class, geo_zone)
+        self.quotes = {}
+        self.positions = {}  # symbol -> row in the table
+        self.label_index = {}
+
+    @contextmanager
+    def write(self):
+        header = self.table.writer_header
+        header[HEADER["seq"]] += 1
+        try:
+            yield header
+        finally:
+            header[HEADER["seq"]] += 1
+
+    def heartbeat(self):
+        # A single aligned store : no seqlock needed
+        self.table.writer_header[HEADER["heartbeat_ms"]] = now_ms()
+
+    def _row(self, doc):
+        # None when the asset does not fit : readers then get it from Mongo
+        if len(doc["symbol"].encode()) > SYMBOL_WIDTH or not isinstance(doc.get("_id"), ObjectId):
+            return None
+        last_price = doc.get("last_price")
+        return (doc["_id"].binary, np.nan if last_price is None else float(last_price), *(doc.get(field) for field in LABEL_FIELDS))
+
+    def _label(self, header, value):
+        # Index of the label, -1 for None, None when the label table cannot hold it
+        if value is None:
+            return -1
+        if (index := self.label_index.get(value)) is None:
+            index = len(self.label_index)
+            if index >= len(self.table.labels) or len(str(value).encode()) > LABEL_DTYPE.itemsize:
+                return None
+            self.table.labels[index] = str(value).encode()
+            self.label_index[value] = index
+            header[HEADER["n_labels"]] = index + 1
+        return index
+
+    def _store(self, header, position, symbol, row):
+        asset_id, last_price, *labels = row
+        if None in (indexes := [self._label(header, label) for label in labels]):
+            return False
+        self.table.assets[position] = (symbol.encode(), np.frombuffer(asset_id, np.uint8), last_price, *indexes)
+        return True
+
+    def _publish_assets(self, header):
+        # Full rewrite, sorted by symbol : new and removed assets only. Assets left out are read from Mongo.
+        self.positions = {}
+        for symbol in sorted(self.rows):
+            position = len(self.positions)
+            if position < len(self.table.assets) and self._store(header, position, symbol, self.rows[symbol]):
+                self.positions[symbol] = position
+        header[HEADER["n_assets"]] = len(self.positions)
+
+    def _publish_rates(self, header):
+        quotes = [(pair, rate) for pair, rate in sorted(self.quotes.items()) if rate is not None][:len(self.table.rates)]
+        for position, (pair, rate) in enumerate(quotes):
+            self.table.rates[position] = (pair.encode(), rate)
+        header[HEADER["n_rates"]] = len(quotes)
+        header[HEADER["fx_seq"]] += 1
+
+    def load(self, assets, quotes):
+        # Everything replaced : assets are documents, quotes pair -> rate
+        self.rows = {doc["symbol"]: row for doc in assets if (row := self._row(doc)) is not None}
+        self.quotes = dict(quotes)
+        self.label_index = {}
+        with self.write() as header:
+            header[HEADER["n_labels"]] = 0
+            self._publish_assets(header)
+            self._publish_rates(header)
+            header[HEADER["state"]] |= LOADED
+
+    def set_asset(self, doc):
+        symbol = doc["symbol"]
+        if (row := self._row(doc)) is None:
+            return self.remove_asset(symbol)
+        known = symbol in self.positions
+        self.rows[symbol] = row
+        with self.write() as header:
+            # Price updates : the row is rewritten in place
+            if not (known and self._store(header, self.positions[symbol], symbol, row)):
+                self._publish_assets(header)
+
+    def remove_asset(self, symbol):
+        if self.rows.pop(symbol, None) is not None:
+            with self.write() as header:
+                self._publish_assets(header)
+
+    def set_quote(self, pair, rate):
+        self.quotes[pair] = rate
+        with self.write() as header:
+            self._publish_rates(header)
+
+    def remove_quote(self, pair):
+        if self.quotes.pop(pair, None) is not None:
+            with self.write() as header:
+                self._publish_rates(header)
+
+    def set_version(self, version):
+        # None : the change stream is not followed
+        with self.write() as header:
+            header[HEADER["version"]] = version or 0
+            if version is None:
+                header[HEADER["state"]] &= ~WATCHING
+            else:
+                header[HEADER["state"]] |= WATCHING
+
+
+class SharedPriceFeeder:
+    """Keeps a SharedPriceTable in line with MongoDB : full load, then the change stream.
+
+    Without a change stream (standalone mongod) the table is reloaded every reload_every seconds.
+    """
+
+    def __init__(self, writer: SharedPriceWriter, db, assets, rates, versions, reload_every: float = 60):
+        self.writer = writer
+        self.db = db
+        self.assets_collection = assets
+        self.rates_collection = rates
+        self.versions_collection = versions
+        self.reload_every = reload_every
+        self.ids = {}  # Mongo _id -> (collection name, key), to resolve delete events
+
+    async def load(self):
+        assets = []
+        async for doc in self.assets_collection.find({}, {field: 1 for field in ASSET_FIELDS}):
+            assets.append(doc)
+            self.ids[doc["_id"]] = (self.assets_collection.name, doc["symbol"])
+        quotes = {}
+        async for doc in self.rates_collection.find({}, {"symbol": 1, "last_rate": 1}):
+            quotes[doc["symbol"]] = doc.get("last_rate")
+            self.ids[doc["_id"]] = (self.rates_collection.name, doc["symbol"])
+        self.writer.load(assets, quotes)
+
+    async def load_version(self):
+        document = await self.versions_collection.find_one({"_id": "market"})
+        return document["version"] if document else 0
+
+    def apply_change(self, change):
+        collection = change["ns"]["coll"]
+        document = change.get("fullDocument")
+        if collection == self.versions_collection.name:
+            # The value of this event, as PriceCache.apply_change
+            fields = change.get("updateDescription", {}).get("updatedFields") or document or {}
+            if "version" in fields:
+                self.writer.set_version(fields["version"])
+            return
+        if document and "symbol" in document:
+            self.ids[document["_id"]] = (collection, document["symbol"])
+            if collection == self.assets_collection.name:
+                self.writer.set_asset(document)
+            elif collection == self.rates_collection.name:
+                self.writer.set_quote(document["symbol"], document.get("last_rate"))
+            return
+        key = self.ids.pop(change.get("documentKey", {}).get("_id"), (None, None))[1]
+        if key is None:
+            return
+        if collection == self.assets_collection.name:
+            self.writer.remove_asset(key)
+        elif collection == self.rates_collection.name:
+            self.writer.remove_quote(key)
+
+    async def beat(self):
+        while True:
+            self.writer.heartbeat()
+            await asyncio.sleep(1)
+
+    async def run(self, retry_delay: float = 5):
+        heartbeat = asyncio.create_task(self.beat())
+        collections = [self.assets_collection.name, self.rates_collection.name, self.versions_collection.name]
+        pipeline = [{"$match": {"ns.coll": {"$in": collections}}}]
+        try:
+            while True:
+                try:
+                    async with self.db.watch(pipeline, full_document="updateLookup") as stream:
+                        # Loaded once the stream is open : no change is missed, the data is at least at version
+                        version = await self.load_version()
+                        await self.load()
+                        self.writer.set_version(version)
+                        async for change in stream:
+                            self.apply_change(change)
+                except PyMongoError:
+                    self.writer.set_version(None)
+                    try:
+                        await self.load()
+                    except PyMongoError:
+                        await asyncio.sleep(retry_delay)
+                        continue
+                    await asyncio.sleep(self.reload_every)
+        finally:
+            heartbeat.cancel()
+
+
+# Owner process, started by the gunicorn master (gunicorn.conf.py) before the workers
+def run_feeder(name: str, reload_every: float):
+    from utils.db import get_db
+    from utils.secret_tools import load_secrets
+
+    load_secrets("mongodb_str")
+    db = get_db()
+    feeder = SharedPriceFeeder(SharedPriceWriter(SharedPriceTable.attach(name, writable=True)), db, db.assets, db.FX_rates, db.versions, reload_every)
+    asyncio.run(feeder.run())
+
+def start_owner(asset_capacity: int, reload_every: float):
+    # The caller keeps the table (it removes the segment on close) and the process
+    table = SharedPriceTable.create(asset_capacity)
+    process = multiprocessing.Process(target=run_feeder, args=(table.name, reload_every), name="shared-prices", daemon=True)
+    process.start()
+    return table, process
@@ -0,0 +1,146 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from pymongo.errors import DuplicateKeyError
+
+from utils.trades import net_trades, apply_netted
+from utils.price_history import to_utc
+
+
+def ledger_time(traded_at: datetime, last_traded_at: datetime = None) -> datetime:
+    # Time of a batch in the ledger, as the trade update stores it in last_traded_at (ledger_time_stage) :
+    # strictly after the previous batch of the portfolio, so the ledger is in the order the updates were applied
+    ts = to_utc(traded_at)
+    ts = ts.replace(microsecond=ts.microsecond // 1000 * 1000)  # Mongo dates are in milliseconds
+    if last_traded_at is not None and ts <= last_traded_at:
+        ts = last_traded_at + timedelta(milliseconds=1)
+    return ts
+
+def ledger_time_stage(traded_at: datetime):
+    # New last_traded_at in the trade update, ledger_time computed by Mongo from the stored one
+    return {"$max": [ledger_time(traded_at), {"$add": ["$last_traded_at", 1]}]}
+
+def replay(positions, trades):
+    # Positions after the trades, batch by batch in the order they were applied to the portfolio
+    held = {position["symbol"]: dict(position) for position in positions}
+    batch = []
+    for trade in trades:
+        if batch and trade["batch_id"] != batch[0]["batch_id"]:
+            apply_netted(held, net_trades(batch))
+            batch = []
+        batch.append(trade)
+    if batch:
+        apply_netted(held, net_trades(batch))
+    return list(held.values())
+
+
+class TradeLedger:
+    """Append-only record of the trades of every portfolio, with periodic position snapshots.
+
+    Each trade is one document of the trades collection, the trades of one request share a
+    batch_id and are replayed netted, as they were applied. A snapshot holds the positions of a
+    portfolio at a time : the positions at any time are the latest snapshot before it plus the
+    trades since, at most about snapshot_every trades. portfolio_content stays the current state
+    read by the rest of the API, the ledger is its audit trail and its history.
+
+    The trades of a batch are written in the transaction of the portfolio update, with the time
+    that update gave them. A compaction snapshot only depends on the ledger : workers compacting
+    the same portfolio at once write the same (owner, name, ts), kept once by the unique index.
+    """
+
+    def __init__(self, trades, snapshots, portfolios, snapshot_every: int = 100, grace: timedelta = timedelta(seconds=60)):
+        self.trades = trades
+        self.snapshots = snapshots
+        self.portfolios = portfolios
+        self.snapshot_every = snapshot_every
+        # Trades younger than grace may still be in flight : they are left for the next compaction
+        self.grace = grace
+        self.tasks = set()
+        self.compacting = set()
+
+    async def record(self, owner: str, name: str, trades, batch_id, ts: datetime, positions_before=None, session=None):
+        # positions_before : the positions the batch was applied to, for portfolios without any snapshot yet
+        if positions_before is not None:
+            await self.snapshot(owner, name, positions_before, ts - timedelta(milliseconds=1), session=session)
+        await self.trades.insert_many([
+            {"owner": owner, "name": name, "batch_id": batch_id, "ts": ts, **trade} for trade in trades
+        ], session=session)
+
+    async def snapshot(self, owner: str, name: str, positions, ts: datetime, trade_count: int = 0, session=None):
+        # True when this call stored it, False when the same snapshot was already there
+        positions = [{key: value for key, value in position.items() if key != "asset_id"} for position in positions]
+        try:
+            result = await self.snapshots.update_one(
+                {"owner": owner, "name": name, "ts": ts},
+                {"$setOnInsert": {"positions": positions, "trade_count": trade_count}},
+                upsert=True, session=session
+            )
+        except DuplicateKeyError:
+            return False
+        return result.upserted_id is not None
+
+    async def latest_snapshot(self, owner: str, name: str, moment: datetime = None):
+        query = {"owner": owner, "name": name}
+        if moment is not None:
+            query["ts"] = {"$lte": to_utc(moment)}
+        return await self.snapshots.find_one(query, sort=[("ts", -1)])
+
+    async def trades_between(self, owner: str, name: str, start: datetime, end: datetime = None):
+        # Trades after start, up to end included
+        ts = {"$gt": to_utc(start)}
+        if end is not None:
+            ts["$lte"] = to_utc(end)
+        cursor = self.trades.find({"owner": owner, "name": name, "ts": ts}, {"_id": 0}).sort([("ts", 1), ("_id", 1)])
+        return await cursor.to_list(length=None)
+
+    async def positions_at(self, owner: str, name: str, moment: datetime = None):
+        # None when the portfolio has no history at that time
+        if (snapshot := await self.latest_snapshot(owner, name, moment)) is None:
+            return None
+        return replay(snapshot["positions"], await self.trades_between(owner, name, snapshot["ts"], moment))
+
+    async def positions_series(self, owner: str, name: str, points):
+        # positions_at each of the sorted points, from one snapshot and the trades up to the last point.
+        # Points before the first snapshot get its positions : the holdings before the first recorded trade.
+        # None when the portfolio has no history.
+        snapshot = await self.latest_snapshot(owner, name, points[0])
+        if snapshot is None and (snapshot := await self.snapshots.find_one({"owner": owner, "name": name}, sort=[("ts", 1)])) is None:
+            return None
+        trades = await self.trades_between(owner, name, snapshot["ts"], points[-1])
+        series, positions, applied = [], snapshot["positions"], 0
+        for point in points:
+            # The trades of a batch share their time : a point never splits a batch
+            end = applied
+            while end < len(trades) and trades[end]["ts"] <= to_utc(point):
+                end += 1
+            if end > applied:
+                positions, applied = replay(positions, trades[applied:end]), end
+            series.append(positions)
+        return series
+
+    # Compaction
+    def schedule_compaction(self, owner: str, name: str):
+        if (owner, name) in self.compacting:
+            return
+        self.compacting.add((owner, name))
+        task = asyncio.create_task(self.compact(owner, name))
+        self.tasks.add(task)
+        task.add_done_callback(lambda done: (self.tasks.discard(done), self.compacting.discard((owner, name))))
+
+    async def compact(self, owner: str, name: str):
+        # New snapshot after the first snapshot_every settled trades, up to the end of their batch. The trade
+        # counter of the portfolio only goes down for the worker that stored it.
+        if (snapshot := await self.latest_snapshot(owner, name)) is None:
+            return
+        trades = await self.trades_between(owner, name, snapshot["ts"], datetime.now(timezone.utc) - self.grace)
+        if len(trades) < self.snapshot_every:
+            # Left to a later trade : a boundary taken from fewer trades would depend on the time of the call
+            return
+        boundary = trades[self.snapshot_every - 1]["ts"]
+        trades = [trade for trade in trades if trade["ts"] <= boundary]
+        if await self.snapshot(owner, name, replay(snapshot["positions"], trades), boundary, len(trades)):
+            await self.portfolios.update_one({"owner": owner, "name": name}, {"$inc": {"trades_since_snapshot": -len(trades)}})
+
+    async def rename(self, owner: str, name: str, new_name: str):
+        await self.trades.update_many({"owner": owner, "name": name}, {"$set": {"name": new_name}})
+        await self.snapshots.update_many({"owner": owner, "name": name}, {"$set": {"name": new_name}})
@@ -0,0 +1,131 @@
+from fastapi import HTTPException
+
+
+# Trades as aggregation pipeline updates : the new position is computed by Mongo from the stored one,
+# so a trade is a single atomic round trip and concurrent trades on a portfolio never lose an update
+def map_position(symbol: str, changes):
+    # changes : expression of the new fields of the position, evaluated with $$position bound to it
+    return {
+        "$map": {
+            "input": "$portfolio_content",
+            "as": "position",
+            "in": {
+                "$cond": [
+                    {"$eq": ["$$position.symbol", {"$literal": symbol}]},
+                    {"$mergeObjects": ["$$position", changes]},
+                    "$$position",
+                ]
+            },
+        }
+    }
+
+def buy_stages(symbol: str, qty: float, cost_price, new_position=None):
+    # Weighted average cost price. new_position is appended when the symbol is not held yet,
+    # None when the asset is unknown : the caller then only matches portfolios already holding it.
+    new_qty = {"$add": ["$$position.qty", qty]}
+    changes = {
+        "qty": new_qty,
+        "cost_prices": {
+            "$cond": [
+                {"$eq": [new_qty, 0]},
+                "$$position.cost_prices",
+                {"$divide": [
+                    {"$add": [{"$multiply": ["$$position.cost_prices", "$$position.qty"]}, {"$multiply": [{"$literal": cost_price}, qty]}]},
+                    new_qty,
+                ]},
+            ]
+        },
+    }
+    content = map_position(symbol, changes)
+    if new_position is not None:
+        content = {
+            "$cond": [
+                {"$in": [{"$literal": symbol}, {"$ifNull": ["$portfolio_content.symbol", []]}]},
+                content,
+                {"$concatArrays": [{"$ifNull": ["$portfolio_content", []]}, [{"$literal": new_position}]]},
+            ]
+        }
+    return [{"$set": {"portfolio_content": content}}]
+
+def sell_stages(symbol: str, qty: float, sell_price: float):
+    # Never sells more than held, realized PnL accumulates on the position
+    changes = {
+        "$let": {
+            "vars": {"sold": {"$min": ["$$position.qty", qty]}},
+            "in": {
+                "qty": {"$subtract": ["$$position.qty", "$$sold"]},
+                "realized_pnl": {"$add": [
+                    {"$ifNull": ["$$position.realized_pnl", 0]},
+                    {"$multiply": [{"$subtract": [sell_price, "$$position.cost_prices"]}, {"$abs": "$$sold"}]},
+                ]},
+            },
+        }
+    }
+    return [{"$set": {"portfolio_content": map_position(symbol, changes)}}]
+
+# Batches : the trades of a symbol are netted into at most one buy and one sell, applied in that
+# order so a batch can sell what it buys. Prices are averaged weighted by quantity.
+def net_trades(trades):
+    # trades : dicts with symbol, side ("buy" or "sell"), qty and price
+    netted = {}
+    for trade in trades:
+        side = netted.setdefault(trade["symbol"], {}).setdefault(trade["side"], {"qty": 0, "amount": 0})
+        side["qty"] += trade["qty"]
+        side["amount"] = None if side["amount"] is None or trade.get("price") is None else side["amount"] + trade["qty"] * trade["price"]
+    return {
+        symbol: {
+            side: (totals["qty"], None if totals["amount"] is None or totals["qty"] == 0 else totals["amount"] / totals["qty"])
+            for side, totals in sides.items()
+        }
+        for symbol, sides in netted.items()
+    }
+
+def batch_stages(netted, new_positions):
+    # new_positions : symbol -> position appended when the symbol is not held, None for unknown assets
+    stages = []
+    for symbol, sides in netted.items():
+        if "buy" in sides:
+            stages += buy_stages(symbol, *sides["buy"], new_positions.get(symbol))
+        if "sell" in sides:
+            stages += sell_stages(symbol, *sides["sell"])
+    return stages
+
+# Same figures as the pipelines, computed from the position before the update to report the outcome
+def buy_position(position, qty: float, cost_price):
+    new_qty = position["qty"] + qty
+    if new_qty == 0:
+        return {**position, "qty": new_qty}
+    if cost_price is None or position.get("cost_prices") is None:
+        return {**position, "qty": new_qty, "cost_prices": None}
+    return {**position, "qty": new_qty, "cost_prices": (position["cost_prices"] * position["qty"] + cost_price * qty) / new_qty}
+
+def sell_position(position, qty: float, sell_price: float):
+    # Returns the position after the sale and the PnL it realized
+    sold = min(position["qty"], qty)
+    realized = None if position.get("cost_prices") is None else (sell_price - position["cost_prices"]) * abs(sold)
+    total = position.get("realized_pnl") or 0
+    return {**position, "qty": position["qty"] - sold, "realized_pnl": None if realized is None else total + realized}, realized
+
+def apply_netted(held, netted, new_positions=None):
+    # held : symbol -> position, updated in place the way batch_stages updates the document.
+    # Returns the realized PnL of each symbol sold and the symbols sold without being held.
+    realized, not_held = {}, []
+    for symbol, sides in netted.items():
+        position = held.get(symbol)
+        if "buy" in sides:
+            if position is None:
+                qty, cost_price = sides["buy"]
+                position = dict((new_positions or {}).get(symbol) or {"symbol": symbol, "qty": qty, "cost_prices": cost_price})
+            else:
+                position = buy_position(position, *sides["buy"])
+        if "sell" in sides:
+            if position is None:
+                not_held.append(symbol)
+                continue
+            position, realized[symbol] = sell_position(position, *sides["sell"])
+        held[symbol] = position
+    return realized, not_held
+
+def assets_not_found(symbols):
+    # One 404 listing every unknown symbol of a portfolio creation or a batch of trades
+    return HTTPException(status_code=404, detail=f"Assets not found : {sorted(symbols)}")
@@ -0,0 +1,255 @@
+import math
+from typing import Union
+
+import numpy as np
+
+# Mongo pipeline : the join positions -> assets -> FX_rates is run once and every figure is
+# computed from it inside a single $facet stage
+PORTFOLIO_FACETS = ("total", "by_asset_class", "by_geo_zone", "by_asset")
+
+def return_expression(price_field: str, cost_field: str):
+    # (price - cost) / cost, null instead of a division by zero when no cost is known
+    return {
+        '$cond': [
+            {'$eq': [cost_field, 0]},
+            None,
+            {'$divide': [{'$subtract': [price_field, cost_field]}, cost_field]}
+        ]
+    }
+
+def group_by_stages(group_key, label: Union[str, None] = None):
+    projection = {'_id': 0}
+    if label:
+        projection[label] = '$_id'
+    projection.update({
+        'name': '$name',
+        'owner': '$owner',
+        'converted_price': '$converted_price',
+        'converted_cost_price': '$converted_cost_price',
+        'return': return_expression('$converted_price', '$converted_cost_price'),
+        'currency': '$currency'
+    })
+    return [
+        {
+            '$group': {
+                '_id': group_key,
+                'name': {'$first': '$name'},
+                'owner': {'$first': '$owner'},
+                'converted_price': {'$sum': '$converted_price'},
+                'converted_cost_price': {'$sum': '$converted_cost_price'},
+                'currency': {'$first': '$portfolio_currency'}
+            }
+        }, {
+            '$project': projection
+        }
+    ]
+
+def portfolio_analytics_pipeline(portfolio_name: str, owner: str, rates, facets=PORTFOLIO_FACETS):
+    # rates : pair -> rate from the FX matrix (PriceCache.rates_into), so inverse and cross rates
+    # value positions like the engine does. Only the quoted pairs are stored in FX_rates.
+    facet_stages = {
+        "total": group_by_stages(0),
+        "by_asset_class": group_by_stages('$asset.asset_class', "asset_class"),
+        "by_geo_zone": group_by_stages('$asset.geo_zone', "geo_zone"),
+        "by_asset": [
+            {
+                '$project': {
+                    '_id': 0,
+                    'name': '$name',
+                    'owner': '$owner',
+                    'asset': '$asset.symbol',
+                    'converted_price': '$converted_price',
+                    'converted_cost_price': '$converted_cost_price',
+                    'return': return_expression('$converted_price', '$converted_cost_price'),
+                    'currency': '$portfolio_currency'
+                }
+            }
+        ],
+    }
+    return [
+        {
+            '$match': {
+                'name': portfolio_name,
+                'owner': owner
+            }
+        }, {
+            '$unwind': '$portfolio_content'
+        }, {
+            '$lookup': {
+                'from': 'assets',
+                'localField': 'portfolio_content.symbol',
+                'foreignField': 'symbol',
+                'as': 'asset'
+            }
+        }, {
+            '$unwind': '$asset'
+        }, {
+            '$addFields': {
+                'exch_rate': {
+                    '$concat': [
+                        '$asset.currency', '$portfolio_currency'
+                    ]
+                }
+            }
+        }, {
+            '$addFields': {
+                'asset_rate': {
+                    '$arrayElemAt': [
+                        {'$filter': {
+                            'input': {'$literal': [{'symbol': pair, 'last_rate': rate} for pair, rate in rates.items()]},
+                            'cond': {'$eq': ['$$this.symbol', '$exch_rate']}
+                        }}, 0
+                    ]
+                }
+            }
+        }, {
+            # Positions without a rate are left out
+            '$match': {'asset_rate': {'$exists': True}}
+        }, {
+            '$addFields': {
+                'converted_price': {
+                    '$multiply': [
+                        '$asset.last_price', '$asset_rate.last_rate', '$portfolio_content.qty'
+                    ]
+                },
+                'converted_cost_price': {
+                    '$multiply': [
+                        '$portfolio_content.cost_prices', '$asset_rate.last_rate', '$portfolio_content.qty'
+                    ]
+                }
+            }
+        }, {
+            '$facet': {facet: facet_stages[facet] for facet in facets}
+        }
+    ]
+
+
+# Vectorised engine : the same figures as portfolio_analytics_pipeline, computed in process on
+# columnar arrays once the prices and FX rates are known (see utils.price_cache)
+def portfolio_columns(portfolio, asset_data, rate_data):
+    # Positions without a known asset or FX rate are left out, like the $unwind stages do
+    # The inputs are kept as given, None included, for the valuation snapshots
+    currency = portfolio.get("portfolio_currency")
+    symbols, asset_classes, geo_zones, pairs = [], [], [], []
+    qty, cost_prices, last_prices, fx_rates = [], [], [], []
+    for position in portfolio.get("portfolio_content", []):
+        asset = asset_data.get(position["symbol"])
+        if asset is None or not asset["currency"] or not currency:
+            continue
+        pair = asset["currency"] + currency
+        rate = rate_data.get(pair)
+        if rate is None:
+            continue
+        symbols.append(position["symbol"])
+        asset_classes.append(asset["asset_class"])
+        geo_zones.append(asset["geo_zone"])
+        pairs.append(pair)
+        qty.append(position.get("qty"))
+        cost_prices.append(position.get("cost_prices"))
+        last_prices.append(asset["last_price"])
+        fx_rates.append(rate)
+    # Missing numbers become NaN, which propagates through a product like null does in $multiply
+    qty_array = np.array(qty, dtype=float)
+    fx_array = np.array(fx_rates, dtype=float)
+    return {
+        "symbol": symbols,
+        "asset_class": asset_classes,
+        "geo_zone": geo_zones,
+        "pair": pairs,
+        "qty": qty,
+        "cost_prices": cost_prices,
+        "last_price": last_prices,
+        "fx_rate": fx_rates,
+        "converted_price": np.array(last_prices, dtype=float) * fx_array * qty_array,
+        "converted_cost_price": np.array(cost_prices, dtype=float) * fx_array * qty_array,
+    }
+
+def factorize(labels):
+    index = {}
+    codes = np.fromiter((index.setdefault(label, len(index)) for label in labels), dtype=np.intp, count=len(labels))
+    return codes, list(index)
+
+def to_json_number(value):
+    return None if math.isnan(value) else value
+
+def return_ratio(price, cost):
+    if math.isnan(price) or math.isnan(cost) or cost == 0:
+        return None
+    return (price - cost) / cost
+
+def summary(portfolio, converted_price, converted_cost_price, label: Union[str, None] = None, key=None):
+    result = {label: key} if label else {}
+    result.update({
+        "name": portfolio["name"],
+        "owner": portfolio["owner"],
+        "converted_price": converted_price,
+        "converted_cost_price": converted_cost_price,
+        "return": return_ratio(converted_price, converted_cost_price),
+        "currency": portfolio["portfolio_currency"],
+    })
+    return result
+
+def analyze_portfolio(portfolio, asset_data, rate_data, facets=PORTFOLIO_FACETS):
+    return analyze_columns(portfolio, portfolio_columns(portfolio, asset_data, rate_data), facets)
+
+def analyze_columns(portfolio, columns, facets=PORTFOLIO_FACETS):
+    # $sum skips nulls
+    price = np.nan_to_num(columns["converted_price"])
+    cost = np.nan_to_num(columns["converted_cost_price"])
+    result = {}
+    if "total" in facets:
+        result["total"] = summary(portfolio, float(price.sum()), float(cost.sum()))
+    for facet, key in (("by_asset_class", "asset_class"), ("by_geo_zone", "geo_zone")):
+        if facet in facets:
+            codes, labels = factorize(columns[key])
+            price_by_group = np.bincount(codes, weights=price, minlength=len(labels))
+            cost_by_group = np.bincount(codes, weights=cost, minlength=len(labels))
+            result[facet] = [
+                summary(portfolio, float(price_by_group[i]), float(cost_by_group[i]), key, label)
+                for i, label in enumerate(labels)
+            ]
+    if "by_asset" in facets:
+        result["by_asset"] = [
+            {
+                "name": portfolio["name"],
+                "owner": portfolio["owner"],
+                "asset": symbol,
+                "converted_price": to_json_number(line_price),
+                "converted_cost_price": to_json_number(line_cost),
+                "return": return_ratio(line_price, line_cost),
+                "currency": portfolio["portfolio_currency"],
+            }
+            for symbol, line_price, line_cost in zip(
+                columns["symbol"], columns["converted_price"].tolist(), columns["converted_cost_price"].tolist()
+            )
+        ]
+    return result
+
+def value_series(portfolio, asset_data, prices, rates, count: int, holdings=None):
+    # Value and cost of the positions held at each point of a price history, the current ones when holdings is None.
+    # prices : symbol -> array of prices, rates : pair -> array of FX rates (see utils.price_history),
+    # holdings : the positions at each point (see TradeLedger.positions_series)
+    currency = portfolio.get("portfolio_currency")
+    if holdings is None:
+        holdings = [portfolio.get("portfolio_content", [])] * count
+    # Quantity and cost price of each symbol at each point, 0 while not held
+    quantities, cost_prices = {}, {}
+    for index, positions in enumerate(holdings):
+        for position in positions:
+            quantities.setdefault(position["symbol"], np.zeros(count))[index] = np.nan if position.get("qty") is None else position["qty"]
+            cost_prices.setdefault(position["symbol"], np.zeros(count))[index] = np.nan if position.get("cost_prices") is None else position["cost_prices"]
+    converted_price, converted_cost_price = np.zeros(count), np.zeros(count)
+    for symbol, qty in quantities.items():
+        asset = asset_data.get(symbol)
+        if asset is None or not asset["currency"] or not currency:
+            continue
+        rate = rates.get(asset["currency"] + currency)
+        price = prices.get(symbol)
+        if rate is None or price is None:
+            continue
+        cost_price = cost_prices[symbol]
+        # Before its first price or rate the position is left out, as an unknown asset would be
+        known = ~np.isnan(price * rate)
+        converted_price += np.where(known, np.nan_to_num(price * rate * qty), 0)
+        converted_cost_price += np.where(known, np.nan_to_num(cost_price * rate * qty), 0)
+    return converted_price, converted_cost_price
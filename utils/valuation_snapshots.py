@@ -0,0 +1,284 @@
+import math
+import re
+import uuid
+from datetime import datetime
+
+import pytz
+from pymongo import ReplaceOne
+from pymongo.errors import DuplicateKeyError
+
+from utils.valuation import PORTFOLIO_FACETS, analyze_columns, portfolio_columns, summary, return_ratio
+
+CH_timezone = pytz.timezone('Europe/Zurich')
+GROUPS = (("by_asset_class", "asset_class"), ("by_geo_zone", "geo_zone"))
+
+
+def multiply(*factors):
+    # Same as $multiply : null as soon as one factor is missing
+    if any(factor is None for factor in factors):
+        return None
+    return math.prod(factors)
+
+def as_number(value):
+    # $sum skips nulls
+    return 0 if value is None else value
+
+def as_float(value):
+    return math.nan if value is None else value
+
+def sums(figures, key=None):
+    # The part of an analytics entry kept in a snapshot
+    result = {key: figures[key]} if key else {}
+    result.update(converted_price=figures["converted_price"], converted_cost_price=figures["converted_cost_price"])
+    return result
+
+def pairs_touching(currencies):
+    # Snapshots holding a pair from or into one of the currencies : prefix and suffix of currency_pairs
+    pattern = "|".join(sorted(re.escape(currency) for currency in currencies))
+    return {"currency_pairs": {"$in": [re.compile(f"^(?:{pattern})"), re.compile(f"(?:{pattern})$")]}}
+
+
+class ValuationSnapshots:
+    """Materialised valuations of the portfolios, one document per portfolio.
+
+    A snapshot holds every valued position with the price and FX rate used, the totals and the
+    asset class / geo zone sums. Trades, price and rate changes adjust the affected positions and
+    add the difference to the sums instead of valuing the portfolio again. The holders of a
+    symbol or currency pair are found through the multikey indexes on symbols and currency_pairs.
+
+    Snapshots are built lazily on first read. A snapshot changed concurrently by another writer,
+    or after too many deltas, is dropped and rebuilt on the next read.
+
+    A rebuild is only stored while the price cache follows the change stream, never over a
+    snapshot stored meanwhile, and is dropped again if the stored market version or the portfolio
+    moved while it was built : the write behind that change may have run before the snapshot existed.
+    """
+
+    def __init__(self, collection, price_cache, rebuild_after: int = 1000, portfolios=None):
+        self.collection = collection
+        self.price_cache = price_cache
+        self.rebuild_after = rebuild_after
+        self.portfolios = portfolios
+
+    # Reads
+    async def get(self, owner: str, name: str):
+        return await self.collection.find_one({"owner": owner, "name": name})
+
+    async def rebuild(self, portfolio):
+        # portfolio : with its last_updated_at, compared once the snapshot is stored
+        version = self.price_cache.etag_version()
+        asset_data, rate_data = await self.price_cache.get_market_data([portfolio])
+        snapshot = self.build(portfolio, asset_data, rate_data)
+        if version is None:
+            # Prices may be up to max_age old : valued for this read only
+            return snapshot
+        key = {"owner": snapshot["owner"], "name": snapshot["name"]}
+        snapshot["write_id"] = uuid.uuid4().hex
+        try:
+            await self.collection.update_one(key, {"$setOnInsert": snapshot}, upsert=True)
+        except DuplicateKeyError:
+            # Stored by a concurrent rebuild
+            return snapshot
+        # The stored market version, not the one read on the stream : a bump made before this check may
+        # not have reached this worker yet
+        current = await self.portfolios.find_one(key, {"_id": 0, "last_updated_at": 1})
+        if await self.price_cache.load_version() != version or (current or {}).get("last_updated_at") != portfolio.get("last_updated_at"):
+            await self.collection.delete_one({**key, "write_id": snapshot["write_id"]})
+        return snapshot
+
+    def build(self, portfolio, asset_data, rate_data):
+        # Figures of the valuation engine, with the price and FX rate of every line for the deltas
+        columns = portfolio_columns(portfolio, asset_data, rate_data)
+        analytics = analyze_columns(portfolio, columns)
+        inputs = ("symbol", "asset_class", "geo_zone", "pair", "qty", "cost_prices", "last_price", "fx_rate")
+        positions = [
+            {
+                **dict(zip(inputs, values)),
+                "converted_price": line["converted_price"],
+                "converted_cost_price": line["converted_cost_price"],
+            }
+            for *values, line in zip(*(columns[field] for field in inputs), analytics["by_asset"])
+        ]
+        snapshot = {
+            "owner": portfolio["owner"],
+            "name": portfolio["name"],
+            "portfolio_currency": portfolio.get("portfolio_currency"),
+            # Reverse indexes : every symbol held, valued or not, and every FX pair used
+            "symbols": sorted({position["symbol"] for position in portfolio.get("portfolio_content", [])}),
+            "currency_pairs": sorted(set(columns["pair"])),
+            "fx_rates": dict(zip(columns["pair"], columns["fx_rate"])),
+            "positions": positions,
+            # False when some positions could not be valued : a new asset or rate may complete it
+            "complete": len(positions) == len(portfolio.get("portfolio_content", [])),
+            "deltas": 0,
+            "total": sums(analytics["total"]),
+        }
+        for facet, key in GROUPS:
+            snapshot[facet] = [sums(group, key) for group in analytics[facet]]
+        return snapshot
+
+    @staticmethod
+    def line_values(line):
+        return (
+            multiply(line["last_price"], line["fx_rate"], line["qty"]),
+            multiply(line["cost_prices"], line["fx_rate"], line["qty"]),
+        )
+
+    def analytics(self, snapshot, facets=PORTFOLIO_FACETS):
+        # Same shape as utils.valuation.analyze_portfolio
+        result = {}
+        if "total" in facets:
+            result["total"] = summary(snapshot, snapshot["total"]["converted_price"], snapshot["total"]["converted_cost_price"])
+        for facet, key in GROUPS:
+            if facet in facets:
+                result[facet] = [
+                    summary(snapshot, group["converted_price"], group["converted_cost_price"], key, group[key])
+                    for group in snapshot[facet]
+                ]
+        if "by_asset" in facets:
+            result["by_asset"] = [
+                {
+                    "name": snapshot["name"],
+                    "owner": snapshot["owner"],
+                    "asset": line["symbol"],
+                    "converted_price": line["converted_price"],
+                    "converted_cost_price": line["converted_cost_price"],
+                    "return": return_ratio(as_float(line["converted_price"]), as_float(line["converted_cost_price"])),
+                    "currency": snapshot["portfolio_currency"],
+                }
+                for line in snapshot["positions"]
+            ]
+        return result
+
+    # Deltas
+    @staticmethod
+    def add_to_sums(snapshot, line, sign: int):
+        price, cost = sign * as_number(line["converted_price"]), sign * as_number(line["converted_cost_price"])
+        snapshot["total"]["converted_price"] += price
+        snapshot["total"]["converted_cost_price"] += cost
+        for facet, key in GROUPS:
+            group = next((group for group in snapshot[facet] if group[key] == line[key]), None)
+            if group is None:
+                group = {key: line[key], "converted_price": 0, "converted_cost_price": 0}
+                snapshot[facet].append(group)
+            group["converted_price"] += price
+            group["converted_cost_price"] += cost
+
+    def update_line(self, snapshot, line, **changes):
+        # Take the line out of the sums, change it and add it back
+        self.add_to_sums(snapshot, line, -1)
+        line.update(changes)
+        line["converted_price"], line["converted_cost_price"] = self.line_values(line)
+        self.add_to_sums(snapshot, line, 1)
+        snapshot["deltas"] += 1
+
+    async def save(self, snapshots):
+        # Conditional writes : a snapshot changed by someone else since it was read is dropped
+        # and rebuilt on its next read, instead of overwriting the other change
+        if not snapshots:
+            return
+        write_id = uuid.uuid4().hex
+        operations, written, stale = [], [], []
+        for snapshot in snapshots:
+            if snapshot["deltas"] > self.rebuild_after:
+                # Rounding errors accumulate with the deltas
+                stale.append(snapshot["_id"])
+                continue
+            previous_write = snapshot.get("write_id")
+            snapshot["write_id"] = write_id
+            snapshot["last_updated_at"] = datetime.now(CH_timezone)
+            operations.append(ReplaceOne({"_id": snapshot["_id"], "write_id": previous_write}, snapshot))
+            written.append(snapshot["_id"])
+        if operations:
+            result = await self.collection.bulk_write(operations, ordered=False)
+            if result.matched_count < len(operations):
+                await self.collection.delete_many({"_id": {"$in": written}, "write_id": {"$ne": write_id}})
+        if stale:
+            await self.collection.delete_many({"_id": {"$in": stale}})
+
+    async def apply_trades(self, owner: str, name: str, positions):
+        # New quantity and cost price of the positions traded in a batch : O(1) change of the portfolio sums
+        # per position, the snapshot read and written once
+        if not positions or (snapshot := await self.get(owner, name)) is None:
+            return
+        lines = {line["symbol"]: line for line in snapshot["positions"]}
+        new_positions = [position for position in positions if position["symbol"] not in lines]
+        for position in positions:
+            if (line := lines.get(position["symbol"])) is not None:
+                self.update_line(snapshot, line, qty=position["qty"], cost_prices=position["cost_prices"])
+        if not new_positions:
+            await self.save([snapshot])
+            return
+        assets = await self.price_cache.get_assets([position["symbol"] for position in new_positions])
+        currency = snapshot["portfolio_currency"]
+        pairs = {asset["currency"] + currency for asset in assets.values() if asset["currency"] and currency}
+        rates = await self.price_cache.get_rates(sorted(pairs))
+        snapshot["symbols"] = sorted(set(snapshot["symbols"]) | {position["symbol"] for position in new_positions})
+        for position in new_positions:
+            asset = assets.get(position["symbol"])
+            pair = asset["currency"] + currency if asset is not None and asset["currency"] and currency else None
+            if pair not in rates:
+                # Only ever cleared : other positions may still be missing a price or a rate
+                snapshot["complete"] = False
+                continue
+            line = {
+                "symbol": position["symbol"], "asset_class": asset["asset_class"], "geo_zone": asset["geo_zone"], "pair": pair,
+                "qty": position["qty"], "cost_prices": position["cost_prices"], "last_price": asset["last_price"], "fx_rate": rates[pair],
+                "converted_price": None, "converted_cost_price": None,
+            }
+            snapshot["positions"].append(line)
+            snapshot["currency_pairs"] = sorted(set(snapshot["currency_pairs"]) | {pair})
+            snapshot["fx_rates"][pair] = rates[pair]
+            self.update_line(snapshot, line)
+        await self.save([snapshot])
+
+    async def apply_prices(self, prices):
+        # prices : symbol -> new last_price. Only the holders of these symbols are read and written.
+        if not prices:
+            return
+        snapshots = []
+        async for snapshot in self.collection.find({"symbols": {"$in": list(prices)}}):
+            for line in snapshot["positions"]:
+                if line["symbol"] in prices and line["last_price"] != prices[line["symbol"]]:
+                    self.update_line(snapshot, line, last_price=prices[line["symbol"]])
+            snapshots.append(snapshot)
+        await self.save(snapshots)
+
+    async def apply_rates(self, pairs=()):
+        # After an FX change of the given pairs : a quote can move every cross rate triangulated through it,
+        # so compare the rate stored by the holders of a pair in a moved currency with the current one
+        if not (currencies := await self.price_cache.moved_currencies(pairs)):
+            return
+        touched = pairs_touching(currencies)
+        pairs = [pair for pair in await self.collection.distinct("currency_pairs", touched) if {pair[:3], pair[-3:]} & currencies]
+        if not pairs:
+            return
+        rate_data = await self.price_cache.get_rates(pairs)
+        if missing := [pair for pair in pairs if pair not in rate_data]:
+            # No rate anymore : the positions leave the valuation, as in a full rebuild
+            await self.collection.delete_many({"currency_pairs": {"$in": missing}})
+        if not rate_data:
+            return
+        query = {"$or": [{"currency_pairs": pair, f"fx_rates.{pair}": {"$ne": rate}} for pair, rate in rate_data.items()]}
+        snapshots = []
+        async for snapshot in self.collection.find(query):
+            for line in snapshot["positions"]:
+                if (rate := rate_data.get(line["pair"])) is not None and line["fx_rate"] != rate:
+                    self.update_line(snapshot, line, fx_rate=rate)
+                    snapshot["fx_rates"][line["pair"]] = rate
+            snapshots.append(snapshot)
+        await self.save(snapshots)
+
+    # Invalidations : the next read values the portfolio again
+    async def invalidate_symbols(self, symbols):
+        await self.collection.delete_many({"symbols": {"$in": list(symbols)}})
+
+    async def invalidate_currencies(self, currencies):
+        if currencies:
+            await self.collection.delete_many(pairs_touching(currencies))
+
+    async def invalidate_incomplete(self):
+        await self.collection.delete_many({"complete": False})
+
+    async def invalidate(self, query):
+        await self.collection.delete_many(query)